@@ -0,0 +1,47 @@
+"""Compare two result files from run_benchmarks.py.
+
+Ratios are new / old, so values below 1 are improvements.
+"""
+
+import argparse
+import json
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("old", help="Results from the reference commit.")
+    parser.add_argument("new", help="Results from the commit being tested.")
+    return parser
+
+
+def main(argv=None):
+    """Print a per-benchmark comparison of run time and peak memory."""
+    args = _get_parser().parse_args(argv)
+    with open(args.old, "r") as fo:
+        old = json.load(fo)
+
+    with open(args.new, "r") as fo:
+        new = json.load(fo)
+
+    if old["size"] != new["size"]:
+        print(f"WARNING: comparing size {old['size']} to size {new['size']}")
+
+    print(f"{old['commit']} -> {new['commit']} ({new['size']})")
+    print(f"{'benchmark':<28}{'old s':>10}{'new s':>10}{'ratio':>8}{'old MB':>10}{'new MB':>10}")
+    for name in sorted(set(old["benchmarks"]) | set(new["benchmarks"])):
+        old_result = old["benchmarks"].get(name, {"status": "missing"})
+        new_result = new["benchmarks"].get(name, {"status": "missing"})
+        if old_result["status"] != "ok" or new_result["status"] != "ok":
+            print(f"{name:<28}{old_result['status']:>10}{new_result['status']:>10}")
+            continue
+
+        print(
+            f"{name:<28}"
+            f"{old_result['best_s']:>10.3f}{new_result['best_s']:>10.3f}"
+            f"{new_result['best_s'] / old_result['best_s']:>8.2f}"
+            f"{old_result['peak_mb']:>10.1f}{new_result['peak_mb']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
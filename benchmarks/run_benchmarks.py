@@ -0,0 +1,216 @@
+"""Time and memory-profile the processing hot paths on synthetic data.
+
+Each benchmark builds its inputs with :mod:`synthetic` in a temporary directory,
+then reports the best and median wall time over several repeats,
+and the peak traced memory (numpy and Python allocations) of a separate, single run.
+
+Results are written as JSON, so runs from different commits can be compared with
+``compare_benchmarks.py``::
+
+    python run_benchmarks.py --size medium --output bench_$(git rev-parse --short HEAD).json
+    python compare_benchmarks.py bench_abc1234.json bench_def5678.json
+
+Benchmarks whose module cannot be imported (e.g., fmriprep is not installed)
+are reported as skipped.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "processing"))
+
+import synthetic  # noqa: E402
+
+
+def bench_minimum_image_regression(work_dir, size):
+    """Minimum image regression on masked optimally combined data."""
+    import pandas as pd
+    from nilearn import image, masking
+    from run_tedana import minimum_image_regression
+
+    shape, n_vols, n_echoes, n_components = synthetic.SIZES[size]
+    files = synthetic.write_multiecho_run(work_dir, shape, n_vols, n_echoes, n_components)
+    mask_img = image.math_img("(img > 0).astype(int)", img=files["adaptive_mask"])
+    data_optcom = masking.apply_mask(files["optcom"], mask_img).T
+    mixing = pd.read_table(files["mixing"]).to_numpy()
+    component_table = pd.read_table(files["metrics"])
+
+    def run():
+        minimum_image_regression(
+            data_optcom=data_optcom,
+            mixing=mixing,
+            mask=mask_img,
+            component_table=component_table,
+        )
+
+    return run
+
+
+def bench_combine_classifications(work_dir, size):
+    """Merge of the AROMA and tedana component tables."""
+    import pandas as pd
+    from run_tedana import combine_classifications
+
+    _, n_vols, _, n_components = synthetic.SIZES[size]
+    synthetic.write_mixing(work_dir, n_vols, n_components)
+    tedana_df = pd.read_table(os.path.join(work_dir, "desc-tedana_metrics.tsv"))
+    aroma_df = pd.read_table(os.path.join(work_dir, "desc-aroma_metrics.tsv"))
+
+    def run():
+        combine_classifications(tedana_df, aroma_df)
+
+    return run
+
+
+def bench_calculate_t1maps(work_dir, size):
+    """T1 map estimation from a pair of TDP volumes."""
+    from calculate_t1maps import main
+
+    shape = synthetic.SIZES[size][0]
+    tdp1_file, tdp2_file, metadata = synthetic.write_tdp_pair(work_dir, shape)
+    out_file = os.path.join(work_dir, "T1map.nii.gz")
+
+    def run():
+        main(tdp1_file, tdp2_file, metadata, out_file)
+
+    return run
+
+
+def bench_average_echoes(work_dir, size):
+    """Cross-echo averaging of a phase derivative time series."""
+    from calculate_phase_jolt import average_echoes
+
+    shape, n_vols, n_echoes, _ = synthetic.SIZES[size]
+    phase_files = synthetic.write_phase_series(work_dir, shape, n_vols, n_echoes)
+    out_file = os.path.join(work_dir, "desc-jolt_bold.nii.gz")
+
+    def run():
+        average_echoes(phase_files, out_file)
+
+    return run
+
+
+def bench_phase_summary(work_dir, size):
+    """Brain-mask summaries of echo-wise phase derivatives and their across-echo means."""
+    import nibabel as nb
+    from calculate_phase_jolt import PHASE_DERIVATIVES, summarize_phase_derivatives
+
+    shape, n_vols, n_echoes, _ = synthetic.SIZES[size]
+    phase_files = synthetic.write_phase_series(work_dir, shape, n_vols, n_echoes)
+    mask_file = os.path.join(work_dir, "mask.nii.gz")
+    nb.Nifti1Image(np.ones(shape, dtype=np.uint8), np.eye(4)).to_filename(mask_file)
+    derivative_files = {name: phase_files for name in PHASE_DERIVATIVES}
+
+    def run():
+        summarize_phase_derivatives(derivative_files, mask_file)
+
+    return run
+
+
+BENCHMARKS = {
+    "minimum_image_regression": bench_minimum_image_regression,
+    "combine_classifications": bench_combine_classifications,
+    "calculate_t1maps": bench_calculate_t1maps,
+    "average_echoes": bench_average_echoes,
+    "phase_summary": bench_phase_summary,
+}
+
+
+def run_benchmark(setup, size, repeats):
+    """Set up one benchmark and measure its run time and peak memory."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            run = setup(work_dir, size)
+        except ImportError as exc:
+            return {"status": "skipped", "reason": repr(exc)}
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "status": "ok",
+        "best_s": min(timings),
+        "median_s": float(np.median(timings)),
+        "peak_mb": peak / 2**20,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCH_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=sorted(synthetic.SIZES), default="small")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        choices=sorted(BENCHMARKS),
+        default=list(BENCHMARKS),
+        help="Benchmarks to run. Default is all of them.",
+    )
+    parser.add_argument("--output", help="JSON file to write the results to.")
+    return parser
+
+
+def main(argv=None):
+    """Run the selected benchmarks and print and save the results."""
+    args = _get_parser().parse_args(argv)
+    results = {
+        "commit": _git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "size": args.size,
+        "repeats": args.repeats,
+        "benchmarks": {},
+    }
+    for name in args.benchmarks:
+        result = run_benchmark(BENCHMARKS[name], args.size, args.repeats)
+        results["benchmarks"][name] = result
+        if result["status"] == "ok":
+            print(
+                f"{name}: best {result['best_s']:.3f} s, median {result['median_s']:.3f} s, "
+                f"peak {result['peak_mb']:.1f} MB"
+            )
+        else:
+            print(f"{name}: skipped ({result['reason']})")
+
+    if args.output:
+        with open(args.output, "w") as fo:
+            json.dump(results, fo, indent=4)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
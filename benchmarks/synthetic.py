@@ -0,0 +1,183 @@
+"""Build synthetic inputs for the benchmarks.
+
+All generators are seeded, so the same size always produces the same data.
+"""
+
+import json
+import os
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+
+
+# (spatial shape, number of volumes, number of echoes, number of ICA components)
+SIZES = {
+    "small": ((32, 32, 20), 60, 5, 20),
+    "medium": ((64, 64, 40), 150, 5, 60),
+    "large": ((90, 108, 72), 240, 5, 100),
+}
+
+
+def _affine(voxel_size=2.0):
+    affine = np.eye(4)
+    affine[:3, :3] *= voxel_size
+    return affine
+
+
+def brain_mask(shape):
+    """Make an ellipsoidal "brain" mask filling most of the field of view."""
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij")
+    return sum(axis**2 for axis in grid) < 0.8
+
+
+def write_mixing(out_dir, n_vols, n_components, seed=0):
+    """Write a tedana-style mixing matrix and component table.
+
+    Returns
+    -------
+    mixing_file, metrics_file : str
+    """
+    rng = np.random.default_rng(seed)
+    columns = [f"ICA_{i:02d}" for i in range(n_components)]
+    mixing = rng.standard_normal((n_vols, n_components))
+    mixing_file = os.path.join(out_dir, "desc-ICA_mixing.tsv")
+    pd.DataFrame(mixing, columns=columns).to_csv(mixing_file, sep="\t", index=False)
+
+    component_table = pd.DataFrame(
+        {
+            "Component": columns,
+            "kappa": rng.random(n_components) * 100,
+            "rho": rng.random(n_components) * 100,
+            "classification": rng.choice(["accepted", "rejected"], n_components),
+            "classification_tags": rng.choice(
+                ["Likely BOLD", "Unlikely BOLD", "Likely BOLD;low variance", "accept borderline"],
+                n_components,
+            ),
+        }
+    )
+    metrics_file = os.path.join(out_dir, "desc-tedana_metrics.tsv")
+    component_table.to_csv(metrics_file, sep="\t", index=False)
+
+    aroma_table = pd.DataFrame(
+        {
+            "classification": rng.choice(["accepted", "rejected"], n_components),
+            "rationale": rng.choice(["HFC", "edge_fract;csf_fract", "max_RP_corr"], n_components),
+        }
+    )
+    for col in [
+        "edge_fract",
+        "csf_fract",
+        "max_RP_corr",
+        "HFC",
+        "model_variance_explained",
+        "total_variance_explained",
+    ]:
+        aroma_table[col] = rng.random(n_components)
+
+    aroma_table.to_csv(os.path.join(out_dir, "desc-aroma_metrics.tsv"), sep="\t", index=False)
+    return mixing_file, metrics_file
+
+
+def write_multiecho_run(out_dir, shape, n_vols, n_echoes, n_components, seed=0):
+    """Write a multi-echo run with the tedana outputs used by run_tedana_aroma.
+
+    The data are a mixture of the components plus noise, with a T2*-like echo-time decay.
+
+    Returns
+    -------
+    files : dict
+        Paths to the echo files, optcom, adaptive mask, mixing matrix, and component tables.
+    """
+    rng = np.random.default_rng(seed)
+    mixing_file, metrics_file = write_mixing(out_dir, n_vols, n_components, seed=seed)
+    mixing = pd.read_table(mixing_file).to_numpy()
+
+    mask = brain_mask(shape)
+    maps = rng.standard_normal((int(mask.sum()), n_components)).astype(np.float32)
+    signal = np.dot(maps, mixing.T.astype(np.float32))
+    s0 = 1000 + 100 * rng.random((mask.sum(), 1)).astype(np.float32)
+    t2star = 0.03 + 0.02 * rng.random((mask.sum(), 1)).astype(np.float32)
+
+    files = {
+        "echoes": [],
+        "echo_times": [0.0142 + 0.0196 * i for i in range(n_echoes)],
+        "mixing": mixing_file,
+        "metrics": metrics_file,
+        "aroma_metrics": os.path.join(out_dir, "desc-aroma_metrics.tsv"),
+    }
+    optcom = np.zeros((mask.sum(), n_vols), dtype=np.float32)
+    for i_echo, echo_time in enumerate(files["echo_times"]):
+        echo_data = s0 * np.exp(-echo_time / t2star) * (1 + 0.01 * signal)
+        echo_data += rng.standard_normal(echo_data.shape).astype(np.float32)
+        optcom += echo_data / n_echoes
+        echo_file = os.path.join(out_dir, f"echo-{i_echo + 1}_desc-preproc_bold.nii.gz")
+        _write_masked(echo_data, mask, echo_file)
+        files["echoes"].append(echo_file)
+
+    files["optcom"] = os.path.join(out_dir, "desc-optcom_bold.nii.gz")
+    _write_masked(optcom, mask, files["optcom"])
+    files["adaptive_mask"] = os.path.join(out_dir, "desc-adaptiveGoodSignal_mask.nii.gz")
+    nb.Nifti1Image((mask * n_echoes).astype(np.int16), _affine()).to_filename(
+        files["adaptive_mask"]
+    )
+    return files
+
+
+def _write_masked(data, mask, out_file):
+    arr = np.zeros(mask.shape + (data.shape[1],), dtype=np.float32)
+    arr[mask] = data
+    nb.Nifti1Image(arr, _affine()).to_filename(out_file)
+
+
+def write_tdp_pair(out_dir, shape, seed=0):
+    """Write a pair of transit delay prescan volumes and the second volume's metadata.
+
+    The second volume is generated from a T1 map with the signal model in calculate_t1maps.py.
+
+    Returns
+    -------
+    tdp1_file, tdp2_file : str
+    tdp2_metadata : dict
+    """
+    rng = np.random.default_rng(seed)
+    metadata = {"SaturationPulseTime": 5, "InversionTime": 1.978}
+    trec = metadata["SaturationPulseTime"] * 1000
+    ti = metadata["InversionTime"] * 1000
+
+    mask = brain_mask(shape)
+    t1 = rng.uniform(600, 4500, shape)
+    tdp1 = np.where(mask, 1000 + 100 * rng.random(shape), rng.random(shape))
+    ratio = (1 - 2 * np.exp(-ti / t1) + np.exp(-trec / t1)) / (1 - np.exp(-trec / t1))
+    tdp2 = tdp1 * ratio
+
+    tdp1_file = os.path.join(out_dir, "acq-tr1_TDP.nii.gz")
+    tdp2_file = os.path.join(out_dir, "acq-tr2_TDP.nii.gz")
+    nb.Nifti1Image(tdp1.astype(np.float32), _affine(3.0)).to_filename(tdp1_file)
+    nb.Nifti1Image(tdp2.astype(np.float32), _affine(3.0)).to_filename(tdp2_file)
+    with open(tdp2_file.replace(".nii.gz", ".json"), "w") as fo:
+        json.dump(metadata, fo, indent=4, sort_keys=True)
+
+    return tdp1_file, tdp2_file, metadata
+
+
+def write_phase_series(out_dir, shape, n_vols, n_echoes, seed=0, extension=".nii.gz"):
+    """Write wrapped phase time series, in radians, for each echo.
+
+    Returns
+    -------
+    phase_files : list of str
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.meshgrid(*[np.linspace(-np.pi, np.pi, n) for n in shape], indexing="ij")
+    background = 3 * grid[0] + 2 * grid[1] + grid[2]
+    phase_files = []
+    for i_echo in range(n_echoes):
+        phase = (i_echo + 1) * background[..., np.newaxis]
+        phase = phase + 0.1 * rng.standard_normal(shape + (n_vols,))
+        phase = np.angle(np.exp(1j * phase)).astype(np.float32)
+        phase_file = os.path.join(out_dir, f"echo-{i_echo + 1}_part-phase_bold{extension}")
+        nb.Nifti1Image(phase, _affine()).to_filename(phase_file)
+        phase_files.append(phase_file)
+
+    return phase_files
@@ -1,27 +1,21 @@
-"""Expand dicom zip files in order to heudiconv."""
+"""Expand dicom zip files in order to heudiconv.
+
+Archives are extracted concurrently and verified member by member.
+A subject is added to the status file only after its archive has been extracted completely,
+so interrupted subjects are extracted again on the next run.
+"""
 
 import os
-import zipfile
 from glob import glob
 
+from utils import extract_zips, print_job_summary
+
 
 if __name__ == "__main__":
     status_file = "/cbica/projects/pafin/sourcedata/curation_files/01_status_unzip_dicom_zips.txt"
-    if os.path.exists(status_file):
-        with open(status_file, "r") as f:
-            unzipped_subjects = f.read().splitlines()
-    else:
-        unzipped_subjects = []
+    n_threads = 4
 
     zip_files = sorted(glob("/cbica/projects/pafin/sourcedata/imaging/*.zip"))
-    for zip_file in zip_files:
-        subject = os.path.basename(zip_file).split(".")[0]
-        if subject in unzipped_subjects:
-            print(f"Subject {subject} already processed, skipping...")
-        else:
-            print(f"Processing {subject}...")
-            with zipfile.ZipFile(zip_file, "r") as zip_ref:
-                zip_ref.extractall(os.path.dirname(zip_file))
-            print(f"Subject {subject} processed successfully.")
-            with open(status_file, "a") as f:
-                f.write(f"{subject}\n")
+    groups = {os.path.basename(zip_file).split(".")[0]: [zip_file] for zip_file in zip_files}
+    results = extract_zips(groups, status_file, n_threads=n_threads)
+    print_job_summary(results)
@@ -1,36 +1,50 @@
-"""Convert physio DICOM files with bidsphysio."""
+"""Convert physio DICOM files with bidsphysio.
 
+All of the conversions are planned first, then run in a process pool,
+and a summary of the converted, skipped, and failed recordings is printed and saved as JSON.
+"""
+
+import json
 import os
 import re
 from glob import glob
 
 from bidsphysio.dcm2bids import dcm2bidsphysio
+from utils import print_job_summary, run_jobs
 
 
-if __name__ == "__main__":
-    in_dir = "/cbica/projects/pafin"
+def plan_conversions(in_dir, session_id="1"):
+    """Find the physio DICOMs to convert and their output prefixes.
+
+    Parameters
+    ----------
+    in_dir : str
+        Path to the project directory.
+    session_id : str
+        Session label of the outputs.
 
+    Returns
+    -------
+    jobs : dict
+        Mapping from output prefix (without the directory) to the keyword arguments
+        of :func:`convert_physio`.
+    skipped : dict
+        Mapping from a run's output prefix or PhysioLog directory to the reason it was skipped.
+    """
+    jobs, skipped = {}, {}
     subject_dirs = sorted(
         glob(os.path.join(in_dir, "sourcedata/imaging/scitran/bbl/PAFIN_844353/*_*"))
     )
     for subject_dir in subject_dirs:
         subject_folder = os.path.basename(subject_dir)
         subject_id = subject_folder.split("_")[0]
-        print(subject_id)
-        session_id = "1"
         search = os.path.join(subject_dir, "CAMRIS^Satterthwait*/*func*_PhysioLog*")
         physio_dirs = sorted(glob(search))
-        physio_folders = [os.path.basename(physio_dir) for physio_dir in physio_dirs]
         if not physio_dirs:
-            print(
-                "No physio found with pattern "
-                f"{os.path.join(subject_dir, 'CAMRIS^Satterthwait*/*func*_PhysioLog*')}"
-            )
-        else:
-            print("\t" + "\n\t".join(physio_dirs))
+            skipped[subject_folder] = f"No physio found with pattern {search}"
 
+        physio_folders = [os.path.basename(physio_dir) for physio_dir in physio_dirs]
         run_types = sorted(set([f.split("_PhysioLog")[0] for f in physio_folders]))
-        print("\n".join(run_types))
         for run_type in run_types:
             search2 = os.path.join(subject_dir, "CAMRIS^Satterthwait*", run_type + "_PhysioLog*")
             run_dirs = sorted(glob(search2))
@@ -38,20 +52,20 @@ if __name__ == "__main__":
                 run_num = i_run + 1
                 physio_dicoms = sorted(glob(os.path.join(run_dir, "*.dcm")))
                 if not physio_dicoms:
-                    print(f"No dicoms in {run_dir}")
+                    skipped[run_dir] = "No dicoms found"
                     continue
 
                 physio_dicom = physio_dicoms[0]
                 out_dir = os.path.join(in_dir, f"dset/sub-{subject_id}/ses-{session_id}/func")
                 fname = os.path.basename(physio_dicom)
                 if "task" not in fname:
-                    print(f"No 'task' found in {fname}")
+                    skipped[run_dir] = f"No 'task' found in {fname}"
                     continue
 
                 task = re.findall("_task-([a-zA-Z0-9]+)_", fname)[0]
                 acqs_found = re.findall("_acq-([a-zA-Z0-9]+)_", fname)
                 dirs_found = re.findall("_dir-([a-zA-Z0-9]+)_", fname)
-                runs_found = re.findall("_run-(\d+)_", fname)
+                runs_found = re.findall(r"_run-(\d+)_", fname)
 
                 prefix = os.path.join(
                     out_dir,
@@ -69,14 +83,36 @@ if __name__ == "__main__":
 
                 prefix += f"_run-{run_num:02d}"
 
-                physio_file = prefix + '*_physio.tsv.gz'
-                print(physio_file)
-                if len(glob(physio_file)) > 0:
-                    print('Physio already converted.')
+                name = os.path.basename(prefix)
+                if glob(prefix + "*_physio.tsv.gz"):
+                    skipped[name] = "Physio already converted"
                     continue
 
-                try:
-                    physio_data = dcm2bidsphysio.dcm2bids(physio_dicom)
-                    physio_data.save_to_bids(bids_fName=prefix)
-                except Exception as e:
-                    print(e)
+                jobs[name] = {"physio_dicom": physio_dicom, "prefix": prefix}
+
+    return jobs, skipped
+
+
+def convert_physio(physio_dicom, prefix):
+    """Convert one physio DICOM to BIDS physio files."""
+    physio_data = dcm2bidsphysio.dcm2bids(physio_dicom)
+    physio_data.save_to_bids(bids_fName=prefix)
+
+
+if __name__ == "__main__":
+    in_dir = "/cbica/projects/pafin"
+    summary_file = "/cbica/projects/pafin/sourcedata/curation_files/04_convert_physio_summary.json"
+    n_procs = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+
+    jobs, skipped = plan_conversions(in_dir)
+    print(f"{len(jobs)} conversions planned, {len(skipped)} skipped")
+    results = run_jobs(convert_physio, jobs, n_procs=n_procs)
+    results.update({name: ("skipped", reason) for name, reason in skipped.items()})
+    print_job_summary(results)
+
+    summary = {
+        status: {name: message for name, (s, message) in results.items() if s == status}
+        for status in ("done", "skipped", "failed")
+    }
+    with open(summary_file, "w") as fo:
+        json.dump(summary, fo, indent=4, sort_keys=True)
@@ -1,9 +1,7 @@
 #!/cbica/projects/pafin/miniforge3/envs/curation/bin/python
 """Remove unneeded fields from bottom-level JSON files."""
 
-import json
-import os
-from glob import glob
+from utils import BIDSIndex, SidecarEditor
 
 
 if __name__ == "__main__":
@@ -19,14 +17,10 @@ if __name__ == "__main__":
         "ImageComments",
     ]
 
-    json_files = sorted(glob(os.path.join(dset_dir, "sub-*/ses-*/*/*.json")))
+    json_files = BIDSIndex(dset_dir).get(extension=".json")
+    editor = SidecarEditor()
     for json_file in json_files:
-        with open(json_file, "r") as fo:
-            json_data = json.load(fo)
+        editor.drop(json_file, drop_keys)
 
-        for drop_key in drop_keys:
-            if drop_key in json_data.keys():
-                json_data.pop(drop_key)
-
-        with open(json_file, "w") as fo:
-            json.dump(json_data, fo, indent=4, sort_keys=True)
+    changed = editor.write(n_threads=8)
+    print(f"{len(changed)} of {len(json_files)} JSON files changed")
@@ -5,6 +5,8 @@ The necessary steps are:
 
 1.  Split out noRF noise scans from multi-echo BOLD scans.
     -   Also copy the JSON.
+    -   Runs are split in parallel, streaming the volumes to temporary files
+        that are renamed into place, with the BOLD file last.
 2.  Copy first echo of each multi-echo field map without echo entity,
     and change the acq entity from func+meepi to func.
 3.  Remove events files.
@@ -14,123 +16,179 @@ The necessary steps are:
 7.  Add multi-echo field maps to .bidsignore.
 """
 
-import json
 import os
 import shutil
-from glob import glob
 
 import nibabel as nb
+import numpy as np
+from utils import BIDSIndex, SidecarEditor, atomic_output, print_job_summary, run_jobs
 
 
 N_NOISE_VOLS = 3
+FULL_RUN_LENGTHS = (246, 366, 204)
+
+
+def _copy_volumes(fi, fo, n_bytes, chunk_size):
+    """Copy a number of bytes between two open files, in chunks."""
+    while n_bytes > 0:
+        chunk = fi.read(min(chunk_size, n_bytes))
+        if not chunk:
+            raise ValueError(f"{fi.name} ended {n_bytes} bytes early")
+
+        fo.write(chunk)
+        n_bytes -= len(chunk)
+
+
+def _write_header(fo, header, n_vols):
+    """Write a copy of a NIfTI header with a new number of volumes, up to the data offset."""
+    header = header.copy()
+    header.set_data_shape(header.get_data_shape()[:3] + (n_vols,))
+    header.write_to(fo)
+    fo.write(b"\x00" * (header.get_data_offset() - fo.tell()))
+
+
+def split_noise_volumes(bold_file, noise_file, n_noise_vols=N_NOISE_VOLS, chunk_size=2**26):
+    """Split the trailing noise volumes of a BOLD run into their own file.
+
+    The volumes are streamed from the original file, as stored (i.e., without rescaling),
+    to temporary files, so the run is never held in memory.
+    The scaling factors of the original file are written to both new headers.
+    The noise file and its JSON are moved into place first, then the BOLD file,
+    so an interrupted split leaves the original run in place and is simply done again.
+
+    Parameters
+    ----------
+    bold_file : str
+        Path to the BOLD file, which is overwritten with all but the noise volumes.
+    noise_file : str
+        Path to the noise file to write.
+    n_noise_vols : int
+        Number of noise volumes at the end of the run.
+    chunk_size : int
+        Maximum number of bytes to read at a time.
+
+    Returns
+    -------
+    status : str
+        "done", or "skipped" for runs that are already split or are partial scans.
+    """
+    img = nb.load(bold_file)
+    n_vols = img.shape[-1]
+    if n_vols not in FULL_RUN_LENGTHS:
+        if os.path.isfile(noise_file):
+            print(f"File exists: {os.path.basename(noise_file)}")
+        else:
+            print(f"File is a partial scan: {os.path.basename(bold_file)}")
+        return "skipped"
+
+    # The loaded header's scl_slope and scl_inter are NaN, as nibabel moves them to the dataobj,
+    # so they must be restored for the copied values to keep their meaning
+    header = img.header.copy()
+    header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    vol_bytes = header.get_data_dtype().itemsize * int(np.prod(img.shape[:3]))
+    n_bold_vols = n_vols - n_noise_vols
+    with atomic_output(bold_file) as bold_temp, atomic_output(noise_file) as noise_temp:
+        with nb.openers.ImageOpener(bold_file, "rb") as fi:
+            fi.seek(img.dataobj.offset)
+            with nb.openers.ImageOpener(bold_temp, "wb") as fo:
+                _write_header(fo, header, n_bold_vols)
+                _copy_volumes(fi, fo, n_bold_vols * vol_bytes, chunk_size)
+
+            with nb.openers.ImageOpener(noise_temp, "wb") as fo:
+                _write_header(fo, header, n_noise_vols)
+                _copy_volumes(fi, fo, n_noise_vols * vol_bytes, chunk_size)
+
+        # Copy the JSON as well
+        with atomic_output(noise_file.replace(".nii.gz", ".json")) as json_temp:
+            shutil.copyfile(bold_file.replace(".nii.gz", ".json"), json_temp)
+
+    return "done"
 
 
 if __name__ == "__main__":
     dset_dir = "/cbica/projects/pafin/dset"
-    subject_dirs = sorted(glob(os.path.join(dset_dir, "sub-*")))
-    for subject_dir in subject_dirs:
-        sub_id = os.path.basename(subject_dir)
-        session_dirs = sorted(glob(os.path.join(subject_dir, "ses-*")))
-        for session_dir in session_dirs:
-            ses_id = os.path.basename(session_dir)
-
-            fmap_dir = os.path.join(session_dir, "fmap")
-            func_dir = os.path.join(session_dir, "func")
-            dwi_dir = os.path.join(session_dir, "dwi")
-
-            # Remove events files
-            events_files = sorted(
-                glob(os.path.join(func_dir, "*part-mag_events.tsv"))
-                + glob(os.path.join(func_dir, "*part-phase_events.tsv"))
-            )
-            for events_file in events_files:
-                os.remove(events_file)
-
-            # Split out noise scans from all multi-echo BOLD files.
-            me_bolds = sorted(glob(os.path.join(func_dir, "*echo-*_bold.nii.gz")))
-            for me_bold in me_bolds:
-                noise_scan = me_bold.replace("_bold.nii.gz", "_noRF.nii.gz")
-                if os.path.isfile(noise_scan):
-                    print(f"File exists: {os.path.basename(noise_scan)}")
-                    continue
-
-                img = nb.load(me_bold)
-                n_vols = img.shape[-1]
-                if n_vols not in (246, 366, 204):
-                    print(f"File is a partial scan: {os.path.basename(me_bold)}")
-                    continue
-
-                noise_img = img.slicer[..., -N_NOISE_VOLS:]
-                bold_img = img.slicer[..., :-N_NOISE_VOLS]
-
-                # Overwrite the BOLD scan
-                os.remove(me_bold)
-
-                bold_img.to_filename(me_bold)
-                noise_img.to_filename(noise_scan)
-
-                # Copy the JSON as well
-                shutil.copyfile(
-                    me_bold.replace(".nii.gz", ".json"),
-                    noise_scan.replace(".nii.gz", ".json"),
-                )
-
-            # Copy first echo of multi-echo field maps without echo entity.
-            me_fmaps = sorted(glob(os.path.join(fmap_dir, "*_acq-func+meepi*_echo-1*epi.*")))
-            for me_fmap in me_fmaps:
-                out_fmap = me_fmap.replace("_echo-1_", "_").replace("_acq-func+meepi", "_acq-func")
-                if os.path.isfile(out_fmap):
-                    print(f"File exists: {os.path.basename(out_fmap)}")
-                    continue
-
-                me_fmap_fname = os.path.join("fmap", os.path.basename(me_fmap))
-                out_fmap_fname = os.path.join("fmap", os.path.basename(out_fmap))
-                shutil.copyfile(me_fmap, out_fmap)
-
-            # Remove part-phase bvec and bval field map files
-            part_phase_bvecs = sorted(glob(os.path.join(fmap_dir, "*_part-phase*.bvec")))
-            for part_phase_bvec in part_phase_bvecs:
-                os.remove(part_phase_bvec)
-            part_phase_bvals = sorted(glob(os.path.join(fmap_dir, "*_part-phase*.bval")))
-            for part_phase_bval in part_phase_bvals:
-                os.remove(part_phase_bval)
-
-            # Remove part-phase bvec and bval DWI files
-            part_phase_bvecs = sorted(glob(os.path.join(dwi_dir, "*_part-phase*.bvec")))
-            for part_phase_bvec in part_phase_bvecs:
-                os.remove(part_phase_bvec)
-            part_phase_bvals = sorted(glob(os.path.join(dwi_dir, "*_part-phase*.bval")))
-            for part_phase_bval in part_phase_bvals:
-                os.remove(part_phase_bval)
-
-            # Drop part entity from part-mag bvec and bval field map filenames
-            part_mag_bvecs = sorted(glob(os.path.join(fmap_dir, "*_part-mag*.bvec")))
-            for part_mag_bvec in part_mag_bvecs:
-                new_part_mag_bvec = part_mag_bvec.replace("_part-mag", "")
-                os.rename(part_mag_bvec, new_part_mag_bvec)
-            part_mag_bvals = sorted(glob(os.path.join(fmap_dir, "*_part-mag*.bval")))
-            for part_mag_bval in part_mag_bvals:
-                new_part_mag_bval = part_mag_bval.replace("_part-mag", "")
-                os.rename(part_mag_bval, new_part_mag_bval)
-
-            # Drop part entity from part-mag bvec and bval DWI filenames
-            part_mag_bvecs = sorted(glob(os.path.join(dwi_dir, "*_part-mag*.bvec")))
-            for part_mag_bvec in part_mag_bvecs:
-                new_part_mag_bvec = part_mag_bvec.replace("_part-mag", "")
-                os.rename(part_mag_bvec, new_part_mag_bvec)
-            part_mag_bvals = sorted(glob(os.path.join(dwi_dir, "*_part-mag*.bval")))
-            for part_mag_bval in part_mag_bvals:
-                new_part_mag_bval = part_mag_bval.replace("_part-mag", "")
-                os.rename(part_mag_bval, new_part_mag_bval)
-
-            # Add Units: arbitrary to all phase JSONs
-            phase_jsons = sorted(glob(os.path.join(session_dir, "*", "*part-phase*.json")))
-            for phase_json in phase_jsons:
-                with open(phase_json, "r") as f:
-                    data = json.load(f)
-                data["Units"] = "arbitrary"
-                with open(phase_json, "w") as f:
-                    json.dump(data, f, indent=4)
+    n_procs = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+    index = BIDSIndex(dset_dir)
+
+    # Split out noise scans from all multi-echo BOLD files.
+    me_bolds = index.get(datatype="func", pattern="*echo-*_bold.nii.gz")
+    noise_scans = {me_bold: me_bold.replace("_bold.nii.gz", "_noRF.nii.gz") for me_bold in me_bolds}
+    jobs = {
+        os.path.basename(me_bold): {"bold_file": me_bold, "noise_file": noise_scan}
+        for me_bold, noise_scan in noise_scans.items()
+    }
+    print_job_summary(run_jobs(split_noise_volumes, jobs, n_procs=n_procs))
+    for noise_scan in noise_scans.values():
+        for noise_file in (noise_scan, noise_scan.replace(".nii.gz", ".json")):
+            if os.path.isfile(noise_file):
+                index.add(noise_file)
+
+    editor = SidecarEditor()
+    for sub_id, ses_id in index.sessions():
+        # Remove events files
+        events_files = sorted(
+            index.get(sub_id, ses_id, "func", pattern="*part-mag_events.tsv")
+            + index.get(sub_id, ses_id, "func", pattern="*part-phase_events.tsv")
+        )
+        for events_file in events_files:
+            index.remove(events_file)
+
+        # Copy first echo of multi-echo field maps without echo entity.
+        me_fmaps = index.get(sub_id, ses_id, "fmap", pattern="*_acq-func+meepi*_echo-1*epi.*")
+        for me_fmap in me_fmaps:
+            out_fmap = me_fmap.replace("_echo-1_", "_").replace("_acq-func+meepi", "_acq-func")
+            if os.path.isfile(out_fmap):
+                print(f"File exists: {os.path.basename(out_fmap)}")
+                continue
+
+            me_fmap_fname = os.path.join("fmap", os.path.basename(me_fmap))
+            out_fmap_fname = os.path.join("fmap", os.path.basename(out_fmap))
+            shutil.copyfile(me_fmap, out_fmap)
+            index.add(out_fmap)
+
+        # Remove part-phase bvec and bval field map files
+        part_phase_bvecs = index.get(sub_id, ses_id, "fmap", pattern="*_part-phase*.bvec")
+        for part_phase_bvec in part_phase_bvecs:
+            index.remove(part_phase_bvec)
+        part_phase_bvals = index.get(sub_id, ses_id, "fmap", pattern="*_part-phase*.bval")
+        for part_phase_bval in part_phase_bvals:
+            index.remove(part_phase_bval)
+
+        # Remove part-phase bvec and bval DWI files
+        part_phase_bvecs = index.get(sub_id, ses_id, "dwi", pattern="*_part-phase*.bvec")
+        for part_phase_bvec in part_phase_bvecs:
+            index.remove(part_phase_bvec)
+        part_phase_bvals = index.get(sub_id, ses_id, "dwi", pattern="*_part-phase*.bval")
+        for part_phase_bval in part_phase_bvals:
+            index.remove(part_phase_bval)
+
+        # Drop part entity from part-mag bvec and bval field map filenames
+        part_mag_bvecs = index.get(sub_id, ses_id, "fmap", pattern="*_part-mag*.bvec")
+        for part_mag_bvec in part_mag_bvecs:
+            new_part_mag_bvec = part_mag_bvec.replace("_part-mag", "")
+            index.rename(part_mag_bvec, new_part_mag_bvec)
+        part_mag_bvals = index.get(sub_id, ses_id, "fmap", pattern="*_part-mag*.bval")
+        for part_mag_bval in part_mag_bvals:
+            new_part_mag_bval = part_mag_bval.replace("_part-mag", "")
+            index.rename(part_mag_bval, new_part_mag_bval)
+
+        # Drop part entity from part-mag bvec and bval DWI filenames
+        part_mag_bvecs = index.get(sub_id, ses_id, "dwi", pattern="*_part-mag*.bvec")
+        for part_mag_bvec in part_mag_bvecs:
+            new_part_mag_bvec = part_mag_bvec.replace("_part-mag", "")
+            index.rename(part_mag_bvec, new_part_mag_bvec)
+        part_mag_bvals = index.get(sub_id, ses_id, "dwi", pattern="*_part-mag*.bval")
+        for part_mag_bval in part_mag_bvals:
+            new_part_mag_bval = part_mag_bval.replace("_part-mag", "")
+            index.rename(part_mag_bval, new_part_mag_bval)
+
+        # Add Units: arbitrary to all phase JSONs
+        phase_jsons = index.get(sub_id, ses_id, pattern="*part-phase*.json")
+        for phase_json in phase_jsons:
+            editor.update(phase_json, {"Units": "arbitrary"})
+
+    changed = editor.write(n_threads=8)
+    print(f"{len(changed)} JSON files changed")
 
     # Add multi-echo field maps to .bidsignore.
     bidsignore_file = os.path.join(dset_dir, ".bidsignore")
@@ -21,118 +21,100 @@ TODO:
 2.  Switch BIDS-URI IntendedFors in the DWI scans for relative paths.
 """
 
-import json
 import os
-from glob import glob
+
+from utils import BIDSIndex, SidecarEditor
 
 
 if __name__ == "__main__":
     dset_dir = "/cbica/projects/pafin/dset"
-    subject_dirs = sorted(glob(os.path.join(dset_dir, "sub-*")))
-    for subject_dir in subject_dirs:
-        subject = os.path.basename(subject_dir)
-
-        session_dirs = sorted(glob(os.path.join(subject_dir, "ses-*")))
-        for session_dir in session_dirs:
-            session = os.path.basename(session_dir)
-
-            fmap_dir = os.path.join(session_dir, "fmap")
-            func_dir = os.path.join(session_dir, "func")
-            dmri_dir = os.path.join(session_dir, "dwi")
-
-            # Remove intendedfor-related fields from multi-echo field maps.
-            me_fmap_jsons = sorted(
-                glob(os.path.join(fmap_dir, "*_acq-func+meepi*_echo-*_sbref.json"))
-                + glob(os.path.join(fmap_dir, "*_acq-func+meepi*_echo-*_epi.json"))
-            )
-            for me_fmap_json in me_fmap_jsons:
-                with open(me_fmap_json, "r") as fo:
-                    json_metadata = json.load(fo)
-
-                if "B0FieldIdentifier" in json_metadata.keys():
-                    json_metadata.pop("B0FieldIdentifier")
-
-                if "B0FieldSource" in json_metadata.keys():
-                    json_metadata.pop("B0FieldSource")
-
-                if "IntendedFor" in json_metadata.keys():
-                    json_metadata.pop("IntendedFor")
-
-                with open(me_fmap_json, "w") as fo:
-                    json.dump(json_metadata, fo, sort_keys=True, indent=4)
-
-            # Add intendedfor-related fields to single-echo field maps.
-            se_fmap_jsons = sorted(glob(os.path.join(fmap_dir, "*acq-func_*part-mag*epi.json")))
-            for ap_fmap_json in se_fmap_jsons:
-                pa_fmap_json = ap_fmap_json.replace("_dir-AP_", "_dir-PA_")
-                with open(ap_fmap_json, "r") as fo:
-                    ap_metadata = json.load(fo)
-
-                with open(pa_fmap_json, "r") as fo:
-                    pa_metadata = json.load(fo)
-
-                # B0Field names should be funcpepolar[run]
-                # Extract run number from filename
-                run_number = ap_fmap_json.split("_run-")[1].split("_")[0]
-                b0fieldname = f"funcpepolar{run_number}"
-
-                target_files = sorted(glob(os.path.join(func_dir, "*bold.nii.gz")))
-                target_jsons = [f.replace(".nii.gz", ".json") for f in target_files]
-                ap_metadata["B0FieldIdentifier"] = [b0fieldname]
-                pa_metadata["B0FieldIdentifier"] = [b0fieldname]
-                target_filenames = [
-                    "bids::" + tf.replace(dset_dir + "/", "") for tf in target_files
-                ]
-                ap_metadata["IntendedFor"] = target_filenames
-                pa_metadata["IntendedFor"] = target_filenames
-
-                with open(ap_fmap_json, "w") as fo:
-                    json.dump(ap_metadata, fo, sort_keys=True, indent=4)
-
-                with open(pa_fmap_json, "w") as fo:
-                    json.dump(pa_metadata, fo, sort_keys=True, indent=4)
-
-                for target_json in target_jsons:
-                    task = target_json.split("_task-")[1].split("_")[0]
-                    run = target_json.split("_run-")[1].split("_")[0]
-                    medic_name = f"medic{task}{run}"
-
-                    with open(target_json, "r") as fo:
-                        target_metadata = json.load(fo)
-
-                    # if "B0FieldSource" not in target_metadata.keys():
-                    target_metadata["B0FieldSource"] = []
-                    target_metadata["B0FieldSource"].append(b0fieldname)
-                    target_metadata["B0FieldSource"].append(medic_name)
-                    target_metadata["B0FieldIdentifier"] = [medic_name]
-
-                    with open(target_json, "w") as fo:
-                        json.dump(target_metadata, fo, sort_keys=True, indent=4)
-
-            # Add intendedfor-related fields to dwi field maps.
-            dwi_fmap_jsons = sorted(glob(os.path.join(fmap_dir, "*acq-dwi_*part-mag*epi.json")))
-            for dwi_fmap_json in dwi_fmap_jsons:
-                run = dwi_fmap_json.split("_run-")[1].split("_")[0]
-                with open(dwi_fmap_json, "r") as fo:
-                    json_metadata = json.load(fo)
-
-                target_files = sorted(glob(os.path.join(dmri_dir, "*dwi.nii.gz")))
-                target_jsons = [f.replace(".nii.gz", ".json") for f in target_files]
-                json_metadata["IntendedFor"] = [
-                    tf.replace(os.path.join(dset_dir, subject) + "/", "") for tf in target_files
-                ]
-                b0fieldname = f"topupdwi{run}"
-                json_metadata["B0FieldIdentifier"] = [b0fieldname]
-
-                with open(dwi_fmap_json, "w") as fo:
-                    json.dump(json_metadata, fo, sort_keys=True, indent=4)
-
-                for target_json in target_jsons:
-                    with open(target_json, "r") as fo:
-                        target_metadata = json.load(fo)
-
-                    target_metadata["B0FieldSource"] = [b0fieldname]
-                    target_metadata["B0FieldIdentifier"] = [b0fieldname]
-
-                    with open(target_json, "w") as fo:
-                        json.dump(target_metadata, fo, sort_keys=True, indent=4)
+    index = BIDSIndex(dset_dir)
+    editor = SidecarEditor()
+    for subject, session in index.sessions():
+        # Remove intendedfor-related fields from multi-echo field maps.
+        me_fmap_jsons = sorted(
+            index.get(subject, session, "fmap", pattern="*_acq-func+meepi*_echo-*_sbref.json")
+            + index.get(subject, session, "fmap", pattern="*_acq-func+meepi*_echo-*_epi.json")
+        )
+        for me_fmap_json in me_fmap_jsons:
+            json_metadata = editor.get(me_fmap_json)
+
+            if "B0FieldIdentifier" in json_metadata.keys():
+                json_metadata.pop("B0FieldIdentifier")
+
+            if "B0FieldSource" in json_metadata.keys():
+                json_metadata.pop("B0FieldSource")
+
+            if "IntendedFor" in json_metadata.keys():
+                json_metadata.pop("IntendedFor")
+
+            editor.replace(me_fmap_json, json_metadata)
+
+        # Add intendedfor-related fields to single-echo field maps.
+        se_fmap_jsons = index.get(subject, session, "fmap", pattern="*acq-func_*part-mag*epi.json")
+        for ap_fmap_json in se_fmap_jsons:
+            pa_fmap_json = ap_fmap_json.replace("_dir-AP_", "_dir-PA_")
+            ap_metadata = editor.get(ap_fmap_json)
+
+            pa_metadata = editor.get(pa_fmap_json)
+
+            # B0Field names should be funcpepolar[run]
+            # Extract run number from filename
+            run_number = ap_fmap_json.split("_run-")[1].split("_")[0]
+            b0fieldname = f"funcpepolar{run_number}"
+
+            target_files = index.get(subject, session, "func", pattern="*bold.nii.gz")
+            target_jsons = [f.replace(".nii.gz", ".json") for f in target_files]
+            ap_metadata["B0FieldIdentifier"] = [b0fieldname]
+            pa_metadata["B0FieldIdentifier"] = [b0fieldname]
+            target_filenames = [
+                "bids::" + tf.replace(dset_dir + "/", "") for tf in target_files
+            ]
+            ap_metadata["IntendedFor"] = target_filenames
+            pa_metadata["IntendedFor"] = target_filenames
+
+            editor.replace(ap_fmap_json, ap_metadata)
+
+            editor.replace(pa_fmap_json, pa_metadata)
+
+            for target_json in target_jsons:
+                task = target_json.split("_task-")[1].split("_")[0]
+                run = target_json.split("_run-")[1].split("_")[0]
+                medic_name = f"medic{task}{run}"
+
+                target_metadata = editor.get(target_json)
+
+                # if "B0FieldSource" not in target_metadata.keys():
+                target_metadata["B0FieldSource"] = []
+                target_metadata["B0FieldSource"].append(b0fieldname)
+                target_metadata["B0FieldSource"].append(medic_name)
+                target_metadata["B0FieldIdentifier"] = [medic_name]
+
+                editor.replace(target_json, target_metadata)
+
+        # Add intendedfor-related fields to dwi field maps.
+        dwi_fmap_jsons = index.get(subject, session, "fmap", pattern="*acq-dwi_*part-mag*epi.json")
+        for dwi_fmap_json in dwi_fmap_jsons:
+            run = dwi_fmap_json.split("_run-")[1].split("_")[0]
+            json_metadata = editor.get(dwi_fmap_json)
+
+            target_files = index.get(subject, session, "dwi", pattern="*dwi.nii.gz")
+            target_jsons = [f.replace(".nii.gz", ".json") for f in target_files]
+            json_metadata["IntendedFor"] = [
+                tf.replace(os.path.join(dset_dir, subject) + "/", "") for tf in target_files
+            ]
+            b0fieldname = f"topupdwi{run}"
+            json_metadata["B0FieldIdentifier"] = [b0fieldname]
+
+            editor.replace(dwi_fmap_json, json_metadata)
+
+            for target_json in target_jsons:
+                target_metadata = editor.get(target_json)
+
+                target_metadata["B0FieldSource"] = [b0fieldname]
+                target_metadata["B0FieldIdentifier"] = [b0fieldname]
+
+                editor.replace(target_json, target_metadata)
+
+    changed = editor.write(n_threads=8)
+    print(f"{len(changed)} JSON files changed")
@@ -0,0 +1,606 @@
+"""Shared helpers for the curation scripts.
+
+The job runner (:func:`run_jobs`, :func:`print_job_summary`, and :func:`limit_blas_threads`)
+and :func:`atomic_output` are copied in processing/utils.py.
+The curation and processing scripts run from their own folders, in their own environments,
+so neither can import the other's helpers. Keep the copies identical
+(tests/test_utils.py checks that they are).
+"""
+
+import copy
+import fcntl
+import json
+import os
+import re
+import threading
+import traceback
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from fnmatch import translate
+from multiprocessing import get_context
+
+
+BLAS_THREAD_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+@contextmanager
+def atomic_output(out_file):
+    """Yield a temporary path to write an output to, then rename it to the output path.
+
+    The temporary file is in the same directory and has the same extension (e.g., ``.nii.gz``),
+    so writers that infer the format from the name work, and the rename is atomic.
+    If the block raises, the temporary file is removed and the output is left untouched,
+    so a killed or failed job never leaves a truncated file that looks complete.
+    """
+    out_dir, base_name = os.path.split(os.path.abspath(out_file))
+    stem, _, extension = base_name.partition(".")
+    # The writer creates the file, so it gets the usual permissions, unlike with mkstemp
+    temp_file = os.path.join(out_dir, f".{stem}.{uuid.uuid4().hex}.{extension}".rstrip("."))
+    try:
+        yield temp_file
+        os.replace(temp_file, out_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def parse_bids_filename(filename):
+    """Split a BIDS filename into its entities, suffix, and extension.
+
+    Parameters
+    ----------
+    filename : str
+        File name, without the directory (e.g., ``sub-01_ses-1_task-rest_echo-1_bold.nii.gz``).
+
+    Returns
+    -------
+    entities : dict
+        Mapping from entity key to label (e.g., {"sub": "01", "ses": "1", "task": "rest"}).
+    suffix : str
+        The last underscore-separated part without a hyphen (e.g., "bold"), or "".
+    extension : str
+        Everything from the first period (e.g., ".nii.gz").
+    """
+    stem, dot, extension = filename.partition(".")
+    parts = stem.split("_")
+    suffix = parts.pop() if "-" not in parts[-1] else ""
+    entities = dict(part.split("-", 1) for part in parts if "-" in part)
+    return entities, suffix, dot + extension
+
+
+def _scandir_dirs(path, prefix=""):
+    """List the subdirectories of a directory whose names start with a prefix, sorted."""
+    with os.scandir(path) as entries:
+        return sorted(
+            (e for e in entries if e.name.startswith(prefix) and e.is_dir()),
+            key=lambda e: e.name,
+        )
+
+
+class BIDSIndex:
+    """An in-memory index of the files in the datatype folders of a BIDS dataset.
+
+    The dataset is walked once, with ``os.scandir``, and each filename is parsed once,
+    so the many pattern and entity queries of a curation script never touch the filesystem.
+    Scripts that create, delete, or rename files should do so through :meth:`add`,
+    :meth:`remove`, and :meth:`rename`, so the index stays in sync.
+
+    Parameters
+    ----------
+    dset_dir : str
+        Path to the BIDS dataset, with ``sub-*/ses-*/<datatype>/`` folders.
+        Paths from the index start with it as given.
+    """
+
+    def __init__(self, dset_dir):
+        """Walk the dataset and parse every filename."""
+        self.dset_dir = dset_dir
+        # (subject, session, datatype) -> {filename: file record}
+        self._files = {}
+        for subject_entry in _scandir_dirs(dset_dir, "sub-"):
+            for session_entry in _scandir_dirs(subject_entry.path, "ses-"):
+                for datatype_entry in _scandir_dirs(session_entry.path):
+                    key = (subject_entry.name, session_entry.name, datatype_entry.name)
+                    folder = self._files.setdefault(key, {})
+                    with os.scandir(datatype_entry.path) as entries:
+                        for entry in entries:
+                            # Broken symlinks (e.g., annexed files that were dropped) are kept,
+                            # as glob would keep them
+                            if not entry.name.startswith(".") and not entry.is_dir():
+                                folder[entry.name] = self._parse(key, entry.name)
+
+    def _parse(self, key, filename):
+        """Build the index record of a file."""
+        entities, suffix, extension = parse_bids_filename(filename)
+        return {
+            "path": os.path.join(self.dset_dir, *key, filename),
+            "entities": entities,
+            "suffix": suffix,
+            "extension": extension,
+        }
+
+    def _split(self, path):
+        """Split a path in the dataset into its (subject, session, datatype) key and filename."""
+        parts = os.path.relpath(path, self.dset_dir).split(os.sep)
+        if len(parts) != 4:
+            raise ValueError(f"{path} is not in a datatype folder of {self.dset_dir}")
+
+        return tuple(parts[:3]), parts[3]
+
+    def sessions(self):
+        """List the sessions in the dataset.
+
+        Returns
+        -------
+        list of (str, str) tuples
+            Sorted subject and session folder names (e.g., ("sub-01", "ses-1")).
+        """
+        return sorted(set(key[:2] for key in self._files))
+
+    def get(
+        self,
+        subject=None,
+        session=None,
+        datatype=None,
+        pattern=None,
+        suffix=None,
+        extension=None,
+        **entities,
+    ):
+        """Find files by folder, filename pattern, and BIDS entities.
+
+        Parameters
+        ----------
+        subject, session, datatype : str or None
+            Folder names to restrict the search to (e.g., "sub-01", "ses-1", "func").
+        pattern : str or None
+            Shell-style pattern the filename must match, as with glob (e.g., "*echo-*_bold.nii.gz").
+        suffix, extension : str or None
+            Suffix (e.g., "bold") and extension (e.g., ".nii.gz") the file must have.
+        **entities
+            Entity labels the file must have, each a label or a list of labels
+            (e.g., ``part="phase"`` or ``echo=["1", "2"]``).
+
+        Returns
+        -------
+        list of str
+            Sorted paths of the matching files.
+        """
+        regex = re.compile(translate(pattern)) if pattern is not None else None
+        entities = {
+            key: values if isinstance(values, (list, tuple, set)) else [values]
+            for key, values in entities.items()
+        }
+        paths = []
+        for key, folder in self._files.items():
+            if any(v is not None and v != k for v, k in zip((subject, session, datatype), key)):
+                continue
+
+            for filename, record in folder.items():
+                if regex is not None and not regex.match(filename):
+                    continue
+
+                if suffix is not None and record["suffix"] != suffix:
+                    continue
+
+                if extension is not None and record["extension"] != extension:
+                    continue
+
+                if any(record["entities"].get(k) not in v for k, v in entities.items()):
+                    continue
+
+                paths.append(record["path"])
+
+        return sorted(paths)
+
+    def add(self, path):
+        """Add a file that was created in the dataset to the index."""
+        key, filename = self._split(path)
+        self._files.setdefault(key, {})[filename] = self._parse(key, filename)
+
+    def remove(self, path):
+        """Delete a file and remove it from the index."""
+        key, filename = self._split(path)
+        os.remove(path)
+        self._files[key].pop(filename, None)
+
+    def rename(self, src, dst):
+        """Rename a file and update the index."""
+        src_key, src_filename = self._split(src)
+        os.rename(src, dst)
+        self._files[src_key].pop(src_filename, None)
+        self.add(dst)
+
+
+class SidecarEditor:
+    """Stage changes to JSON sidecars in memory, then write each changed sidecar once.
+
+    Each sidecar is read the first time it is touched, and every change after that is applied to
+    the staged copy. :meth:`write` then rewrites only the sidecars whose content differs from
+    what was read, so unchanged files keep their modification times,
+    and incremental tools (e.g., DataLad) do not see spurious modifications.
+
+    Parameters
+    ----------
+    indent : int
+        Indentation of the written JSON files.
+    """
+
+    def __init__(self, indent=4):
+        """Initialize an editor with no staged changes."""
+        self.indent = indent
+        # path -> (metadata as read, or None for new files; staged metadata)
+        self._sidecars = {}
+
+    def _staged(self, json_file, create=False):
+        """Get the staged metadata of a sidecar, reading the sidecar the first time.
+
+        A sidecar that does not exist raises a FileNotFoundError, unless ``create`` is True.
+        """
+        if json_file not in self._sidecars:
+            original = None
+            if not create or os.path.isfile(json_file):
+                with open(json_file, "r") as fo:
+                    original = json.load(fo)
+
+            self._sidecars[json_file] = (original, copy.deepcopy(original or {}))
+
+        return self._sidecars[json_file][1]
+
+    def get(self, json_file):
+        """Get a copy of a sidecar's metadata, with the changes staged so far.
+
+        Returns
+        -------
+        dict
+
+        Raises
+        ------
+        FileNotFoundError
+            If the sidecar does not exist and has not been created with :meth:`replace`.
+        """
+        return copy.deepcopy(self._staged(json_file))
+
+    def replace(self, json_file, metadata):
+        """Stage the whole content of a sidecar, creating the sidecar if it does not exist yet."""
+        staged = self._staged(json_file, create=True)
+        staged.clear()
+        staged.update(copy.deepcopy(metadata))
+
+    def update(self, json_file, fields):
+        """Stage new values for some of an existing sidecar's fields."""
+        self._staged(json_file).update(copy.deepcopy(fields))
+
+    def drop(self, json_file, keys):
+        """Stage the removal of some fields from an existing sidecar, if they are present."""
+        staged = self._staged(json_file)
+        for key in keys:
+            staged.pop(key, None)
+
+    def write(self, n_threads=1):
+        """Write the sidecars whose staged content differs from what was read.
+
+        Parameters
+        ----------
+        n_threads : int
+            Number of sidecars to write at once.
+
+        Returns
+        -------
+        changed : list of str
+            Paths of the sidecars that were written.
+        """
+        changed = sorted(
+            json_file
+            for json_file, (original, staged) in self._sidecars.items()
+            # New sidecars are always written, even if they are empty
+            if original is None or staged != original
+        )
+
+        def _write(json_file):
+            with atomic_output(json_file) as temp_file:
+                with open(temp_file, "w") as fo:
+                    json.dump(self._sidecars[json_file][1], fo, indent=self.indent, sort_keys=True)
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            # list() re-raises the first error
+            list(pool.map(_write, changed))
+
+        for json_file in changed:
+            staged = self._sidecars[json_file][1]
+            self._sidecars[json_file] = (copy.deepcopy(staged), staged)
+
+        return changed
+
+
+class Journal:
+    """A status file of finished items, one per line, that several workers can share.
+
+    Appends and reads hold an exclusive or shared ``flock`` on the file,
+    so concurrent workers (threads, processes, or jobs on other nodes of a shared filesystem)
+    never interleave or read partial lines.
+    The format is the same as that of the plain status files the scripts used to write.
+
+    Parameters
+    ----------
+    status_file : str
+        Path to the status file. It is created if it does not exist.
+    """
+
+    def __init__(self, status_file):
+        """Initialize the journal."""
+        self.status_file = status_file
+        self._lock = threading.Lock()
+
+    def read(self):
+        """Read the finished items.
+
+        Returns
+        -------
+        set of str
+        """
+        if not os.path.exists(self.status_file):
+            return set()
+
+        with open(self.status_file, "r") as fo:
+            fcntl.flock(fo, fcntl.LOCK_SH)
+            try:
+                return set(fo.read().splitlines())
+            finally:
+                fcntl.flock(fo, fcntl.LOCK_UN)
+
+    def __contains__(self, item):
+        """Check whether an item is finished, according to the current state of the file."""
+        return item in self.read()
+
+    def record(self, item):
+        """Append a finished item and flush it to disk."""
+        with self._lock, open(self.status_file, "a") as fo:
+            fcntl.flock(fo, fcntl.LOCK_EX)
+            try:
+                fo.write(f"{item}\n")
+                fo.flush()
+                os.fsync(fo.fileno())
+            finally:
+                fcntl.flock(fo, fcntl.LOCK_UN)
+
+
+def _get_member_path(out_dir, member_name):
+    """Get the output path of an archive member, refusing paths that leave the output directory."""
+    out_dir = os.path.realpath(out_dir)
+    out_file = os.path.realpath(os.path.join(out_dir, member_name))
+    if os.path.commonpath([out_dir, out_file]) != out_dir:
+        raise ValueError(f"Archive member {member_name} would be extracted outside of {out_dir}")
+
+    return out_file
+
+
+def extract_zip(zip_file, out_dir, chunk_size=2**20):
+    """Extract a zip file, verifying the size and CRC of every member.
+
+    Each member is streamed to a temporary file in chunks and renamed once it is verified,
+    so an interrupted extraction never leaves a truncated file under a member's name,
+    and extracting again overwrites whatever a previous attempt left behind.
+
+    Parameters
+    ----------
+    zip_file : str
+        Path to the zip file.
+    out_dir : str
+        Directory to extract the members to.
+    chunk_size : int
+        Number of bytes to read and write at a time.
+
+    Returns
+    -------
+    n_members : int
+        Number of files extracted.
+
+    Raises
+    ------
+    zipfile.BadZipFile
+        If the archive is corrupt, or a member's size or CRC does not match the archive's record.
+    """
+    n_members = 0
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        for member in zip_ref.infolist():
+            out_file = _get_member_path(out_dir, member.filename)
+            if member.is_dir():
+                os.makedirs(out_file, exist_ok=True)
+                continue
+
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+            temp_file = os.path.join(
+                os.path.dirname(out_file),
+                f".{os.path.basename(out_file)}.{uuid.uuid4().hex}",
+            )
+            crc, size = 0, 0
+            try:
+                with zip_ref.open(member, "r") as fi, open(temp_file, "wb") as fo:
+                    for chunk in iter(lambda: fi.read(chunk_size), b""):
+                        crc = zlib.crc32(chunk, crc)
+                        size += len(chunk)
+                        fo.write(chunk)
+
+                if size != member.file_size or crc != member.CRC:
+                    raise zipfile.BadZipFile(
+                        f"{member.filename} in {zip_file} failed verification "
+                        f"(size {size} vs. {member.file_size}, CRC {crc:08x} vs. {member.CRC:08x})"
+                    )
+
+                os.replace(temp_file, out_file)
+            except BaseException:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                raise
+
+            n_members += 1
+
+    return n_members
+
+
+def _extract_group(name, zip_files, journal, remove):
+    """Extract a group of zip files in its own directory, then record the group as finished."""
+    if name in journal:
+        return "skipped"
+
+    for zip_file in zip_files:
+        extract_zip(zip_file, os.path.dirname(zip_file))
+        if remove:
+            # Only reached once every member has been verified
+            os.remove(zip_file)
+
+    journal.record(name)
+    return "done"
+
+
+def extract_zips(groups, status_file, n_threads=4, remove=False):
+    """Extract groups of zip files concurrently, recording each finished group in a journal.
+
+    Each zip file is extracted into its own directory.
+    A group is recorded only after all of its zip files have been extracted and verified,
+    so a group that was interrupted is extracted again on the next run.
+
+    Parameters
+    ----------
+    groups : dict
+        Mapping from a group name (e.g., a subject ID) to a list of zip files.
+    status_file : str
+        Path to the journal of finished groups. See :class:`Journal`.
+        Groups that are already in it are skipped.
+    n_threads : int
+        Number of groups to extract at once.
+        Decompression and file I/O release the GIL, so threads run in parallel.
+    remove : bool
+        Delete each zip file once its extraction has been verified.
+
+    Returns
+    -------
+    results : dict
+        Mapping from group name to a (status, message) tuple,
+        where status is "done", "skipped", or "failed", and message holds the traceback.
+    """
+    journal = Journal(status_file)
+    finished = journal.read()
+    results = {name: ("skipped", "") for name in groups if name in finished}
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        futures = {
+            pool.submit(_extract_group, name, zip_files, journal, remove): name
+            for name, zip_files in groups.items()
+            if name not in finished
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = (future.result(), "")
+            except Exception:
+                results[name] = ("failed", traceback.format_exc())
+
+            print(f"\t{results[name][0].upper()}: {name}")
+
+    return {name: results[name] for name in groups}
+
+
+@contextmanager
+def limit_blas_threads(n_threads):
+    """Temporarily cap BLAS/OpenMP threads for any child processes started in this context.
+
+    BLAS libraries read these variables once, when they are loaded,
+    so they must be in the environment before a worker process imports numpy.
+    """
+    old_values = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: str(n_threads) for var in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for var, value in old_values.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _run_job(func, kwargs, n_threads):
+    """Run one job, turning any exception into a "failed" status."""
+    try:
+        if n_threads is None:
+            status = func(**kwargs)
+        else:
+            from threadpoolctl import threadpool_limits
+
+            with threadpool_limits(limits=n_threads):
+                status = func(**kwargs)
+
+        return status or "done", ""
+    except Exception:
+        return "failed", traceback.format_exc()
+
+
+def run_jobs(func, jobs, n_procs=1, n_threads=1):
+    """Run ``func`` once per job, optionally across a process pool.
+
+    Parameters
+    ----------
+    func : callable
+        Module-level function to run. It may return a short status string (e.g., "skipped").
+    jobs : dict
+        Mapping from a job name (e.g., a run prefix) to the keyword arguments for ``func``.
+    n_procs : int
+        Number of worker processes. With 1, jobs run serially in this process.
+    n_threads : int
+        Number of BLAS/OpenMP threads allowed in each worker process.
+        Ignored when ``n_procs`` is 1.
+
+    Returns
+    -------
+    results : dict
+        Mapping from job name to a (status, message) tuple,
+        where message holds the traceback of failed jobs.
+    """
+    results = {}
+    if n_procs == 1:
+        for name, kwargs in jobs.items():
+            results[name] = _run_job(func, kwargs, None)
+            print(f"\t{results[name][0].upper()}: {name}")
+        return results
+
+    with limit_blas_threads(n_threads):
+        # spawn, rather than fork, so the thread limits are in place before workers load BLAS
+        with ProcessPoolExecutor(max_workers=n_procs, mp_context=get_context("spawn")) as pool:
+            futures = {
+                pool.submit(_run_job, func, kwargs, n_threads): name
+                for name, kwargs in jobs.items()
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    # e.g., a worker killed by the OOM killer
+                    results[name] = ("failed", traceback.format_exc())
+
+                print(f"\t{results[name][0].upper()}: {name}")
+
+    return {name: results[name] for name in jobs}
+
+
+def print_job_summary(results):
+    """Print a per-job summary of the output of :func:`run_jobs`."""
+    statuses = sorted(set(status for status, _ in results.values()))
+    counts = ", ".join(
+        f"{sum(s == status for s, _ in results.values())} {status}" for status in statuses
+    )
+    print(f"{len(results)} jobs: {counts}")
+    for name, (status, message) in results.items():
+        if status == "failed":
+            print(f"FAILED: {name}\n{message}")
@@ -1,14 +1,352 @@
-"""Calculate phase jolt and phase jump time series from phase data."""
+"""Calculate phase jolt, phase jump, and phase laplacian time series from phase data."""
 
 import os
-import shutil
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
 import nibabel as nb
+import nitransforms as nt
 import numpy as np
+import pandas as pd
 import templateflow.api as tfapi
-from fmriprep.interfaces.resampling import ResampleSeries
+from fmriprep.utils.transforms import load_transforms
+from scipy import ndimage as ndi
+from utils import atomic_output, is_up_to_date, run_commands
+
+
+LAYNII_DIR = "/cbica/projects/pafin/laynii"
+
+
+def average_echoes(in_files, out_file, by_volume=False, max_memory=2**26):
+    """Average echo-wise phase derivative time series.
+
+    Echoes are read and summed one at a time, so at most one echo's series is held in memory.
+
+    Parameters
+    ----------
+    in_files : list of str
+        Paths to the echo-wise 4D images.
+    out_file : str
+        Path to the output image, which uses the first input's affine and header.
+    by_volume : bool
+        If True, read blocks of volumes, rather than whole series, from each echo.
+        This is only efficient for uncompressed (memory-mapped) inputs.
+    max_memory : int
+        Approximate size, in bytes, of the sum over echoes for one block of volumes.
+        Only used if ``by_volume`` is True.
+    """
+    base_img = nb.load(in_files[0])
+    n_vols = base_img.shape[-1]
+    block_size = n_vols
+    if by_volume:
+        block_size = max(1, int(max_memory // (8 * np.prod(base_img.shape[:-1]))))
+
+    # The sum is accumulated in float64, in echo order, so the result matches np.mean
+    avg_arr = np.empty(base_img.shape, dtype=np.promote_types(base_img.get_data_dtype(), "f4"))
+    for start in range(0, n_vols, block_size):
+        stop = min(start + block_size, n_vols)
+        sum_arr = np.zeros(base_img.shape[:-1] + (stop - start,))
+        for in_file in in_files:
+            sum_arr += nb.load(in_file).dataobj[..., start:stop]
+
+        avg_arr[..., start:stop] = sum_arr / len(in_files)
+        del sum_arr
+
+    with atomic_output(out_file) as temp_file:
+        nb.Nifti1Image(avg_arr, base_img.affine, base_img.header).to_filename(temp_file)
+
+
+PHASE_DERIVATIVES = ("jump", "jolt", "laplacian")
+SUMMARY_PERCENTILES = (50, 5, 25, 75, 95)
+SUMMARY_STATISTICS = ("mean", "median", "p05", "p25", "p75", "p95")
+
+
+def summarize_volumes(data, mask):
+    """Summarize each volume of a series within a mask.
+
+    Parameters
+    ----------
+    data : (X, Y, Z, T, ...) numpy.ndarray
+        Series to summarize. Any trailing axes (e.g., echoes) are summarized separately.
+    mask : (X, Y, Z) numpy.ndarray of bool
+        Brain mask.
+
+    Returns
+    -------
+    summary : dict
+        Mapping from each of SUMMARY_STATISTICS to a (T, ...) array.
+    """
+    masked = data[mask]
+    summary = {"mean": masked.mean(axis=0, dtype=np.float64)}
+    percentiles = np.percentile(masked, SUMMARY_PERCENTILES, axis=0)
+    for statistic, values in zip(SUMMARY_STATISTICS[1:], percentiles):
+        summary[statistic] = values
+
+    return summary
+
+
+def laynii_commands(echo_file, out_prefix, log_prefix):
+    """Build the LayNII phase jolt and laplacian commands for one echo.
+
+    Returns
+    -------
+    commands : list of (list of str, str) tuples
+        Commands and their log files, for :func:`utils.run_commands`.
+    laynii_files : dict
+        Mapping from each of PHASE_DERIVATIVES to the uncompressed LayNII output.
+    """
+    commands = [
+        (
+            [
+                os.path.join(LAYNII_DIR, "LN2_PHASE_JOLT"),
+                "-input",
+                echo_file,
+                "-int13",
+                "-phase_jump",
+                "-2D",
+                "-output",
+                out_prefix,
+            ],
+            f"{log_prefix}_LN2_PHASE_JOLT.log",
+        ),
+        (
+            [
+                os.path.join(LAYNII_DIR, "LN2_PHASE_LAPLACIAN"),
+                "-input",
+                echo_file,
+                "-int13",
+                "-2D",
+                "-output",
+                out_prefix,
+            ],
+            f"{log_prefix}_LN2_PHASE_LAPLACIAN.log",
+        ),
+    ]
+    laynii_files = {name: f"{out_prefix}_phase_{name}.nii" for name in PHASE_DERIVATIVES}
+    return commands, laynii_files
+
+
+def run_laynii(echo_files, work_dir, n_jobs=1):
+    """Run LayNII's phase jolt and laplacian commands on each echo of a run.
+
+    Parameters
+    ----------
+    echo_files : list of str
+        Paths to the echo-wise 4D phase images, as Siemens 12-bit integers.
+    work_dir : str
+        Directory in which to write the LayNII outputs and logs.
+    n_jobs : int
+        Maximum number of LayNII commands to run at once.
+
+    Returns
+    -------
+    laynii_files : list of dict
+        For each echo, a mapping from each of PHASE_DERIVATIVES to the uncompressed LayNII output.
+    """
+    for program in ("LN2_PHASE_JOLT", "LN2_PHASE_LAPLACIAN"):
+        if not os.path.isfile(os.path.join(LAYNII_DIR, program)):
+            raise FileNotFoundError(os.path.join(LAYNII_DIR, program))
+
+    # The echo-wise commands have no outputs in common, so none of them have to wait on another
+    log_dir = os.path.join(work_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    commands, laynii_files = [], []
+    for echo_file in echo_files:
+        out_prefix = os.path.join(
+            work_dir,
+            os.path.basename(echo_file).replace("_part-phase_bold.nii.gz", ""),
+        )
+        echo_commands, echo_laynii_files = laynii_commands(
+            echo_file,
+            out_prefix,
+            os.path.join(log_dir, os.path.basename(out_prefix)),
+        )
+        commands += echo_commands
+        laynii_files.append(echo_laynii_files)
+
+    print(f"\t\tRunning {len(commands)} LayNII commands")
+    run_commands(commands, n_jobs=n_jobs)
+    for echo_laynii_files in laynii_files:
+        for laynii_file in echo_laynii_files.values():
+            if not os.path.isfile(laynii_file):
+                raise FileNotFoundError(laynii_file)
+
+    return laynii_files
+
+
+def write_laynii_outputs(laynii_files, out_files):
+    """Compress the LayNII outputs of each echo into place, and average them across echoes.
+
+    Parameters
+    ----------
+    laynii_files : list of dict
+        Output of :func:`run_laynii`.
+    out_files : dict
+        Mapping from any of PHASE_DERIVATIVES to a list of output paths:
+        one per echo, followed by the across-echo mean.
+    """
+    for name, files in out_files.items():
+        echo_laynii_files = [echo_laynii_files[name] for echo_laynii_files in laynii_files]
+        for laynii_file, out_file in zip(echo_laynii_files, files[:-1]):
+            with atomic_output(out_file) as temp_file:
+                nb.load(laynii_file).to_filename(temp_file)
+
+        # The uncompressed LayNII outputs can be read volume by volume
+        print(f"\t\tAveraging phase {name}s")
+        average_echoes(echo_laynii_files, files[-1], by_volume=True)
+
+
+def summarize_phase_derivatives(derivative_files, mask_file):
+    """Summarize echo-wise phase derivatives and their across-echo means within a brain mask.
+
+    Echoes are read one at a time and summed in float64, as in :func:`average_echoes`.
+
+    Parameters
+    ----------
+    derivative_files : dict
+        Mapping from each of PHASE_DERIVATIVES to a list of echo-wise 4D images
+        (e.g., from :func:`run_laynii`).
+    mask_file : str
+        Brain mask on the images' grid.
+
+    Returns
+    -------
+    summary_df : pandas.DataFrame
+        One row per volume, with each of SUMMARY_STATISTICS of each derivative,
+        for the across-echo mean (e.g., ``phase_jolt_median``)
+        and each echo (e.g., ``phase_jolt_echo1_median``).
+    """
+    mask = np.asanyarray(nb.load(mask_file).dataobj).astype(bool)
+    summary = {}
+    for name, files in derivative_files.items():
+        sum_derivative = None
+        echo_summaries = []
+        for in_file in files:
+            derivative = nb.load(in_file).get_fdata(dtype=np.float32)
+            if sum_derivative is None:
+                sum_derivative = np.zeros(derivative.shape)
+
+            sum_derivative += derivative
+            echo_summaries.append(summarize_volumes(derivative, mask))
+            del derivative
+
+        sum_derivative /= len(files)
+        mean_summary = summarize_volumes(sum_derivative.astype(np.float32), mask)
+        for statistic in SUMMARY_STATISTICS:
+            summary[f"phase_{name}_{statistic}"] = mean_summary[statistic]
+            for i_echo, echo_summary in enumerate(echo_summaries):
+                summary[f"phase_{name}_echo{i_echo + 1}_{statistic}"] = echo_summary[statistic]
+
+        del sum_derivative
+
+    return pd.DataFrame(summary)
+
+
+class SeriesResampler:
+    """Resample series from one BOLD run into a target space.
+
+    This does what fMRIPrep's ResampleSeries interface does, without fieldmaps or Jacobian
+    correction, but the transforms are only loaded, and the target grid only mapped through
+    the non-head-motion transforms, once.
+    The mapped coordinates are then reused for every series from the run,
+    and only target voxels within reach of the source grid are interpolated.
+
+    Parameters
+    ----------
+    source_file : str
+        Any series from the run. Only its affine is used.
+    ref_file : str
+        Image defining the target space.
+    transforms : list of str
+        Transform files, from the source to the target space (image mode).
+        The head-motion transform, if any, must be first.
+    n_threads : int
+        Number of threads with which to resample the volumes of each series.
+    """
+
+    def __init__(self, source_file, ref_file, transforms, n_threads=1):
+        """Load the transforms and map the target grid into the source's voxel space."""
+        self.target = nb.load(ref_file)
+        self.n_threads = n_threads
+        self.vox2ras = nb.load(source_file).affine
+        ras2vox = np.linalg.inv(self.vox2ras)
+
+        chain = load_transforms(transforms, [False])
+        if not isinstance(chain, nt.TransformChain):
+            chain = nt.TransformChain([chain])
+
+        hmc = []
+        transform_list = chain.transforms
+        if isinstance(chain[-1], nt.linear.LinearTransformsMapping):
+            transform_list, hmc = chain[:-1], chain[-1]
+
+        # Head motion is applied volume-wise, in voxel space, at resampling time
+        self.hmc_xfms = [ras2vox @ xfm.matrix @ self.vox2ras for xfm in hmc]
+
+        # Map the target grid's world coordinates to the source's voxel coordinates
+        coordinates = nt.base.SpatialReference.factory(self.target).ndcoords.astype("f4")
+        ref2vox = nt.TransformChain(transform_list + [nt.Affine(ras2vox)])
+        self.coordinates = ref2vox.map(coordinates).T.reshape((3, *self.target.shape[:3]))
+
+    def _resample_volume(self, data, hmc_xfm, output):
+        """Resample one volume into a preallocated output array.
+
+        Target voxels that map so far outside the source grid that no spline coefficient
+        reaches them (including ``map_coordinates``' 12-voxel constant padding) would be
+        exactly zero, so they are skipped.
+        """
+        coordinates = self.coordinates.reshape(3, -1)
+        if hmc_xfm is not None:
+            coordinates = nb.affines.apply_affine(hmc_xfm, coordinates.T).T
+
+        margin = 16
+        upper = np.array(data.shape)[:, np.newaxis] + margin
+        inside = np.all((coordinates > -margin) & (coordinates < upper), axis=0)
+        output_flat = np.zeros(inside.shape, dtype="f4")
+        output_flat[inside] = ndi.map_coordinates(
+            data,
+            coordinates[:, inside],
+            output="f4",
+            order=3,
+            mode="grid-constant",
+            cval=0.0,
+            prefilter=True,
+        )
+        output[...] = output_flat.reshape(output.shape)
+
+    def resample(self, in_file, out_file):
+        """Resample one series into the target space and write it to a file."""
+        source = nb.load(in_file)
+        if not np.allclose(source.affine, self.vox2ras):
+            raise ValueError(f"{in_file} is not on the same grid as the run's other series")
+
+        n_vols = source.shape[3]
+        if self.hmc_xfms and len(self.hmc_xfms) != n_vols:
+            raise ValueError(f"{in_file} has {n_vols} volumes, but {len(self.hmc_xfms)} HMC xfms")
+
+        data = source.get_fdata(dtype="f4")
+        # Order F keeps each volume contiguous, as in fMRIPrep
+        resampled_data = np.zeros(self.target.shape[:3] + (n_vols,), dtype="f4", order="F")
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            futures = [
+                pool.submit(
+                    self._resample_volume,
+                    data[..., i_vol],
+                    self.hmc_xfms[i_vol] if self.hmc_xfms else None,
+                    resampled_data[..., i_vol],
+                )
+                for i_vol in range(n_vols)
+            ]
+            for future in futures:
+                future.result()
+
+        resampled_img = nb.Nifti1Image(resampled_data, self.target.affine, self.target.header)
+        resampled_img.set_data_dtype("f4")
+        resampled_img.header.set_zooms(
+            self.target.header.get_zooms()[:3] + source.header.get_zooms()[3:]
+        )
+        with atomic_output(out_file) as temp_file:
+            resampled_img.to_filename(temp_file)
 
 
 if __name__ == "__main__":
@@ -16,6 +354,17 @@ if __name__ == "__main__":
     temp_dir = "/cbica/comp_space/pafin/phase_jolt"
     out_dir = "/cbica/projects/pafin/derivatives/phase_jolt"
     fmriprep_dir = "/cbica/projects/pafin/derivatives/fmriprep"
+    # Number of LayNII commands to run at once, and of threads for resampling
+    n_jobs = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+    # Write brain-mask summary time series of the derivatives
+    write_timeseries = True
+    # Write the full native- and MNI-space derivative series.
+    # If False, only the summary time series are written.
+    write_volumes = True
+    # Only process these subjects (e.g., ["sub-01"]) and runs whose file names contain
+    # any of these strings (e.g., ["task-rest_acq-MBME_run-1"]). None processes everything.
+    subjects = None
+    runs = None
 
     ref_file = tfapi.get(
         "MNI152NLin2009cAsym",
@@ -29,6 +378,9 @@ if __name__ == "__main__":
 
     for subject_dir in glob(os.path.join(in_dir, "sub-*")):
         subid = os.path.basename(subject_dir)
+        if subjects is not None and subid not in subjects:
+            continue
+
         print(subid)
 
         for session_dir in glob(os.path.join(subject_dir, "ses-*")):
@@ -42,126 +394,29 @@ if __name__ == "__main__":
                 glob(os.path.join(session_dir, "func", "*echo-1*part-phase_bold.nii.gz"))
             )
             for phase_file in phase_files:
-                print(f"\t\t{os.path.basename(phase_file)}")
-                echo_files = sorted(glob(phase_file.replace("echo-1", "echo-*")))
-                phase_jump_files = []
-                phase_jolt_files = []
-                phase_laplacian_files = []
-
-                # Check if the last file that will be created already exists
-                # This is the MNI-resampled mean (across echoes)phase laplacian file
-                temp_base_name = os.path.basename(phase_file)
-                temp_base_name = temp_base_name.replace("echo-1_", "")
-                temp_base_name = temp_base_name.replace("_bold", "_desc-laplacian_bold")
-                temp_base_name = temp_base_name.replace(
-                    "desc-",
-                    "space-MNI152NLin2009cAsym_desc-",
-                )
-                last_file = os.path.join(out_sub_dir, temp_base_name)
-                if os.path.isfile(last_file):
-                    print(f"\t\t\t{os.path.basename(last_file)} already exists")
+                base_name = os.path.basename(phase_file)
+                if runs is not None and not any(run in base_name for run in runs):
                     continue
 
-                for echo_file in echo_files:
-                    base_name = os.path.basename(echo_file)
-                    out_prefix = os.path.join(
-                        temp_dir,
-                        base_name.replace("_part-phase_bold.nii.gz", ""),
-                    )
-
-                    cmd = (
-                        "/cbica/projects/pafin/laynii/LN2_PHASE_JOLT "
-                        f"-input {echo_file} -int13 -phase_jump -2D -output {out_prefix}"
-                    )
-                    print(cmd)
-                    subprocess.run(
-                        cmd.split(),
-                    )
-                    phase_jump_file = out_prefix + "_phase_jump.nii"
-                    phase_jolt_file = out_prefix + "_phase_jolt.nii"
-                    assert os.path.isfile(phase_jump_file)
-                    assert os.path.isfile(phase_jolt_file)
-
-                    cmd = (
-                        "/cbica/projects/pafin/laynii/LN2_PHASE_LAPLACIAN "
-                        f"-input {echo_file} -int13 -2D -output {out_prefix}"
-                    )
-                    print(cmd)
-                    subprocess.run(
-                        cmd.split(),
-                    )
-                    phase_laplacian_file = out_prefix + "_phase_laplacian.nii"
-                    assert os.path.isfile(phase_laplacian_file)
-
-                    out_phase_jump_file = os.path.join(
-                        out_sub_dir,
-                        base_name.replace("_bold.nii.gz", "_desc-jump_bold.nii.gz"),
-                    )
-                    out_phase_jolt_file = os.path.join(
-                        out_sub_dir,
-                        base_name.replace("_bold.nii.gz", "_desc-jolt_bold.nii.gz"),
-                    )
-                    out_phase_laplacian_file = os.path.join(
-                        out_sub_dir,
-                        base_name.replace("_bold.nii.gz", "_desc-laplacian_bold.nii.gz"),
-                    )
-
-                    nb.load(phase_jump_file).to_filename(out_phase_jump_file)
-                    nb.load(phase_jolt_file).to_filename(out_phase_jolt_file)
-                    nb.load(phase_laplacian_file).to_filename(out_phase_laplacian_file)
-                    phase_jump_files.append(out_phase_jump_file)
-                    phase_jolt_files.append(out_phase_jolt_file)
-                    phase_laplacian_files.append(out_phase_laplacian_file)
-                    del phase_jump_file, phase_jolt_file, phase_laplacian_file
-                    del out_phase_jump_file, out_phase_jolt_file, out_phase_laplacian_file
-
-                print("\t\tAveraging phase jumps")
-                base_name = os.path.basename(phase_file)
-                avg_phase_jump_file = os.path.join(
-                    out_sub_dir,
-                    base_name.replace("echo-1_", "").replace("_bold", "_desc-jump_bold"),
-                )
-                arrs = [nb.load(f).get_fdata() for f in phase_jump_files]
-                avg_phase_jump = np.mean(arrs, axis=0)
-                base_img = nb.load(phase_jump_files[0])
-                nb.Nifti1Image(avg_phase_jump, base_img.affine, base_img.header).to_filename(
-                    avg_phase_jump_file
-                )
-                del arrs, avg_phase_jump
-                phase_jump_files.append(avg_phase_jump_file)
+                print(f"\t\t{base_name}")
+                fmriprep_sub_dir = os.path.join(fmriprep_dir, subid, sesid)
+                new_base_name = base_name.split("_echo-")[0]
+                echo_files = sorted(glob(phase_file.replace("echo-1", "echo-*")))
 
-                print("\t\tAveraging phase jolts")
-                avg_phase_jolt_file = os.path.join(
-                    out_sub_dir,
-                    base_name.replace("echo-1_", "").replace("_bold", "_desc-jolt_bold"),
-                )
-                arrs = [nb.load(f).get_fdata() for f in phase_jolt_files]
-                avg_phase_jolt = np.mean(arrs, axis=0)
-                base_img = nb.load(phase_jolt_files[0])
-                nb.Nifti1Image(avg_phase_jolt, base_img.affine, base_img.header).to_filename(
-                    avg_phase_jolt_file
+                # Get the fMRIPrep brain mask, which is on the same grid as the raw data
+                mask_file = os.path.join(
+                    fmriprep_sub_dir,
+                    "func",
+                    f"{new_base_name}_part-mag_desc-brain_mask.nii.gz",
                 )
-                del arrs, avg_phase_jolt
-                phase_jolt_files.append(avg_phase_jolt_file)
-
-                print("\t\tAveraging phase laplacians")
-                avg_phase_laplacian_file = os.path.join(
+                timeseries_file = os.path.join(
                     out_sub_dir,
-                    base_name.replace("echo-1_", "").replace("_bold", "_desc-laplacian_bold"),
+                    base_name.replace("echo-1_", "").replace(
+                        "_bold.nii.gz", "_desc-confounds_timeseries.tsv"
+                    ),
                 )
-                arrs = [nb.load(f).get_fdata() for f in phase_laplacian_files]
-                avg_phase_laplacian = np.mean(arrs, axis=0)
-                base_img = nb.load(phase_laplacian_files[0])
-                nb.Nifti1Image(avg_phase_laplacian, base_img.affine, base_img.header).to_filename(
-                    avg_phase_laplacian_file
-                )
-                del arrs, avg_phase_laplacian
-                phase_laplacian_files.append(avg_phase_laplacian_file)
 
-                # Now apply HMC+coreg+norm transforms to the phase jolt and jump files
                 # Get the HMC+coreg+norm transforms
-                fmriprep_sub_dir = os.path.join(fmriprep_dir, subid, sesid)
-                new_base_name = base_name.split("_echo-")[0]
                 hmc_file = os.path.join(
                     fmriprep_sub_dir,
                     "func",
@@ -177,52 +432,88 @@ if __name__ == "__main__":
                     "anat",
                     f"{subid}_{sesid}_rec-norm_from-T1w_to-MNI152NLin2009cAsym_mode-image_xfm.h5",
                 )
+                transforms = [hmc_file, coreg_file, norm_file]
 
-                # Apply the transforms to the phase jolt and jump files
-                for phase_jump_file in phase_jump_files:
-                    print(f"\t\tWarping {os.path.basename(phase_jump_file)}")
-                    out_fname = os.path.basename(phase_jump_file).replace(
-                        "desc-",
-                        "space-MNI152NLin2009cAsym_desc-",
-                    )
-                    out_phase_jump_file = os.path.join(out_sub_dir, out_fname)
-                    resampler = ResampleSeries(
-                        jacobian=False,
-                        in_file=phase_jump_file,
-                        ref_file=ref_file,
-                        transforms=[hmc_file, coreg_file, norm_file],
-                    )
-                    result = resampler.run(cwd=temp_dir)
-                    shutil.copyfile(result.outputs.out_file, out_phase_jump_file)
+                in_files = echo_files + (transforms if write_volumes else [])
+                in_files += [mask_file] if write_timeseries else []
+                for in_file in in_files:
+                    if not os.path.isfile(in_file):
+                        raise FileNotFoundError(in_file)
 
-                for phase_jolt_file in phase_jolt_files:
-                    print(f"\t\tWarping {os.path.basename(phase_jolt_file)}")
-                    out_fname = os.path.basename(phase_jolt_file).replace(
-                        "desc-",
-                        "space-MNI152NLin2009cAsym_desc-",
+                out_files = {}
+                for name in PHASE_DERIVATIVES:
+                    out_files[name] = [
+                        os.path.join(
+                            out_sub_dir,
+                            os.path.basename(echo_file).replace(
+                                "_bold.nii.gz", f"_desc-{name}_bold.nii.gz"
+                            ),
+                        )
+                        for echo_file in echo_files
+                    ]
+                    out_files[name].append(
+                        os.path.join(
+                            out_sub_dir,
+                            base_name.replace("echo-1_", "").replace("_bold", f"_desc-{name}_bold"),
+                        )
                     )
-                    out_phase_jolt_file = os.path.join(out_sub_dir, out_fname)
-                    resampler = ResampleSeries(
-                        jacobian=False,
-                        in_file=phase_jolt_file,
-                        ref_file=ref_file,
-                        transforms=[hmc_file, coreg_file, norm_file],
-                    )
-                    result = resampler.run(cwd=temp_dir)
-                    shutil.copyfile(result.outputs.out_file, out_phase_jolt_file)
 
-                for phase_laplacian_file in phase_laplacian_files:
-                    print(f"\t\tWarping {os.path.basename(phase_laplacian_file)}")
-                    out_fname = os.path.basename(phase_laplacian_file).replace(
+                # Resume at the first missing or stale output.
+                # Outputs are written atomically, so any output that exists is complete.
+                stale_files = {}
+                if write_volumes:
+                    stale_files = {
+                        name: files
+                        for name, files in out_files.items()
+                        if not all(is_up_to_date(f, echo_files) for f in files)
+                    }
+
+                write_summary = write_timeseries and not is_up_to_date(
+                    timeseries_file, echo_files + [mask_file]
+                )
+                if stale_files or write_summary:
+                    laynii_files = run_laynii(echo_files, temp_dir, n_jobs=n_jobs)
+                    write_laynii_outputs(laynii_files, stale_files)
+                    if write_summary:
+                        summary_df = summarize_phase_derivatives(
+                            {
+                                name: [files[name] for files in laynii_files]
+                                for name in PHASE_DERIVATIVES
+                            },
+                            mask_file,
+                        )
+
+                if write_summary:
+                    with atomic_output(timeseries_file) as temp_file:
+                        summary_df.to_csv(temp_file, sep="\t", index=False, na_rep="n/a")
+
+                if not write_volumes:
+                    continue
+
+                # Now apply HMC+coreg+norm transforms to the phase jolt, jump, and laplacian files
+                warp_files = {}
+                for in_file in [f for name in PHASE_DERIVATIVES for f in out_files[name]]:
+                    out_fname = os.path.basename(in_file).replace(
                         "desc-",
                         "space-MNI152NLin2009cAsym_desc-",
                     )
-                    out_phase_laplacian_file = os.path.join(out_sub_dir, out_fname)
-                    resampler = ResampleSeries(
-                        jacobian=False,
-                        in_file=phase_laplacian_file,
-                        ref_file=ref_file,
-                        transforms=[hmc_file, coreg_file, norm_file],
-                    )
-                    result = resampler.run(cwd=temp_dir)
-                    shutil.copyfile(result.outputs.out_file, out_phase_laplacian_file)
+                    out_file = os.path.join(out_sub_dir, out_fname)
+                    if not is_up_to_date(out_file, [in_file] + transforms):
+                        warp_files[in_file] = out_file
+
+                if not warp_files:
+                    print("\t\t\tAll outputs are up to date")
+                    continue
+
+                # The transforms are composed once and the mapped coordinates reused.
+                resampler = SeriesResampler(
+                    source_file=echo_files[0],
+                    ref_file=ref_file,
+                    transforms=transforms,
+                    n_threads=n_jobs,
+                )
+                for in_file, out_file in warp_files.items():
+                    print(f"\t\tWarping {os.path.basename(in_file)}")
+                    resampler.resample(in_file, out_file)
+
+                del resampler
@@ -0,0 +1,455 @@
+"""Calculate physiological nuisance regressors for the BOLD runs from the physio peaks.
+
+The regressors are computed from the peaks and troughs saved by run_peakdet.py,
+so the raw signals are not read again. They are:
+
+-   RETROICOR (Glover et al., 2000) Fourier terms of the cardiac and respiratory phases.
+    The cardiac phase increases linearly from 0 to 2 pi between consecutive peaks.
+    The respiratory phase is 0 at each trough and pi at each peak, increasing linearly between them,
+    which approximates Glover's histogram-equalized phase without the raw signal.
+-   Heart rate variability (HRV; Chang et al., 2009), the heart rate in a 6-second window,
+    and its convolution with the cardiac response function.
+-   Respiration volume per time (RVT; Birn et al., 2006), the breath amplitude divided by the
+    breath period, and its convolution with the respiratory response function (Birn et al., 2008).
+
+The physio StartTime (relative to the first volume) and SamplingFrequency place the peaks in time,
+and the terms are sampled at all volumes at once.
+Each run gets a TSV file with one row per volume, named like the fMRIPrep confounds,
+so the two can be joined column-wise.
+"""
+
+import json
+import os
+from glob import glob
+
+import nibabel as nb
+import numpy as np
+import pandas as pd
+from physio_peaks import get_peaks_file, load_peaks
+from utils import atomic_output, is_up_to_date, print_job_summary, run_jobs
+
+
+RECORDINGS = ("cardiac", "respiratory")
+CARDIAC_ORDER = 3
+RESPIRATORY_ORDER = 4
+HRV_WINDOW = 6  # seconds
+KERNEL_LENGTH = 40  # seconds
+
+
+def get_acquisition_times(n_volumes, repetition_time, slice_offsets):
+    """Get the acquisition times of the slices of every volume.
+
+    Parameters
+    ----------
+    n_volumes : int
+        Number of volumes in the run.
+    repetition_time : float
+        Repetition time, in seconds.
+    slice_offsets : array_like of float
+        Acquisition time of each slice (e.g., the SliceTiming field),
+        or of a single reference slice, relative to the start of the volume, in seconds.
+
+    Returns
+    -------
+    times : numpy.ndarray of shape (n_volumes, n_slices)
+        Acquisition times relative to the start of the first volume, in seconds.
+    """
+    onsets = np.arange(n_volumes) * repetition_time
+    return onsets[:, np.newaxis] + np.atleast_1d(slice_offsets)[np.newaxis, :]
+
+
+def get_reference_offset(metadata, slice_time_ref=0.5):
+    """Get the acquisition time that slice-timing corrected data are aligned to.
+
+    Parameters
+    ----------
+    metadata : dict
+        BOLD sidecar, with RepetitionTime and, optionally, SliceTiming.
+    slice_time_ref : float
+        Fraction of the span of the slice times to align to,
+        as in fMRIPrep's ``--slice-time-ref``.
+        Without SliceTiming, it is a fraction of the repetition time.
+
+    Returns
+    -------
+    float
+        Reference time relative to the start of the volume, in seconds.
+    """
+    slice_timing = metadata.get("SliceTiming")
+    if not slice_timing:
+        return slice_time_ref * metadata["RepetitionTime"]
+
+    slice_timing = np.asarray(slice_timing)
+    return slice_timing.min() + slice_time_ref * (slice_timing.max() - slice_timing.min())
+
+
+def _interpolate_phase(knot_times, knot_phases, times):
+    """Interpolate an unwrapped phase linearly and wrap it, with NaNs outside of the knots."""
+    phase = np.interp(times, knot_times, knot_phases) % (2 * np.pi)
+    phase[(times < knot_times[0]) | (times > knot_times[-1])] = np.nan
+    return phase
+
+
+def cardiac_phase(peak_times, times):
+    """Calculate the cardiac phase, which increases linearly from 0 to 2 pi between heartbeats.
+
+    Parameters
+    ----------
+    peak_times : numpy.ndarray of shape (n_peaks,)
+        Sorted times of the cardiac peaks.
+    times : numpy.ndarray
+        Times at which to calculate the phase.
+
+    Returns
+    -------
+    phase : numpy.ndarray
+        Phase at each time, with NaNs outside of the first and last peaks.
+    """
+    return _interpolate_phase(peak_times, 2 * np.pi * np.arange(peak_times.size), times)
+
+
+def respiratory_phase(peak_times, trough_times, times):
+    """Calculate the respiratory phase, which is 0 at end-expiration and pi at end-inspiration.
+
+    Parameters
+    ----------
+    peak_times, trough_times : numpy.ndarray
+        Sorted times of the respiratory peaks and troughs, which must alternate.
+    times : numpy.ndarray
+        Times at which to calculate the phase.
+
+    Returns
+    -------
+    phase : numpy.ndarray
+        Phase at each time, with NaNs outside of the first and last peaks or troughs.
+    """
+    knot_times = np.concatenate((peak_times, trough_times))
+    is_peak = np.concatenate((np.ones(peak_times.size, bool), np.zeros(trough_times.size, bool)))
+    order = np.argsort(knot_times, kind="stable")
+    knot_times, is_peak = knot_times[order], is_peak[order]
+    if np.any(is_peak[1:] == is_peak[:-1]):
+        raise ValueError("Respiratory peaks and troughs must alternate.")
+
+    knot_phases = np.pi * (np.arange(knot_times.size) + is_peak[0])
+    return _interpolate_phase(knot_times, knot_phases, times)
+
+
+def retroicor_terms(phase, order, name):
+    """Calculate RETROICOR Fourier terms of a phase.
+
+    Parameters
+    ----------
+    phase : numpy.ndarray
+        Cardiac or respiratory phase.
+    order : int
+        Number of harmonics.
+    name : str
+        Prefix of the term names.
+
+    Returns
+    -------
+    terms : dict
+        Mapping from term name (e.g., "cardiac_cos_1") to an array with the shape of ``phase``.
+    """
+    harmonics = np.arange(1, order + 1).reshape((order,) + (1,) * phase.ndim)
+    cos_terms, sin_terms = np.cos(harmonics * phase), np.sin(harmonics * phase)
+    terms = {}
+    for i_order in range(order):
+        terms[f"{name}_cos_{i_order + 1}"] = cos_terms[i_order]
+        terms[f"{name}_sin_{i_order + 1}"] = sin_terms[i_order]
+
+    return terms
+
+
+def heart_rate_variability(peak_times, times, window=HRV_WINDOW):
+    """Calculate the heart rate from the mean inter-beat interval in a window around each time.
+
+    Parameters
+    ----------
+    peak_times : numpy.ndarray of shape (n_peaks,)
+        Sorted times of the cardiac peaks.
+    times : numpy.ndarray
+        Times at which to calculate the heart rate.
+    window : float
+        Width of the window centered on each time, in seconds.
+
+    Returns
+    -------
+    hrv : numpy.ndarray
+        Heart rate in beats per minute, with NaNs where the window has fewer than two beats.
+    """
+    first = np.searchsorted(peak_times, times - window / 2, side="left")
+    last = np.searchsorted(peak_times, times + window / 2, side="right") - 1
+    n_intervals = last - first
+    valid = n_intervals > 0
+    # The inter-beat intervals in the window sum to the time from the first beat to the last
+    duration = np.full(times.shape, np.nan)
+    duration[valid] = peak_times[last[valid]] - peak_times[first[valid]]
+    return 60 * n_intervals / duration
+
+
+def respiration_volume_per_time(peak_times, trough_times, peak_values, trough_values, times):
+    """Calculate the breath amplitude divided by the breath period at each time.
+
+    The amplitude is the difference between the upper and lower envelopes of the signal,
+    interpolated from the peaks and troughs, and the period is interpolated from the
+    intervals between peaks.
+
+    Parameters
+    ----------
+    peak_times, trough_times : numpy.ndarray
+        Sorted times of the respiratory peaks and troughs.
+    peak_values, trough_values : numpy.ndarray
+        Values of the respiratory signal at the peaks and troughs.
+    times : numpy.ndarray
+        Times at which to calculate the RVT.
+
+    Returns
+    -------
+    rvt : numpy.ndarray
+        RVT in signal units per second, with NaNs outside of the peaks and troughs.
+    """
+    upper = np.interp(times, peak_times, peak_values)
+    lower = np.interp(times, trough_times, trough_values)
+    period = np.interp(times, (peak_times[1:] + peak_times[:-1]) / 2, np.diff(peak_times))
+    rvt = (upper - lower) / period
+    start = max(peak_times[0], trough_times[0])
+    end = min(peak_times[-1], trough_times[-1])
+    rvt[(times < start) | (times > end)] = np.nan
+    return rvt
+
+
+def cardiac_response_function(t):
+    """Calculate the cardiac response function of Chang et al. (2009)."""
+    return 0.6 * t**2.7 * np.exp(-t / 1.6) - 16 / np.sqrt(2 * np.pi * 9) * np.exp(
+        -0.5 * (t - 12) ** 2 / 9
+    )
+
+
+def respiratory_response_function(t):
+    """Calculate the respiratory response function of Birn et al. (2008)."""
+    return 0.6 * t**2.1 * np.exp(-t / 1.6) - 0.0023 * t**3.54 * np.exp(-t / 4.25)
+
+
+def convolve_response(signal, repetition_time, response_function):
+    """Convolve a mean-centered regressor with a response function sampled at the TR.
+
+    NaNs are replaced with the mean before convolution, so they do not spread.
+    """
+    signal = np.nan_to_num(signal - np.nanmean(signal))
+    kernel = response_function(np.arange(0, KERNEL_LENGTH, repetition_time))
+    return np.convolve(signal, kernel)[: signal.size]
+
+
+def calculate_regressors(times, cardiac=None, respiratory=None):
+    """Calculate the physio regressors at the given times.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Times at which to sample the regressors, relative to the first volume, in seconds,
+        e.g., from :func:`get_acquisition_times`.
+    cardiac, respiratory : dict or None
+        Output of :func:`physio_peaks.load_peaks`, with an added "start_time" key
+        holding the physio StartTime. If None, those regressors are not calculated.
+
+    Returns
+    -------
+    regressors : dict
+        Mapping from regressor name to an array with the shape of ``times``.
+    """
+    regressors = {}
+    if cardiac is not None:
+        fs, start_time = cardiac["sampling_frequency"], cardiac["start_time"]
+        peak_times = start_time + cardiac["peaks"] / fs
+        phase = cardiac_phase(peak_times, times)
+        regressors.update(retroicor_terms(phase, CARDIAC_ORDER, "cardiac"))
+        regressors["hrv"] = heart_rate_variability(peak_times, times)
+
+    if respiratory is not None:
+        fs, start_time = respiratory["sampling_frequency"], respiratory["start_time"]
+        peak_times = start_time + respiratory["peaks"] / fs
+        trough_times = start_time + respiratory["troughs"] / fs
+        phase = respiratory_phase(peak_times, trough_times, times)
+        regressors.update(retroicor_terms(phase, RESPIRATORY_ORDER, "respiratory"))
+        regressors["rvt"] = respiration_volume_per_time(
+            peak_times,
+            trough_times,
+            respiratory["peak_values"],
+            respiratory["trough_values"],
+            times,
+        )
+
+    return regressors
+
+
+def _parse_entities(name):
+    """Get the BIDS entities of a file name, keeping the first value of any repeated entity."""
+    entities = {}
+    for part in name.split("_"):
+        if "-" in part:
+            entity, value = part.split("-", 1)
+            entities.setdefault(entity, value)
+
+    return entities
+
+
+def find_physio_files(bold_file):
+    """Find the physio recordings of a BOLD run by their BIDS entities.
+
+    curation/04_convert_physio.py names the recordings after the physio DICOMs,
+    then bidsphysio appends ``_recording-<label>_physio``,
+    so a recording can have more entities than its BOLD run (e.g., an acq entity).
+    The conversion also appends a run entity that numbers the PhysioLog folders of each run type,
+    after the run entity of the DICOM, if it has one.
+    A recording belongs to a run if it has all of the run's entities with the same values,
+    using the first run entity of the recording and comparing run numbers as integers.
+
+    Parameters
+    ----------
+    bold_file : str
+        Path to the BOLD file.
+
+    Returns
+    -------
+    physio_files : dict
+        Mapping from recording label (in :data:`RECORDINGS`) to the path of the
+        ``_physio.tsv.gz`` file. Labels with no recording, or with several, are left out.
+    """
+    bold_entities = _parse_entities(os.path.basename(bold_file).split("_echo-")[0])
+    candidates = {}
+    func_dir = os.path.dirname(bold_file)
+    for physio_file in sorted(glob(os.path.join(func_dir, "*_recording-*_physio.tsv.gz"))):
+        physio_entities = _parse_entities(
+            os.path.basename(physio_file).replace("_physio.tsv.gz", "")
+        )
+        label = physio_entities.pop("recording")
+        if label not in RECORDINGS:
+            continue
+
+        matches = all(
+            entity in physio_entities
+            and (
+                int(physio_entities[entity]) == int(value)
+                if entity == "run"
+                else physio_entities[entity] == value
+            )
+            for entity, value in bold_entities.items()
+        )
+        if matches:
+            candidates.setdefault(label, []).append(physio_file)
+
+    physio_files = {}
+    for label, files in candidates.items():
+        if len(files) > 1:
+            print(f"Skipping {label}: {len(files)} recordings match {os.path.basename(bold_file)}")
+            continue
+
+        physio_files[label] = files[0]
+
+    return physio_files
+
+
+def write_physio_regressors(bold_file, recordings, out_file, slice_time_ref=0.5):
+    """Write the physio regressors of a BOLD run, sampled at its slice-timing reference.
+
+    Parameters
+    ----------
+    bold_file : str
+        Path to the BOLD file, with a JSON sidecar.
+    recordings : dict
+        Mapping from recording label ("cardiac" or "respiratory") to a dict with the
+        "peaks_file" from run_peakdet.py and the "json_file" of the physio recording.
+    out_file : str
+        Path to the TSV file to write.
+    slice_time_ref : float
+        See :func:`get_reference_offset`.
+    """
+    with open(bold_file.replace(".nii.gz", ".json"), "r") as fo:
+        bold_metadata = json.load(fo)
+
+    repetition_time = bold_metadata["RepetitionTime"]
+    n_volumes = nb.load(bold_file).shape[-1]
+    offset = get_reference_offset(bold_metadata, slice_time_ref)
+    times = get_acquisition_times(n_volumes, repetition_time, offset)[:, 0]
+
+    peaks = {}
+    for label, files in recordings.items():
+        with open(files["json_file"], "r") as fo:
+            physio_metadata = json.load(fo)
+
+        peaks[label] = load_peaks(files["peaks_file"])
+        peaks[label]["start_time"] = physio_metadata.get("StartTime", 0)
+        if peaks[label]["sampling_frequency"] != physio_metadata["SamplingFrequency"]:
+            raise ValueError(f"Sampling frequencies of {files['peaks_file']} do not match.")
+
+    regressors = calculate_regressors(
+        times,
+        cardiac=peaks.get("cardiac"),
+        respiratory=peaks.get("respiratory"),
+    )
+    if "hrv" in regressors:
+        regressors["hrv_crf"] = convolve_response(
+            regressors["hrv"], repetition_time, cardiac_response_function
+        )
+
+    if "rvt" in regressors:
+        regressors["rvt_rrf"] = convolve_response(
+            regressors["rvt"], repetition_time, respiratory_response_function
+        )
+
+    regressors_df = pd.DataFrame(regressors)
+    n_missing = int(regressors_df.isna().any(axis=1).sum())
+    if n_missing:
+        print(f"{n_missing} volumes of {os.path.basename(out_file)} are not covered by the physio")
+
+    with atomic_output(out_file) as temp_file:
+        regressors_df.to_csv(temp_file, sep="\t", index=False, na_rep="n/a")
+
+
+if __name__ == "__main__":
+    in_dir = "/cbica/projects/pafin/dset"
+    peaks_dir = "/cbica/projects/pafin/derivatives/physiopy"
+    n_procs = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+    overwrite = False
+
+    bold_files = sorted(
+        glob(
+            os.path.join(
+                in_dir,
+                "sub-*",
+                "ses-1",
+                "func",
+                "sub-*_ses-1_*_echo-1_part-mag_bold.nii.gz",
+            )
+        )
+    )
+    jobs = {}
+    for bold_file in bold_files:
+        prefix = os.path.basename(bold_file).split("_echo-1")[0]
+        recordings = {}
+        for label, physio_file in find_physio_files(bold_file).items():
+            name = os.path.basename(physio_file).replace("_physio.tsv.gz", "")
+            peaks_file = get_peaks_file(peaks_dir, name)
+            json_file = physio_file.replace(".tsv.gz", ".json")
+            if os.path.isfile(peaks_file):
+                recordings[label] = {"peaks_file": peaks_file, "json_file": json_file}
+
+        if not recordings:
+            print(f"No physio peaks found for {prefix}")
+            continue
+
+        out_file = os.path.join(
+            os.path.dirname(get_peaks_file(peaks_dir, prefix)),
+            f"{prefix}_part-mag_desc-physio_timeseries.tsv",
+        )
+        in_files = [bold_file, bold_file.replace(".nii.gz", ".json")] + [
+            f for files in recordings.values() for f in files.values()
+        ]
+        if not overwrite and is_up_to_date(out_file, in_files):
+            continue
+
+        jobs[prefix] = {"bold_file": bold_file, "recordings": recordings, "out_file": out_file}
+
+    print(f"Calculating physio regressors for {len(jobs)} runs")
+    print_job_summary(run_jobs(write_physio_regressors, jobs, n_procs=n_procs, n_threads=1))
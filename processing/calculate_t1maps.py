@@ -6,18 +6,246 @@ Modifications:
 - Removed mask
 - Used BIDS-ish input files, where the two volumes are in separate files
 - Used json files for metadata instead of hardcoding values
+- Replaced the per-run interp1d with a cached lookup table, with optional masking,
+  Newton refinement, and batch evaluation of many runs
+- Wrote the T1 maps to a derivatives dataset, in parallel, skipping up-to-date maps
 """
 
 import json
 import os
+from functools import lru_cache
 from glob import glob
 
 import nibabel as nb
 import numpy as np
 import scipy
+from utils import atomic_output, is_up_to_date, print_job_summary, run_jobs
 
 
-def main(tdp1_file, tdp2_file, tdp2_metadata, out_file):
+# T1 values (ms) at which the signal ratio is tabulated
+T1_RANGE = np.arange(100, 5010, 10)
+
+
+def signal_ratio(t1, trec, ti):
+    """Calculate the TDP2/TDP1 signal ratio for a given T1.
+
+    Parameters
+    ----------
+    t1 : float or numpy.ndarray
+        T1, in ms.
+    trec : float
+        Saturation recovery time (SaturationPulseTime), in ms.
+    ti : float
+        Inversion time, in ms.
+
+    Returns
+    -------
+    z : float or numpy.ndarray
+    """
+    return (1 - 2 * np.exp(-ti / t1) + np.exp(-trec / t1)) / (1 - np.exp(-trec / t1))
+
+
+def _signal_ratio_derivative(t1, trec, ti):
+    """Calculate the derivative of :func:`signal_ratio` with respect to T1."""
+    exp_ti = np.exp(-ti / t1)
+    exp_trec = np.exp(-trec / t1)
+    d_exp_ti = exp_ti * ti / t1**2
+    d_exp_trec = exp_trec * trec / t1**2
+    numerator = 1 - 2 * exp_ti + exp_trec
+    denominator = 1 - exp_trec
+    return (
+        (-2 * d_exp_ti + d_exp_trec) * denominator + numerator * d_exp_trec
+    ) / denominator**2
+
+
+@lru_cache(maxsize=None)
+def get_lookup_table(trec, ti):
+    """Build the lookup table from signal ratio to T1, for one set of timing parameters.
+
+    The table is cached, so runs with the same SaturationPulseTime and InversionTime share it.
+
+    Parameters
+    ----------
+    trec : float
+        Saturation recovery time (SaturationPulseTime), in ms.
+    ti : float
+        Inversion time, in ms.
+
+    Returns
+    -------
+    z : numpy.ndarray
+        Signal ratios at T1_RANGE, in ascending order.
+    t1 : numpy.ndarray
+        The corresponding T1 values.
+    slope : numpy.ndarray
+        Slope of T1 with respect to the signal ratio between each pair of table entries.
+    """
+    z = signal_ratio(T1_RANGE, trec, ti)
+    order = np.argsort(z, kind="mergesort")
+    z, t1 = z[order], T1_RANGE[order].astype(np.float64)
+    if not np.all(np.diff(z) > 0):
+        raise ValueError(
+            f"Signal ratio is not monotonic in T1 for SaturationPulseTime={trec} ms, "
+            f"InversionTime={ti} ms"
+        )
+
+    slope = np.diff(t1) / np.diff(z)
+    for arr in (z, t1, slope):
+        arr.flags.writeable = False
+
+    return z, t1, slope
+
+
+def invert_ratio(ratio, trec, ti, method="table", dtype=np.float64, n_iterations=3):
+    """Convert TDP2/TDP1 signal ratios to T1.
+
+    Parameters
+    ----------
+    ratio : numpy.ndarray
+        Signal ratios, already clipped to the table's range as in :func:`calculate_ratio`.
+    trec : float
+        Saturation recovery time (SaturationPulseTime), in ms.
+    ti : float
+        Inversion time, in ms.
+    method : {"table", "newton"}
+        "table" linearly interpolates, and extrapolates, the lookup table,
+        which matches ``scipy.interpolate.interp1d(z, T1_RANGE, fill_value="extrapolate")``.
+        "newton" refines the table estimates within the table's range with Newton's method
+        on the analytic signal ratio, which removes the interpolation error.
+    dtype : numpy dtype
+        Floating-point type for the Newton iterations.
+    n_iterations : int
+        Number of Newton iterations.
+
+    Returns
+    -------
+    t1 : numpy.ndarray
+        T1, in ms, with the same shape as ``ratio``. NaN ratios (0 / 0) give NaN.
+    """
+    z, t1_table, slope = get_lookup_table(trec, ti)
+
+    # Same arithmetic as interp1d's linear interpolation, but with precomputed slopes
+    index = np.searchsorted(z, ratio).clip(1, z.size - 1) - 1
+    t1 = slope[index] * (ratio - z[index]) + t1_table[index]
+    if method == "table":
+        return t1
+
+    if method != "newton":
+        raise ValueError(f"Unknown method: {method}")
+
+    in_range = (ratio >= z[0]) & (ratio <= z[-1])
+    target = ratio[in_range].astype(dtype)
+    estimate = t1[in_range].astype(dtype)
+    for _ in range(n_iterations):
+        step = (signal_ratio(estimate, trec, ti) - target) / _signal_ratio_derivative(
+            estimate, trec, ti
+        )
+        estimate -= step.astype(dtype)
+
+    # Newton's method should never leave the bracketing table interval
+    np.clip(estimate, T1_RANGE[0], T1_RANGE[-1], out=estimate)
+    t1[in_range] = estimate
+    return t1
+
+
+def calculate_ratio(tdp1_data, tdp2_data, trec, ti):
+    """Calculate the TDP2/TDP1 signal ratio, limited to the range of the lookup table.
+
+    Zero ratios are set to the smallest tabulated ratio, and ratios of 1 or more to the largest.
+    """
+    z = get_lookup_table(trec, ti)[0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = tdp2_data / tdp1_data
+
+    ratio[ratio == 0] = z[0]
+    ratio[ratio >= 1] = z[-1]
+    return ratio
+
+
+def check_accuracy(ratio, t1, trec, ti):
+    """Compare T1 estimates to the original ``interp1d`` inversion.
+
+    Returns
+    -------
+    max_abs_diff : float
+        Maximum absolute difference, in ms, over voxels with finite estimates.
+    """
+    z = signal_ratio(T1_RANGE, trec, ti)
+    reference = scipy.interpolate.interp1d(z, T1_RANGE, fill_value="extrapolate")(ratio)
+    finite = np.isfinite(reference) & np.isfinite(t1)
+    if not finite.any():
+        return 0.0
+
+    return float(np.max(np.abs(reference[finite] - t1[finite])))
+
+
+def calculate_t1maps(runs, method="table", dtype=np.float64, check=False):
+    """Calculate T1 maps for many runs at once.
+
+    Runs are grouped by their timing parameters, and the ratios of each group,
+    restricted to each run's mask, are inverted with one call to :func:`invert_ratio`.
+
+    Parameters
+    ----------
+    runs : list of dict
+        Each with "tdp1_file", "tdp2_file", "tdp2_metadata", and "out_file" keys,
+        as for :func:`main`, and optionally a "mask_file".
+        Voxels outside the mask are set to zero.
+    method : {"table", "newton"}
+        Inversion method. See :func:`invert_ratio`.
+    dtype : numpy dtype
+        Floating-point type for Newton refinement.
+    check : bool
+        If True, compare each run's T1 values to the original interp1d inversion.
+
+    Returns
+    -------
+    max_abs_diffs : dict
+        Mapping from each output file to the maximum absolute difference, in ms,
+        from the interp1d inversion. Empty unless ``check`` is True.
+    """
+    groups = {}
+    for run in runs:
+        trec = run["tdp2_metadata"]["SaturationPulseTime"] * 1000
+        ti = run["tdp2_metadata"]["InversionTime"] * 1000
+        groups.setdefault((trec, ti), []).append(run)
+
+    max_abs_diffs = {}
+    for (trec, ti), group in groups.items():
+        masks, ratios, tdp1_imgs = [], [], []
+        for run in group:
+            tdp1_img = nb.load(run["tdp1_file"])
+            tdp1_data = tdp1_img.get_fdata()
+            tdp2_data = nb.load(run["tdp2_file"]).get_fdata()
+            if run.get("mask_file"):
+                mask = np.asanyarray(nb.load(run["mask_file"]).dataobj).astype(bool)
+            else:
+                mask = np.ones(tdp1_data.shape, dtype=bool)
+
+            tdp1_imgs.append(tdp1_img)
+            masks.append(mask)
+            ratios.append(calculate_ratio(tdp1_data[mask], tdp2_data[mask], trec, ti))
+            del tdp1_data, tdp2_data
+
+        t1_values = invert_ratio(np.concatenate(ratios), trec, ti, method=method, dtype=dtype)
+        sections = np.cumsum([ratio.size for ratio in ratios])[:-1]
+        for run, tdp1_img, mask, ratio, t1 in zip(
+            group, tdp1_imgs, masks, ratios, np.split(t1_values, sections)
+        ):
+            if check:
+                max_abs_diffs[run["out_file"]] = check_accuracy(ratio, t1, trec, ti)
+
+            t1[np.isnan(t1)] = 0
+            t1_data = np.zeros(mask.shape, dtype=t1.dtype)
+            t1_data[mask] = t1
+            t1map_img = nb.Nifti1Image(t1_data, tdp1_img.affine, tdp1_img.header)
+            with atomic_output(run["out_file"]) as temp_file:
+                t1map_img.to_filename(temp_file)
+
+    return max_abs_diffs
+
+
+def main(tdp1_file, tdp2_file, tdp2_metadata, out_file, mask_file=None, method="table"):
     """Calculate a low-resolution, quantitative t1_range map from input files.
 
     Parameters
@@ -30,41 +258,136 @@ def main(tdp1_file, tdp2_file, tdp2_metadata, out_file):
         Metadata for the second TDP volume
     out_file : str
         Path to the output T1map file
+    mask_file : str or None
+        Path to a brain mask. T1 is only calculated within the mask.
+        If None, T1 is calculated for every voxel.
+    method : {"table", "newton"}
+        Inversion method. See :func:`invert_ratio`.
     """
+    run = {
+        "tdp1_file": tdp1_file,
+        "tdp2_file": tdp2_file,
+        "tdp2_metadata": tdp2_metadata,
+        "out_file": out_file,
+        "mask_file": mask_file,
+    }
+    calculate_t1maps([run], method=method)
 
-    tdp1_img = nb.load(tdp1_file)
-    tdp1_data = tdp1_img.get_fdata()
-
-    tdp2_img = nb.load(tdp2_file)
-    tdp2_data = tdp2_img.get_fdata()
-
-    t1_range = np.arange(100, 5010, 10)
-    trec = tdp2_metadata["SaturationPulseTime"] * 1000
-    ti = tdp2_metadata["InversionTime"] * 1000
-
-    z = (1 - 2 * np.exp(-ti / t1_range) + np.exp(-trec / t1_range)) / (1 - np.exp(-trec / t1_range))
 
-    ratio = tdp2_data / tdp1_data
-    ratio[ratio == 0] = np.min(z)
-    ratio[ratio >= 1] = np.max(z)
-    f = scipy.interpolate.interp1d(z, t1_range, fill_value="extrapolate")
-
-    t1 = f(ratio)
-    t1[np.isnan(t1)] = 0
-
-    t1map_img = nb.Nifti1Image(t1, tdp1_img.affine, tdp1_img.header)
-    t1map_img.to_filename(out_file)
+def find_runs(in_dir, out_dir):
+    """Find the TDP pairs in a BIDS dataset and their T1 maps in a derivatives dataset.
 
+    Parameters
+    ----------
+    in_dir : str
+        Path to the BIDS dataset.
+    out_dir : str
+        Path to the derivatives dataset.
 
-if __name__ == "__main__":
-    in_dir = "/cbica/projects/pafin/dset"
+    Returns
+    -------
+    runs : list of dict
+        Inputs and outputs of each run, for :func:`calculate_t1maps`,
+        plus an "in_files" key listing the files the T1 map depends on.
+    """
     tdp1_files = sorted(glob(os.path.join(in_dir, "sub-*/ses-*/anat/*acq-tr1_TDP.nii.gz")))
+    runs = []
     for tdp1_file in tdp1_files:
         tdp2_file = tdp1_file.replace("acq-tr1", "acq-tr2")
         tdp2_metadata_file = tdp2_file.replace(".nii.gz", ".json")
+        for in_file in (tdp2_file, tdp2_metadata_file):
+            if not os.path.isfile(in_file):
+                raise FileNotFoundError(in_file)
+
         with open(tdp2_metadata_file, "r") as f:
             tdp2_metadata = json.load(f)
 
-        # TODO: Write the T1map out to a derivatives dataset
-        out_file = tdp1_file.replace("TDP.nii.gz", "T1map.nii.gz")
-        main(tdp1_file, tdp2_file, tdp2_metadata, out_file)
+        anat_dir = os.path.relpath(os.path.dirname(tdp1_file), in_dir)
+        out_name = os.path.basename(tdp1_file).replace("acq-tr1_", "")
+        out_name = out_name.replace("TDP.nii.gz", "T1map.nii.gz")
+        runs.append(
+            {
+                "tdp1_file": tdp1_file,
+                "tdp2_file": tdp2_file,
+                "tdp2_metadata": tdp2_metadata,
+                "out_file": os.path.join(out_dir, anat_dir, out_name),
+                "in_files": [tdp1_file, tdp2_file, tdp2_metadata_file],
+            }
+        )
+
+    return runs
+
+
+def write_dataset_description(out_dir):
+    """Write the derivatives dataset's dataset_description.json, if it does not exist."""
+    out_file = os.path.join(out_dir, "dataset_description.json")
+    if os.path.isfile(out_file):
+        return
+
+    dataset_description = {
+        "Name": "PAFIN T1 maps",
+        "BIDSVersion": "1.9.0",
+        "DatasetType": "derivative",
+        "GeneratedBy": [
+            {
+                "Name": "calculate_t1maps.py",
+                "Description": (
+                    "Quantitative T1 maps from pairs of transit delay prescan (TDP) volumes, "
+                    "by inverting the TDP2/TDP1 signal ratio."
+                ),
+            }
+        ],
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    with open(out_file, "w") as f:
+        json.dump(dataset_description, f, indent=4, sort_keys=True)
+
+
+def run_batch(in_dir, out_dir, n_procs=1, overwrite=False, method="table"):
+    """Calculate T1 maps for every TDP pair in a BIDS dataset.
+
+    Each run is its own job, so only one TDP pair is held in memory per process,
+    and a bad pair only fails its own T1 map.
+    Runs with the same SaturationPulseTime and InversionTime share a lookup table,
+    which is cached by :func:`get_lookup_table` in each worker process.
+
+    Parameters
+    ----------
+    in_dir : str
+        Path to the BIDS dataset.
+    out_dir : str
+        Path to the derivatives dataset.
+    n_procs : int
+        Number of worker processes.
+    overwrite : bool
+        If False, T1 maps that are newer than their inputs are skipped.
+    method : {"table", "newton"}
+        Inversion method. See :func:`invert_ratio`.
+
+    Returns
+    -------
+    results : dict
+        Output of :func:`utils.run_jobs`, with one job per T1 map.
+    """
+    write_dataset_description(out_dir)
+    runs = find_runs(in_dir, out_dir)
+    todo = [run for run in runs if overwrite or not is_up_to_date(run["out_file"], run["in_files"])]
+    print(f"{len(runs)} TDP pairs found, {len(runs) - len(todo)} up to date")
+
+    jobs = {}
+    for run in todo:
+        os.makedirs(os.path.dirname(run["out_file"]), exist_ok=True)
+        name = os.path.relpath(run["out_file"], out_dir)
+        jobs[name] = {k: v for k, v in run.items() if k != "in_files"}
+        jobs[name]["method"] = method
+
+    results = run_jobs(main, jobs, n_procs=n_procs, n_threads=1)
+    print_job_summary(results)
+    return results
+
+
+if __name__ == "__main__":
+    in_dir = "/cbica/projects/pafin/dset"
+    out_dir = "/cbica/projects/pafin/derivatives/t1maps"
+    n_procs = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+    run_batch(in_dir, out_dir, n_procs=n_procs)
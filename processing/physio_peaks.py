@@ -0,0 +1,192 @@
+"""Read and write the peaks and troughs found by run_peakdet.py.
+
+Each physio recording gets one small ``.npz`` file, mirroring the BIDS tree,
+with the peak and trough indices and signal values, the sampling rate, the number of samples,
+and the settings used to filter the signal and find the peaks.
+An index table (``peaks.tsv``) lists every file with its BIDS entities and a few summary values,
+so the results of a whole cohort can be selected and loaded without reading the raw signals.
+
+Only numpy and pandas are needed to load the results.
+"""
+
+import json
+import os
+from glob import glob
+
+import numpy as np
+import pandas as pd
+from utils import atomic_output
+
+
+INDEX_FILE = "peaks.tsv"
+
+
+def get_peaks_file(out_dir, name):
+    """Get the path of the peaks file of a recording.
+
+    Parameters
+    ----------
+    out_dir : str
+        Path to the derivatives dataset.
+    name : str
+        Base name of the recording, without the ``_physio.tsv.gz`` suffix.
+
+    Returns
+    -------
+    str
+    """
+    entities = dict(part.split("-", 1) for part in name.split("_") if "-" in part)
+    sub_dir = os.path.join(f"sub-{entities['sub']}", f"ses-{entities['ses']}", "func")
+    return os.path.join(out_dir, sub_dir, f"{name}_desc-peaks_physio.npz")
+
+
+def save_peaks(
+    out_file,
+    peaks,
+    troughs,
+    peak_values,
+    trough_values,
+    sampling_frequency,
+    n_samples,
+    settings,
+):
+    """Write the peaks and troughs of a recording.
+
+    Parameters
+    ----------
+    out_file : str
+        Path to the ``.npz`` file to write.
+    peaks, troughs : array_like of int
+        Sample indices of the peaks and troughs.
+    peak_values, trough_values : array_like of float
+        Values of the filtered signal at the peaks and troughs.
+    sampling_frequency : float
+        Sampling rate of the recording, in Hz.
+    n_samples : int
+        Number of samples in the recording.
+    settings : dict
+        JSON-serializable settings used to filter the signal and find the peaks.
+    """
+    with atomic_output(out_file) as temp_file:
+        np.savez_compressed(
+            temp_file,
+            peaks=np.asarray(peaks, dtype=np.int32),
+            troughs=np.asarray(troughs, dtype=np.int32),
+            peak_values=np.asarray(peak_values, dtype=np.float32),
+            trough_values=np.asarray(trough_values, dtype=np.float32),
+            sampling_frequency=np.float64(sampling_frequency),
+            n_samples=np.int64(n_samples),
+            # stored as a string, so loading never needs pickle
+            settings=json.dumps(settings, sort_keys=True),
+        )
+
+
+def load_peaks(peaks_file):
+    """Read the peaks and troughs of a recording.
+
+    Parameters
+    ----------
+    peaks_file : str
+        Path to a file written by :func:`save_peaks`.
+
+    Returns
+    -------
+    dict
+        With keys "peaks", "troughs", "peak_values", "trough_values", "sampling_frequency",
+        "n_samples", and "settings".
+    """
+    with np.load(peaks_file) as npz:
+        return {
+            "peaks": npz["peaks"],
+            "troughs": npz["troughs"],
+            "peak_values": npz["peak_values"],
+            "trough_values": npz["trough_values"],
+            "sampling_frequency": float(npz["sampling_frequency"]),
+            "n_samples": int(npz["n_samples"]),
+            "settings": json.loads(str(npz["settings"])),
+        }
+
+
+def write_index(out_dir):
+    """Write the index table of all of the peaks files in a derivatives dataset.
+
+    Parameters
+    ----------
+    out_dir : str
+        Path to the derivatives dataset.
+
+    Returns
+    -------
+    index_df : pandas.DataFrame
+        One row per peaks file, with its path relative to ``out_dir``, its BIDS entities,
+        sampling rate, number of samples, and numbers of peaks and troughs.
+    """
+    peaks_files = sorted(
+        glob(os.path.join(out_dir, "sub-*", "ses-*", "func", "*_desc-peaks_physio.npz"))
+    )
+    rows = []
+    for peaks_file in peaks_files:
+        name = os.path.basename(peaks_file).replace("_desc-peaks_physio.npz", "")
+        result = load_peaks(peaks_file)
+        rows.append(
+            {
+                "name": name,
+                "path": os.path.relpath(peaks_file, out_dir),
+                **dict(part.split("-", 1) for part in name.split("_") if "-" in part),
+                "sampling_frequency": result["sampling_frequency"],
+                "n_samples": result["n_samples"],
+                "n_peaks": result["peaks"].size,
+                "n_troughs": result["troughs"].size,
+            }
+        )
+
+    index_df = pd.DataFrame(rows)
+    with atomic_output(os.path.join(out_dir, INDEX_FILE)) as temp_file:
+        index_df.to_csv(temp_file, sep="\t", index=False, na_rep="n/a")
+
+    return index_df
+
+
+def load_cohort(out_dir, **entities):
+    """Load the peaks and troughs of many recordings at once.
+
+    Parameters
+    ----------
+    out_dir : str
+        Path to the derivatives dataset, with an index table written by :func:`write_index`.
+    **entities
+        BIDS entities to select recordings by, each a value or a list of values
+        (e.g., ``recording="cardiac", sub=["01", "02"]``).
+
+    Returns
+    -------
+    cohort_df : pandas.DataFrame
+        The selected rows of the index table,
+        with the "peaks", "troughs", "peak_values", and "trough_values" arrays of each recording.
+
+    Examples
+    --------
+    >>> cohort_df = load_cohort("/cbica/projects/pafin/derivatives/physiopy", recording="cardiac")
+    >>> heart_rates = [
+    ...     60 * row.sampling_frequency / np.diff(row.peaks).mean()
+    ...     for row in cohort_df.itertuples()
+    ... ]
+    """
+    index_df = pd.read_table(os.path.join(out_dir, INDEX_FILE), dtype=str, keep_default_na=False)
+    for entity, values in entities.items():
+        if entity not in index_df.columns:
+            raise ValueError(f"Unknown entity '{entity}'. Options are {list(index_df.columns)}")
+
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        index_df = index_df.loc[index_df[entity].isin([str(value) for value in values])]
+
+    cohort_df = index_df.reset_index(drop=True)
+    cohort_df["sampling_frequency"] = cohort_df["sampling_frequency"].astype(float)
+    for column in ("n_samples", "n_peaks", "n_troughs"):
+        cohort_df[column] = cohort_df[column].astype(int)
+
+    results = [load_peaks(os.path.join(out_dir, path)) for path in cohort_df["path"]]
+    for key in ("peaks", "troughs", "peak_values", "trough_values"):
+        cohort_df[key] = [result[key] for result in results]
+
+    return cohort_df
@@ -2,53 +2,169 @@
 Run peakdet on all physio files in the dataset.
 
 This script will identify peaks and troughs in the physio data and save the results
-in the derivatives/physiopy directory.
+in the derivatives/physiopy directory. See physio_peaks.py for the file format and loaders.
+
+Peak detection and figure rendering are separate stages, each run in a process pool.
+Figures are optional, and only the visible 50-second window of the signal is drawn on each axis.
 """
 
 import json
 import os
 from glob import glob
 
-import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.figure import Figure
 from peakdet import load_physio, operations
+from physio_peaks import get_peaks_file, load_peaks, save_peaks, write_index
+from utils import atomic_output, is_up_to_date, print_job_summary, run_jobs
+
+
+FILTER_SETTINGS = {"cutoffs": 1, "method": "lowpass"}
+PEAKFIND_SETTINGS = {"thresh": 0.1, "dist": 100}
+WINDOW_LENGTH = 50  # seconds of signal per row of the figure
+N_WINDOWS = 10
+
+
+def load_filtered_physio(physio_file):
+    """Load a physio recording and low-pass filter it."""
+    json_file = physio_file.replace(".tsv.gz", ".json")
+
+    with open(json_file) as fo:
+        metadata = json.load(fo)
+
+    fs = metadata["SamplingFrequency"]
+
+    data = load_physio(physio_file, fs=fs)
+    return operations.filter_physio(data, **FILTER_SETTINGS)
+
+
+def find_peaks(physio_file, out_file):
+    """Filter a physio recording, find its peaks and troughs, and save them.
+
+    Parameters
+    ----------
+    physio_file : str
+        Path to a BIDS ``_physio.tsv.gz`` file with a JSON sidecar.
+    out_file : str
+        Path to the ``.npz`` file to write with :func:`physio_peaks.save_peaks`.
+    """
+    data = load_filtered_physio(physio_file)
+    data = operations.peakfind_physio(data, **PEAKFIND_SETTINGS)
+    save_peaks(
+        out_file,
+        peaks=data.peaks,
+        troughs=data.troughs,
+        peak_values=data.data[data.peaks],
+        trough_values=data.data[data.troughs],
+        sampling_frequency=data.fs,
+        n_samples=len(data),
+        settings={"filter_physio": FILTER_SETTINGS, "peakfind_physio": PEAKFIND_SETTINGS},
+    )
+
+
+def _plot_window(ax, time, signal, peaks, troughs, start, end):
+    """Plot the samples, peaks, and troughs between two times, as peakdet's plot_physio does."""
+    # Keep the samples just outside the window, so the line reaches the edges of the axis
+    first, last = np.searchsorted(time, [start, end])
+    first, last = max(first - 1, 0), min(last + 1, time.size)
+    peaks = peaks[(peaks >= first) & (peaks < last)]
+    troughs = troughs[(troughs >= first) & (troughs < last)]
+    ax.plot(
+        time[first:last],
+        signal[first:last],
+        "b",
+        time[peaks],
+        signal[peaks],
+        ".r",
+        time[troughs],
+        signal[troughs],
+        ".g",
+    )
+    ax.set_xlim(start, end)
+
+
+def plot_peaks(physio_file, peaks_file, out_file, title):
+    """Plot the first few minutes of a physio recording with its peaks and troughs.
+
+    The figure is built without pyplot, so it is rendered with Agg and never kept alive
+    by pyplot's figure manager.
+
+    Parameters
+    ----------
+    physio_file : str
+        Path to the BIDS ``_physio.tsv.gz`` file, which is filtered again for plotting.
+    peaks_file : str
+        Output of :func:`find_peaks`.
+    out_file : str
+        Path to the PNG file to write.
+    title : str
+        Title of the figure.
+    """
+    result = load_peaks(peaks_file)
+    signal = np.asarray(load_filtered_physio(physio_file).data)
+    time = np.arange(signal.size) / result["sampling_frequency"]
+    peaks, troughs = result["peaks"], result["troughs"]
+
+    fig = Figure(figsize=(16, 24))
+    axes = fig.subplots(nrows=N_WINDOWS, sharey=True)
+    for i_ax, ax in enumerate(axes):
+        ax_start = i_ax * WINDOW_LENGTH
+        ax_end = (i_ax + 1) * WINDOW_LENGTH
+        _plot_window(ax, time, signal, peaks, troughs, ax_start, ax_end)
+
+    # Scale the shared y-axis to the whole signal, as when the whole signal was drawn on each axis
+    margin = 0.05 * (signal.max() - signal.min())
+    axes[0].set_ylim(signal.min() - margin, signal.max() + margin)
+
+    fig.suptitle(title)
+    fig.tight_layout()
+    with atomic_output(out_file) as temp_file:
+        fig.savefig(temp_file, format="png")
 
 
 if __name__ == "__main__":
     in_dir = "/cbica/projects/pafin/dset"
     out_dir = "/cbica/projects/pafin/derivatives/physiopy"
+    n_procs = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+    overwrite = False
+    plot_figures = True
     os.makedirs(out_dir, exist_ok=True)
     os.makedirs(os.path.join(out_dir, "figures"), exist_ok=True)
 
-    physio_files = glob(os.path.join(in_dir, "sub-*", "ses-1", "func", "*_physio.tsv.gz"))
+    physio_files = sorted(glob(os.path.join(in_dir, "sub-*", "ses-1", "func", "*_physio.tsv.gz")))
+    peak_jobs, plot_jobs = {}, {}
     for physio_file in physio_files:
         if "trigger" in physio_file:
             print(f"Skipping {physio_file} because it contains 'trigger'")
             continue
 
+        name = os.path.basename(physio_file).replace("_physio.tsv.gz", "")
         json_file = physio_file.replace(".tsv.gz", ".json")
+        peaks_file = get_peaks_file(out_dir, name)
+        figure_file = os.path.join(out_dir, "figures", f"{name}_peakdet.png")
+        if overwrite or not is_up_to_date(peaks_file, [physio_file, json_file]):
+            os.makedirs(os.path.dirname(peaks_file), exist_ok=True)
+            peak_jobs[name] = {"physio_file": physio_file, "out_file": peaks_file}
+
+        plot_jobs[name] = {
+            "physio_file": physio_file,
+            "peaks_file": peaks_file,
+            "out_file": figure_file,
+            "title": name,
+        }
+
+    print(f"Finding peaks in {len(peak_jobs)} files")
+    results = run_jobs(find_peaks, peak_jobs, n_procs=n_procs, n_threads=1)
+    print_job_summary(results)
+    write_index(out_dir)
 
-        with open(json_file) as fo:
-            metadata = json.load(fo)
-
-        fs = metadata["SamplingFrequency"]
-
-        data = load_physio(physio_file, fs=fs)
-        data = operations.filter_physio(data, cutoffs=1, method="lowpass")
-        data = operations.peakfind_physio(data, thresh=0.1, dist=100)
-
-        fig, axes = plt.subplots(figsize=(16, 24), nrows=10, sharey=True)
-        for i_ax, ax in enumerate(axes):
-            operations.plot_physio(data, ax=ax)
-            ax_start = i_ax * 50
-            ax_end = (i_ax + 1) * 50
-            ax.set_xlim(ax_start, ax_end)
-
-        fig.suptitle(os.path.basename(physio_file).replace("_physio.tsv.gz", ""))
-        fig.tight_layout()
-        fig.savefig(
-            os.path.join(
-                out_dir,
-                "figures",
-                os.path.basename(physio_file).replace("_physio.tsv.gz", "_peakdet.png"),
-            ),
-        )
+    if plot_figures:
+        failed = {name for name, (status, _) in results.items() if status == "failed"}
+        plot_jobs = {
+            name: kwargs
+            for name, kwargs in plot_jobs.items()
+            if name not in failed
+            and (overwrite or not is_up_to_date(kwargs["out_file"], [kwargs["peaks_file"]]))
+        }
+        print(f"Plotting {len(plot_jobs)} figures")
+        print_job_summary(run_jobs(plot_peaks, plot_jobs, n_procs=n_procs, n_threads=1))
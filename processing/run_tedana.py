@@ -2,14 +2,221 @@
 
 import json
 import os
+import tempfile
 from glob import glob
 
 import nibabel as nb
 import numpy as np
 import pandas as pd
 from nilearn import image, masking
-from scipy import stats
+from scipy import linalg, stats
 from tedana.workflows import tedana_workflow
+from utils import (
+    adopt_legacy_outputs,
+    get_confounds_summary,
+    manifest_is_current,
+    print_job_summary,
+    run_jobs,
+    write_json_atomic,
+    write_manifest,
+)
+
+
+# Settings for tedana_workflow, which are also recorded in each run's manifest
+TEDANA_PARAMS = {
+    "fittype": "curvefit",
+    "combmode": "t2s",
+    "tree": "minimal",
+    "gscontrol": ["mir"],
+    "tedort": True,
+}
+# tedana outputs used by run_tedana_aroma
+TEDANA_OUTPUTS = [
+    "tedana_report.html",
+    "desc-optcom_bold.nii.gz",
+    "desc-ICA_mixing.tsv",
+    "desc-tedana_metrics.tsv",
+    "desc-adaptiveGoodSignal_mask.nii.gz",
+]
+# Columns copied from the fMRIPost-AROMA component table into the tedana+aroma table
+AROMA_METRICS = [
+    "edge_fract",
+    "csf_fract",
+    "max_RP_corr",
+    "HFC",
+    "model_variance_explained",
+    "total_variance_explained",
+]
+# Settings recorded in each run's tedana+aroma manifest
+TEDANA_AROMA_PARAMS = {"aroma_metrics": AROMA_METRICS}
+TEDANA_AROMA_OUTPUTS = [
+    "desc-tedana+aroma_metrics.tsv",
+    "desc-ICAOrth_mixing.tsv",
+    "desc-t1_map.nii.gz",
+    "desc-glsig_timeseries.tsv",
+    "desc-ICAOrthMIR_mixing.tsv",
+    "desc-confounds_timeseries.tsv",
+]
+
+
+class MixingSolver:
+    """Least-squares solves against a mixing matrix, using a single QR factorisation.
+
+    The columns in ``leading`` are placed first in the factorisation,
+    so the leading columns of Q span exactly those components.
+    That lets the same factorisation orthogonalize the remaining components with respect to them,
+    and gives the factorisation of the orthogonalized mixing matrix for free.
+
+    Parameters
+    ----------
+    mixing : (T x C) array_like
+        Mixing matrix. It must have full column rank.
+    leading : array_like of int
+        Indices of the components to place first (e.g., the accepted components).
+    dtype : numpy dtype
+        Precision of the factorisation and of the solves.
+        float32 halves the memory and roughly doubles the speed of :meth:`solve`.
+    """
+
+    def __init__(self, mixing, leading=(), dtype=np.float64):
+        """Factorise the mixing matrix."""
+        self.mixing = np.asarray(mixing, dtype=dtype)
+        self.dtype = dtype
+        n_components = self.mixing.shape[1]
+        leading = np.asarray(leading, dtype=int)
+        trailing = np.setdiff1d(np.arange(n_components), leading)
+        self.leading, self.trailing = leading, trailing
+        self.q, self.r = np.linalg.qr(self.mixing[:, np.concatenate((leading, trailing))])
+
+    def solve(self, data):
+        """Equivalent to ``np.linalg.lstsq(mixing, data)[0]``, for a (T x N) ``data`` array."""
+        betas = linalg.solve_triangular(self.r, np.dot(self.q.T, data.astype(self.dtype)))
+        out = np.empty_like(betas)
+        out[np.concatenate((self.leading, self.trailing))] = betas
+        return out
+
+    def orthogonalize(self):
+        """Orthogonalize the trailing components with respect to the leading components.
+
+        Returns
+        -------
+        solver : :obj:`MixingSolver`
+            Solver for the orthogonalized mixing matrix, available as ``solver.mixing``.
+            The leading components are unchanged.
+        """
+        n_leading = self.leading.size
+        # With mixing[:, trailing] = Q_l R_lt + Q_t R_tt, the residuals of the trailing components
+        # after regressing out the leading components are mixing[:, trailing] - Q_l R_lt,
+        # and the QR factorisation of the orthogonalized matrix is Q with R_lt set to zero.
+        mixing = self.mixing.copy()
+        mixing[:, self.trailing] -= np.dot(self.q[:, :n_leading], self.r[:n_leading, n_leading:])
+
+        solver = object.__new__(MixingSolver)
+        solver.mixing, solver.dtype = mixing, self.dtype
+        solver.leading, solver.trailing = self.leading, self.trailing
+        solver.q, solver.r = self.q, self.r.copy()
+        solver.r[:n_leading, n_leading:] = 0
+        return solver
+
+    def orthogonalize_estimates(self, betas):
+        """Convert parameter estimates for this mixing matrix to its orthogonalized form.
+
+        If ``data = mixing @ betas``, then ``data = orthogonalized_mixing @ new_betas``, where
+        the trailing components keep their estimates and the leading components absorb the
+        part of the trailing components explained by them.
+
+        Parameters
+        ----------
+        betas : (C x N) array_like
+            Parameter estimates for the mixing matrix, e.g., from :meth:`solve`.
+
+        Returns
+        -------
+        new_betas : (C x N) numpy.ndarray
+            Parameter estimates for the mixing matrix from :meth:`orthogonalize`.
+        """
+        n_leading = self.leading.size
+        # Regression coefficients of the trailing components on the leading components
+        coefs = linalg.solve_triangular(
+            self.r[:n_leading, :n_leading],
+            self.r[:n_leading, n_leading:],
+        )
+        new_betas = np.array(betas, dtype=np.result_type(betas, self.dtype))
+        new_betas[self.leading] += np.dot(coefs, new_betas[self.trailing])
+        return new_betas
+
+
+def _voxel_blocks(n_voxels, bytes_per_voxel, max_memory):
+    """Split voxels into blocks whose working memory stays under ``max_memory`` bytes."""
+    block_size = max(1, int(max_memory // bytes_per_voxel))
+    return [slice(i, i + block_size) for i in range(0, n_voxels, block_size)]
+
+
+def cache_masked_optcom(optcom, adaptive_mask, mixing_file, cache_prefix, max_memory=2**30):
+    """Cache the masked optimally combined data and its component parameter estimates.
+
+    The cache is rebuilt whenever any of the three input files changes.
+
+    Parameters
+    ----------
+    optcom : str
+        Path to tedana's optimally combined data.
+    adaptive_mask : str
+        Path to tedana's adaptive mask. Voxels with a value above zero are used.
+    mixing_file : str
+        Path to tedana's (unorthogonalized) mixing matrix.
+    cache_prefix : str
+        Path prefix for the cache files.
+    max_memory : int
+        Approximate ceiling, in bytes, on the working memory used when building the cache.
+
+    Returns
+    -------
+    data_optcom : (S x T) numpy.memmap
+        Masked optimally combined data, in float32.
+    comp_pes : (S x C) numpy.memmap
+        Parameter estimates of the z-scored data for each component of the mixing matrix,
+        in float64. Use :meth:`MixingSolver.orthogonalize_estimates` to convert them
+        to any orthogonalized version of the mixing matrix.
+    """
+    key_file = f"{cache_prefix}_cache.json"
+    data_file = f"{cache_prefix}_desc-optcom_bold.npy"
+    pes_file = f"{cache_prefix}_desc-compPEs.npy"
+    key = {}
+    for in_file in (optcom, adaptive_mask, mixing_file):
+        stat = os.stat(in_file)
+        key[os.path.abspath(in_file)] = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    cached_key = None
+    if os.path.isfile(key_file):
+        with open(key_file, "r") as fo:
+            cached_key = json.load(fo)
+
+    if cached_key != key or not (os.path.isfile(data_file) and os.path.isfile(pes_file)):
+        print("\t\tCaching masked optimally combined data")
+        mask_img = image.math_img("(img > 0).astype(int)", img=adaptive_mask)
+        data_optcom = masking.apply_mask(optcom, mask_img).T.astype(np.float32)
+        np.save(f"{data_file}.tmp.npy", data_optcom)
+
+        # Temporary files are renamed only once complete, so a killed job leaves no valid cache
+        solver = MixingSolver(pd.read_table(mixing_file).to_numpy())
+        n_voxels, n_vols = data_optcom.shape
+        comp_pes = np.lib.format.open_memmap(
+            f"{pes_file}.tmp.npy",
+            mode="w+",
+            dtype=np.float64,
+            shape=(n_voxels, solver.mixing.shape[1]),
+        )
+        for block in _voxel_blocks(n_voxels, 8 * 2 * n_vols, max_memory):
+            comp_pes[block] = solver.solve(stats.zscore(data_optcom[block], axis=-1).T).T
+
+        comp_pes.flush()
+        del comp_pes, data_optcom
+        os.replace(f"{data_file}.tmp.npy", data_file)
+        os.replace(f"{pes_file}.tmp.npy", pes_file)
+        write_json_atomic(key, key_file)
+
+    return np.load(data_file, mmap_mode="r"), np.load(pes_file, mmap_mode="r")
 
 
 def minimum_image_regression(
@@ -18,6 +225,10 @@ def minimum_image_regression(
     mixing: np.ndarray,
     mask: np.ndarray,
     component_table: pd.DataFrame,
+    max_memory: int = 2**30,
+    solver: MixingSolver = None,
+    comp_pes: np.ndarray = None,
+    comp_pes_solver: MixingSolver = None,
 ):
     """Perform minimum image regression (MIR) to remove T1-like effects from BOLD-like components.
 
@@ -33,6 +244,23 @@ def minimum_image_regression(
     component_table : (C x X) :obj:`pandas.DataFrame`
         Component metric table. One row for each component, with a column for
         each metric. The index should be the component number.
+    max_memory : int
+        Approximate ceiling, in bytes, on the working memory used for the voxel-wise steps.
+        Voxels are processed in blocks small enough to stay under it.
+        Default is 1 GB.
+    solver : :obj:`MixingSolver` or None
+        Factorisation of ``mixing`` to reuse for the component parameter estimates.
+        If None, ``mixing`` is factorised here.
+    comp_pes : (S x C) array_like or None
+        Precomputed parameter estimates of the z-scored ``data_optcom`` for each component
+        in ``mixing`` (e.g., from :func:`cache_masked_optcom`).
+        If None, they are estimated here.
+    comp_pes_solver : :obj:`MixingSolver` or None
+        Solver for the unorthogonalized mixing matrix that ``comp_pes`` were estimated for,
+        when ``mixing`` is its orthogonalized form.
+        Each block of ``comp_pes`` is then converted with
+        :meth:`MixingSolver.orthogonalize_estimates`, so a memory-mapped ``comp_pes``
+        is never loaded whole.
 
     Notes
     -----
@@ -64,24 +292,51 @@ def minimum_image_regression(
     # Drop rejected components (by AROMA) from list of ignored components
     ign = sorted(np.setdiff1d(ign, acc))
 
-    # Compute temporal regression
-    data_optcom_z = stats.zscore(data_optcom, axis=-1)
-    # component parameter estimates
-    comp_pes = np.linalg.lstsq(mixing, data_optcom_z.T, rcond=None)[0].T
+    n_voxels, n_vols = data_optcom.shape
+    # Each voxel in a block holds its z-scored time series, lstsq's copy of it,
+    # its MEHK time series, and its component parameter estimates, all in float64.
+    blocks = _voxel_blocks(n_voxels, 8 * (3 * n_vols + mixing.shape[1]), max_memory)
+    if solver is None and comp_pes is None:
+        solver = MixingSolver(mixing)
 
     # Build time series of just BOLD-like components (i.e., MEHK) and save T1-like effect
-    mehk_ts = np.dot(comp_pes[:, acc], mixing[:, acc].T)
-    t1_map = mehk_ts.min(axis=-1)  # map of T1-like effect
+    t1_map = np.empty(n_voxels)  # map of T1-like effect
+    for block in blocks:
+        if comp_pes is None:
+            # Compute temporal regression
+            data_optcom_z = stats.zscore(data_optcom[block], axis=-1)
+            # component parameter estimates
+            block_pes = solver.solve(data_optcom_z.T).T
+            del data_optcom_z
+        else:
+            block_pes = np.asarray(comp_pes[block])
+            if comp_pes_solver is not None:
+                block_pes = comp_pes_solver.orthogonalize_estimates(block_pes.T).T
+
+        mehk_ts = np.dot(block_pes[:, acc], mixing[:, acc].T)
+        t1_map[block] = mehk_ts.min(axis=-1)
+        del block_pes, mehk_ts
+
     t1_map -= t1_map.mean()
     t1_img = masking.unmask(t1_map, mask)
-    t1_map = t1_map[:, np.newaxis]
 
-    # Find the global signal based on the T1-like effect
-    gs_ts = np.linalg.lstsq(t1_map, data_optcom_z, rcond=None)[0]
+    # Find the global signal based on the T1-like effect.
+    # With a single regressor, lstsq(t1_map[:, None], data_optcom_z) reduces to
+    # t1_map @ data_optcom_z / (t1_map @ t1_map), which can be accumulated block by block.
+    t1_dot_data = np.zeros(n_vols)
+    for block in blocks:
+        t1_dot_data += np.dot(t1_map[block], stats.zscore(data_optcom[block], axis=-1))
+
+    t1_ss = np.dot(t1_map, t1_map)
+    gs_ts = t1_dot_data / t1_ss if t1_ss > 0 else np.zeros(n_vols)
+    gs_ts = gs_ts[np.newaxis, :]
     glsig_df = pd.DataFrame(data=gs_ts.T, columns=["mir_global_signal"])
 
-    # Orthogonalize mixing matrix w.r.t. T1-GS
-    mixing_not1gs = mixing.T - np.dot(np.linalg.lstsq(gs_ts.T, mixing, rcond=None)[0].T, gs_ts)
+    # Orthogonalize mixing matrix w.r.t. T1-GS.
+    # As above, lstsq(gs_ts.T, mixing) with a single regressor is gs_ts @ mixing / (gs_ts @ gs_ts).
+    gs_ss = np.dot(gs_ts[0], gs_ts[0])
+    gs_betas = np.dot(gs_ts, mixing) / gs_ss if gs_ss > 0 else np.zeros((1, mixing.shape[1]))
+    mixing_not1gs = mixing.T - np.dot(gs_betas.T, gs_ts)
     mixing_not1gs_z = stats.zscore(mixing_not1gs, axis=-1)
     mixing_not1gs_z = np.vstack((np.atleast_2d(np.ones(max(gs_ts.shape))), gs_ts, mixing_not1gs_z))
 
@@ -90,7 +345,213 @@ def minimum_image_regression(
     return t1_img, glsig_df, mixing_df
 
 
-def run_tedana(raw_dir, fmriprep_dir, aroma_dir, temp_dir, tedana_out_dir):
+def trim_dummy_scans(in_file, dummy_scans, out_dir):
+    """Drop the first ``dummy_scans`` volumes from a 4D image.
+
+    The trimmed image is written uncompressed, so it is never re-gzipped
+    and nibabel can memory-map it when tedana loads it.
+
+    Parameters
+    ----------
+    in_file : str
+        Path to the 4D image.
+    dummy_scans : int
+        Number of initial volumes to drop.
+    out_dir : str
+        Directory in which to write the trimmed image.
+
+    Returns
+    -------
+    out_file : str
+        Path to the trimmed image.
+        This is ``in_file`` itself if there are no volumes to drop.
+    """
+    if dummy_scans == 0:
+        return in_file
+
+    img = nb.load(in_file)
+    out_file = os.path.join(out_dir, os.path.basename(in_file).replace(".nii.gz", ".nii"))
+    img.slicer[:, :, :, dummy_scans:].to_filename(out_file)
+    return out_file
+
+
+def tedana_single_run(
+    base_file,
+    fmriprep_dir,
+    aroma_dir,
+    temp_dir,
+    tedana_out_dir,
+    scratch_dir=None,
+    confounds_cache=None,
+):
+    """Run tedana on a single multi-echo run.
+
+    Parameters
+    ----------
+    base_file : str
+        Path to the first-echo magnitude BOLD file in the raw dataset.
+    fmriprep_dir : str
+        Path to the fMRIPrep derivatives dataset.
+    aroma_dir : str
+        Path to the fMRIPost-AROMA derivatives dataset.
+    temp_dir : str
+        Working directory for this run. Nothing else should write to it.
+    tedana_out_dir : str
+        Path to the tedana derivatives dataset.
+    scratch_dir : str or None
+        Directory for the short-lived, trimmed echo files (ideally fast, node-local storage).
+        If None, ``temp_dir`` is used.
+    confounds_cache : str or None
+        Directory caching the number of dummy scans for each confounds file.
+        See :func:`utils.get_confounds_summary`.
+
+    Returns
+    -------
+    status : str
+        "done" if tedana was run, "skipped" if the outputs are up to date with the inputs.
+
+    Notes
+    -----
+    The inputs, parameters, and outputs of each run are recorded in a
+    ``{prefix}_tedana_manifest.json`` file next to the tedana outputs.
+    Runs with an existing report but no manifest are assumed to be up to date.
+    """
+    raw_files = sorted(glob(base_file.replace("echo-1", "echo-*")))
+
+    base_filename = os.path.basename(base_file)
+    print(f"\t{base_filename}")
+    subject = base_filename.split("_")[0]
+    prefix = base_filename.split("_echo-1")[0]
+    func_dir = os.path.join(fmriprep_dir, subject, "ses-1", "func")
+
+    # Get the fMRIPrep brain mask
+    mask_base = base_filename.split("_echo-1")[0]
+    mask = os.path.join(func_dir, f"{mask_base}_part-mag_desc-brain_mask.nii.gz")
+
+    # Get the fMRIPrep confounds file, to identify the number of non-steady-state volumes
+    confounds_file = os.path.join(
+        func_dir,
+        f"{mask_base}_part-mag_desc-confounds_timeseries.tsv",
+    )
+
+    # Get the fMRIPost-AROMA mixing file
+    mask_base = "_".join([p for p in mask_base.split("_") if not p.startswith("dir")])
+    t2star = os.path.join(func_dir, f"{mask_base}_space-boldref_T2starmap.nii.gz")
+    mixing = os.path.join(
+        aroma_dir,
+        subject,
+        "ses-1",
+        "func",
+        f"{mask_base}_part-mag_space-MNI152NLin6Asym_res-2_desc-melodic_mixing.tsv",
+    )
+
+    # Get the echo-wise metadata and fMRIPrep BOLD files
+    json_files = [raw_file.replace(".nii.gz", ".json") for raw_file in raw_files]
+    fmriprep_files = [
+        os.path.join(
+            func_dir,
+            os.path.basename(raw_file).split("_bold.nii.gz")[0] + "_desc-preproc_bold.nii.gz",
+        )
+        for raw_file in raw_files
+    ]
+
+    inputs = [mask, confounds_file, mixing] + json_files + fmriprep_files
+    for in_file in [t2star] + inputs:
+        if not os.path.isfile(in_file):
+            raise FileNotFoundError(in_file)
+
+    # Skip runs whose inputs and parameters are unchanged, before reading any of them
+    tedana_run_out_dir = os.path.join(tedana_out_dir, subject, "ses-1", "func")
+    os.makedirs(tedana_run_out_dir, exist_ok=True)
+    manifest_file = os.path.join(tedana_run_out_dir, f"{prefix}_tedana_manifest.json")
+    outputs = [
+        os.path.join(tedana_run_out_dir, f"{prefix}_{suffix}")
+        for suffix in TEDANA_OUTPUTS
+    ]
+    if manifest_is_current(manifest_file, inputs, TEDANA_PARAMS):
+        print(f"DONE: {prefix}")
+        return "skipped"
+    elif adopt_legacy_outputs(manifest_file, inputs, TEDANA_PARAMS, outputs):
+        # Outputs from before manifests were tracked, and newer than all of their inputs
+        print(f"DONE: {prefix}")
+        return "skipped"
+
+    os.makedirs(temp_dir, exist_ok=True)
+    dummy_scans, _ = get_confounds_summary(confounds_file, cache_dir=confounds_cache)
+
+    print(f"\t\t{dummy_scans} dummy scans")
+
+    mixing_arr = np.loadtxt(mixing)
+    # remove dummy volumes
+    mixing_arr = mixing_arr[dummy_scans:, :]
+    mixing_df = pd.DataFrame(
+        data=mixing_arr,
+        columns=[f"ICA_{i}" for i in range(mixing_arr.shape[1])],
+    )
+    mixing2 = os.path.join(temp_dir, os.path.basename(mixing))
+    mixing_df.to_csv(mixing2, sep="\t", index=False)
+
+    # Get echo time from json file
+    echo_times = []
+    for json_file in json_files:
+        with open(json_file, "r") as f:
+            echo_times.append(json.load(f)["EchoTime"] * 1000)
+
+    # Remove non-steady-state volumes into uncompressed scratch files,
+    # which are deleted as soon as tedana is done with them.
+    with tempfile.TemporaryDirectory(prefix=f"{prefix}_", dir=scratch_dir or temp_dir) as trim_dir:
+        trimmed_files = [trim_dummy_scans(f, dummy_scans, trim_dir) for f in fmriprep_files]
+
+        # Any existing outputs are stale at this point
+        tedana_workflow(
+            data=trimmed_files,
+            tes=echo_times,
+            mask=mask,
+            out_dir=tedana_run_out_dir,
+            prefix=prefix,
+            mixm=mixing2,
+            overwrite=True,
+            # t2smap=t2star,
+            **TEDANA_PARAMS,
+        )
+
+    write_manifest(manifest_file, inputs, TEDANA_PARAMS, outputs)
+    return "done"
+
+
+def run_tedana(
+    raw_dir,
+    fmriprep_dir,
+    aroma_dir,
+    temp_dir,
+    tedana_out_dir,
+    scratch_dir=None,
+    confounds_cache=None,
+    n_procs=1,
+    n_threads=1,
+):
+    """Run tedana on every multi-echo run in the dataset.
+
+    Parameters
+    ----------
+    raw_dir, fmriprep_dir, aroma_dir, tedana_out_dir : str
+        Paths to the raw, fMRIPrep, fMRIPost-AROMA, and tedana datasets.
+    temp_dir : str
+        Working directory. Each run gets its own subdirectory, named after the run prefix.
+    scratch_dir : str or None
+        Directory for the trimmed echo files. If None, each run's working directory is used.
+    confounds_cache : str or None
+        Directory caching the number of dummy scans for each confounds file.
+    n_procs : int
+        Number of runs to process in parallel.
+    n_threads : int
+        Number of BLAS/OpenMP threads available to each parallel run.
+
+    Returns
+    -------
+    results : dict
+        Mapping from run prefix to a (status, message) tuple.
+    """
     print("TEDANA")
 
     base_search = os.path.join(
@@ -104,131 +565,76 @@ def run_tedana(raw_dir, fmriprep_dir, aroma_dir, temp_dir, tedana_out_dir):
     if not base_files:
         raise FileNotFoundError(base_search)
 
+    jobs = {}
     for base_file in base_files:
-        raw_files = sorted(glob(base_file.replace("echo-1", "echo-*")))
+        prefix = os.path.basename(base_file).split("_echo-1")[0]
+        jobs[prefix] = {
+            "base_file": base_file,
+            "fmriprep_dir": fmriprep_dir,
+            "aroma_dir": aroma_dir,
+            "temp_dir": os.path.join(temp_dir, prefix),
+            "tedana_out_dir": tedana_out_dir,
+            "scratch_dir": scratch_dir,
+            "confounds_cache": confounds_cache,
+        }
 
-        base_filename = os.path.basename(base_file)
-        print(f"\t{base_filename}")
-        subject = base_filename.split("_")[0]
-        prefix = base_filename.split("_echo-1")[0]
+    results = run_jobs(tedana_single_run, jobs, n_procs=n_procs, n_threads=n_threads)
+    print_job_summary(results)
+    return results
 
-        # Get the fMRIPrep brain mask
-        mask_base = base_filename.split("_echo-1")[0]
-        mask = os.path.join(
-            fmriprep_dir,
-            subject,
-            "ses-1",
-            "func",
-            f"{mask_base}_part-mag_desc-brain_mask.nii.gz",
-        )
-        assert os.path.isfile(mask), mask
 
-        # Get the fMRIPrep confounds file and identify the number of non-steady-state volumes
-        confounds_file = os.path.join(
-            fmriprep_dir,
-            subject,
-            "ses-1",
-            "func",
-            f"{mask_base}_part-mag_desc-confounds_timeseries.tsv",
-        )
-        confounds_df = pd.read_table(confounds_file)
-        nss_cols = [c for c in confounds_df.columns if c.startswith("non_steady_state_outlier")]
-
-        dummy_scans = 0
-        if nss_cols:
-            initial_volumes_df = confounds_df[nss_cols]
-            dummy_scans = np.any(initial_volumes_df.to_numpy(), axis=1)
-            dummy_scans = np.where(dummy_scans)[0]
-
-            # reasonably assumes all NSS volumes are contiguous
-            dummy_scans = int(dummy_scans[-1] + 1)
-
-        print(f"\t\t{dummy_scans} dummy scans")
+def combine_classifications(tedana_df, aroma_df):
+    """Add fMRIPost-AROMA classifications and metrics to a tedana component table.
 
-        # Get the fMRIPost-AROMA mixing file
-        mask_base = "_".join([p for p in mask_base.split("_") if not p.startswith("dir")])
+    Components rejected by AROMA are rejected,
+    and the rationales from both tools are combined in the classification tags.
 
-        t2star = os.path.join(
-            fmriprep_dir,
-            subject,
-            "ses-1",
-            "func",
-            f"{mask_base}_space-boldref_T2starmap.nii.gz",
-        )
-        assert os.path.isfile(t2star), t2star
+    Parameters
+    ----------
+    tedana_df : :obj:`pandas.DataFrame`
+        tedana component table.
+    aroma_df : :obj:`pandas.DataFrame`
+        fMRIPost-AROMA component table, with the same index as ``tedana_df``.
+
+    Returns
+    -------
+    tedana_df : :obj:`pandas.DataFrame`
+        Updated copy of the tedana component table.
+    """
+    tedana_df = tedana_df.copy()
+    rows = aroma_df.index
+    aroma_rejected = aroma_df["classification"] == "rejected"
 
-        mixing = os.path.join(
-            aroma_dir,
-            subject,
-            "ses-1",
-            "func",
-            f"{mask_base}_part-mag_space-MNI152NLin6Asym_res-2_desc-melodic_mixing.tsv",
-        )
-        assert os.path.isfile(mixing), mixing
-
-        mixing_arr = np.loadtxt(mixing)
-        # remove dummy volumes
-        mixing_arr = mixing_arr[dummy_scans:, :]
-        mixing_df = pd.DataFrame(
-            data=mixing_arr,
-            columns=[f"ICA_{i}" for i in range(mixing_arr.shape[1])],
-        )
-        mixing2 = os.path.join(temp_dir, os.path.basename(mixing))
-        mixing_df.to_csv(mixing2, sep="\t", index=False)
-
-        echo_times = []
-        fmriprep_files = []
-        for raw_file in raw_files:
-            base_query = os.path.basename(raw_file).split("_bold.nii.gz")[0]
-
-            # Get echo time from json file
-            with open(raw_file.replace(".nii.gz", ".json"), "r") as f:
-                echo_times.append(json.load(f)["EchoTime"] * 1000)
-
-            # Get the fMRIPrep BOLD files
-            fmriprep_file = os.path.join(
-                fmriprep_dir,
-                subject,
-                "ses-1",
-                "func",
-                f"{base_query}_desc-preproc_bold.nii.gz",
-            )
-            assert os.path.isfile(fmriprep_file), fmriprep_file
-
-            # Remove non-steady-state volumes
-            echo_img = nb.load(fmriprep_file)
-            echo_img = echo_img.slicer[:, :, :, dummy_scans:]
-            temporary_file = os.path.join(
-                temp_dir,
-                os.path.basename(fmriprep_file),
-            )
-            echo_img.to_filename(temporary_file)
-            fmriprep_files.append(temporary_file)
+    # Equivalent to prefixing each ;-separated rationale with the name of the tool
+    tags = "TEDANA " + tedana_df.loc[rows, "classification_tags"].str.replace(
+        ";", ";TEDANA ", regex=False
+    )
+    aroma_tags = "AROMA " + aroma_df.loc[aroma_rejected, "rationale"].str.replace(
+        ";", ";AROMA ", regex=False
+    )
+    tags[aroma_rejected] = tags[aroma_rejected] + ";" + aroma_tags
+    tedana_df.loc[rows[aroma_rejected], "classification"] = "rejected"
+    tedana_df.loc[rows, "classification_tags"] = tags
 
-        tedana_run_out_dir = os.path.join(tedana_out_dir, subject, "ses-1", "func")
-        os.makedirs(tedana_run_out_dir, exist_ok=True)
-        if os.path.isfile(os.path.join(tedana_run_out_dir, f"{prefix}_tedana_report.html")):
-            print(f"DONE: {prefix}")
-            continue
+    # Add other columns from aroma_df to tedana_df
+    for col in AROMA_METRICS:
+        tedana_df.loc[rows, col] = aroma_df[col]
 
-        tedana_workflow(
-            data=fmriprep_files,
-            tes=echo_times,
-            mask=mask,
-            out_dir=tedana_run_out_dir,
-            prefix=prefix,
-            fittype="curvefit",
-            combmode="t2s",
-            tree="minimal",
-            mixm=mixing2,
-            gscontrol=["mir"],
-            tedort=True,
-            # t2smap=t2star,
-        )
+    return tedana_df
 
 
-def run_tedana_aroma(raw_dir, fmriprep_dir, aroma_dir, tedana_out_dir, tedana_aroma_out_dir):
+def run_tedana_aroma(
+    raw_dir,
+    fmriprep_dir,
+    aroma_dir,
+    tedana_out_dir,
+    tedana_aroma_out_dir,
+    confounds_cache=None,
+    optcom_cache_dir=None,
+):
     print("TEDANA+AROMA")
+    if optcom_cache_dir is not None:
+        os.makedirs(optcom_cache_dir, exist_ok=True)
 
     base_files = sorted(
         glob(
@@ -248,10 +654,9 @@ def run_tedana_aroma(raw_dir, fmriprep_dir, aroma_dir, tedana_out_dir, tedana_ar
         prefix = base_filename.split("_echo-1")[0]
 
         tedana_run_out_dir = os.path.join(tedana_out_dir, subject, "ses-1", "func")
-        # Get the fMRIPrep brain mask
         fname_base = base_filename.split("_echo-1")[0]
 
-        # Get the fMRIPrep confounds file and identify the number of non-steady-state volumes
+        # Get the fMRIPrep confounds file, to identify the number of non-steady-state volumes
         confounds_file = os.path.join(
             fmriprep_dir,
             subject,
@@ -259,24 +664,9 @@ def run_tedana_aroma(raw_dir, fmriprep_dir, aroma_dir, tedana_out_dir, tedana_ar
             "func",
             f"{fname_base}_part-mag_desc-confounds_timeseries.tsv",
         )
-        confounds_df = pd.read_table(confounds_file)
-        nss_cols = [c for c in confounds_df.columns if c.startswith("non_steady_state_outlier")]
-
-        dummy_scans = 0
-        if nss_cols:
-            initial_volumes_df = confounds_df[nss_cols]
-            dummy_scans = np.any(initial_volumes_df.to_numpy(), axis=1)
-            dummy_scans = np.where(dummy_scans)[0]
-
-            # reasonably assumes all NSS volumes are contiguous
-            dummy_scans = int(dummy_scans[-1] + 1)
-
-        print(f"\t\t{dummy_scans} dummy scans")
 
         fname_base = "_".join([p for p in fname_base.split("_") if not p.startswith("dir")])
 
-        # Combine the classifications from tedana with the AROMA classifications
-        # and save the combined classifications to the derivatives folder
         # Get the AROMA classifications
         aroma_classifications = os.path.join(
             aroma_dir,
@@ -285,48 +675,36 @@ def run_tedana_aroma(raw_dir, fmriprep_dir, aroma_dir, tedana_out_dir, tedana_ar
             "func",
             f"{fname_base}_part-mag_desc-aroma_metrics.tsv",
         )
-        aroma_df = pd.read_table(aroma_classifications)
 
-        # Get the tedana classifications
+        # Get the tedana classifications, optimally combined data, mixing matrix, adaptive mask
         tedana_classifications = os.path.join(
             tedana_run_out_dir,
             f"{prefix}_desc-tedana_metrics.tsv",
         )
-        tedana_df = pd.read_table(tedana_classifications)
-
-        assert aroma_df.shape[0] == tedana_df.shape[0], (
-            "AROMA and tedana have different numbers of components"
+        optcom = os.path.join(
+            tedana_run_out_dir,
+            f"{prefix}_desc-optcom_bold.nii.gz",
+        )
+        mixing = os.path.join(
+            tedana_run_out_dir,
+            f"{prefix}_desc-ICA_mixing.tsv",
         )
+        adaptive_mask = os.path.join(
+            tedana_run_out_dir,
+            f"{prefix}_desc-adaptiveGoodSignal_mask.nii.gz",
+        )
+        inputs = [
+            confounds_file,
+            aroma_classifications,
+            tedana_classifications,
+            optcom,
+            mixing,
+            adaptive_mask,
+        ]
+        for in_file in inputs:
+            if not os.path.isfile(in_file):
+                raise FileNotFoundError(in_file)
 
-        # Combine the classifications
-        for i_row, aroma_row in aroma_df.iterrows():
-            aroma_clf = aroma_row["classification"]
-            tedana_rationale = tedana_df.loc[i_row, "classification_tags"]
-            tedana_rationales = tedana_rationale.split(";")
-
-            aroma_rationales = []
-            if aroma_clf == "rejected":
-                aroma_rationales = aroma_row["rationale"].split(";")
-                aroma_rationales = [f"AROMA {rationale}" for rationale in aroma_rationales]
-                tedana_df.loc[i_row, "classification"] = "rejected"
-
-            tedana_rationales = [f"TEDANA {rationale}" for rationale in tedana_rationales]
-            rationales = tedana_rationales + aroma_rationales
-            tedana_df.loc[i_row, "classification_tags"] = ";".join(rationales)
-
-            # Add other columns from aroma_df to tedana_df
-            other_cols = [
-                "edge_fract",
-                "csf_fract",
-                "max_RP_corr",
-                "HFC",
-                "model_variance_explained",
-                "total_variance_explained",
-            ]
-            for col in other_cols:
-                tedana_df.loc[i_row, col] = aroma_row[col]
-
-        # Save the combined classifications
         tedana_aroma_run_out_dir = os.path.join(
             tedana_aroma_out_dir,
             subject,
@@ -335,6 +713,34 @@ def run_tedana_aroma(raw_dir, fmriprep_dir, aroma_dir, tedana_out_dir, tedana_ar
         )
         os.makedirs(tedana_aroma_run_out_dir, exist_ok=True)
 
+        # Skip runs whose inputs and parameters are unchanged, before reading any of them
+        manifest_file = os.path.join(
+            tedana_aroma_run_out_dir,
+            f"{prefix}_tedana+aroma_manifest.json",
+        )
+        outputs = [
+            os.path.join(tedana_aroma_run_out_dir, f"{prefix}_{suffix}")
+            for suffix in TEDANA_AROMA_OUTPUTS
+        ]
+        if manifest_is_current(manifest_file, inputs, TEDANA_AROMA_PARAMS):
+            print(f"DONE: {prefix}")
+            continue
+
+        dummy_scans, _ = get_confounds_summary(confounds_file, cache_dir=confounds_cache)
+
+        print(f"\t\t{dummy_scans} dummy scans")
+
+        # Combine the classifications from tedana with the AROMA classifications
+        # and save the combined classifications to the derivatives folder
+        aroma_df = pd.read_table(aroma_classifications)
+        tedana_df = pd.read_table(tedana_classifications)
+
+        assert aroma_df.shape[0] == tedana_df.shape[0], (
+            "AROMA and tedana have different numbers of components"
+        )
+
+        tedana_df = combine_classifications(tedana_df, aroma_df)
+
         # Write out updated component table
         combined_classifications = os.path.join(
             tedana_aroma_run_out_dir,
@@ -346,35 +752,16 @@ def run_tedana_aroma(raw_dir, fmriprep_dir, aroma_dir, tedana_out_dir, tedana_ar
             index=False,
         )
 
-        # Load optimally combined data, mixing matrix, adaptive mask
-        optcom = os.path.join(
-            tedana_run_out_dir,
-            f"{prefix}_desc-optcom_bold.nii.gz",
-        )
-        mixing = os.path.join(
-            tedana_run_out_dir,
-            f"{prefix}_desc-ICA_mixing.tsv",
-        )
-        adaptive_mask = os.path.join(
-            tedana_run_out_dir,
-            f"{prefix}_desc-adaptiveGoodSignal_mask.nii.gz",
-        )
-        assert os.path.isfile(optcom), optcom
-        assert os.path.isfile(mixing), mixing
-        assert os.path.isfile(adaptive_mask), adaptive_mask
-
         mixing_df = pd.read_table(mixing)
         mixing_arr = mixing_df.to_numpy()
 
         # Orthogonalize rejected components with respect to accepted components
         comps_accepted = tedana_df.loc[tedana_df["classification"] == "accepted"].index.values
         comps_rejected = tedana_df.loc[tedana_df["classification"] == "rejected"].index.values
-        acc_ts = mixing_arr[:, comps_accepted]
-        rej_ts = mixing_arr[:, comps_rejected]
-        betas = np.linalg.lstsq(acc_ts, rej_ts, rcond=None)[0]
-        pred_rej_ts = np.dot(acc_ts, betas)
-        resid = rej_ts - pred_rej_ts
-        mixing_arr[:, comps_rejected] = resid
+        # The factorisation is reused for the component parameter estimates in MIR.
+        raw_solver = MixingSolver(mixing_arr, leading=comps_accepted)
+        solver = raw_solver.orthogonalize()
+        mixing_arr = solver.mixing
 
         # Write out orthogonalized mixing matrix
         mixing_df = pd.DataFrame(columns=mixing_df.columns, data=mixing_arr)
@@ -388,12 +775,27 @@ def run_tedana_aroma(raw_dir, fmriprep_dir, aroma_dir, tedana_out_dir, tedana_ar
 
         # Perform minimum image regression on orthogonalized mixing matrix
         mask_img = image.math_img("(img > 0).astype(int)", img=adaptive_mask)
-        optcom_arr = masking.apply_mask(optcom, mask_img).T
+        comp_pes = None
+        if optcom_cache_dir is None:
+            optcom_arr = masking.apply_mask(optcom, mask_img).T
+        else:
+            # Only the conversion of the cached estimates depends on the classifications,
+            # and minimum_image_regression does it one voxel block at a time
+            optcom_arr, comp_pes = cache_masked_optcom(
+                optcom,
+                adaptive_mask,
+                mixing,
+                os.path.join(optcom_cache_dir, prefix),
+            )
+
         t1_img, glsig_df, mixing_df = minimum_image_regression(
             data_optcom=optcom_arr,
             mixing=mixing_arr,
             mask=mask_img,
             component_table=tedana_df,
+            solver=solver,
+            comp_pes=comp_pes,
+            comp_pes_solver=raw_solver,
         )
         t1_img.to_filename(os.path.join(tedana_aroma_run_out_dir, f"{prefix}_desc-t1_map.nii.gz"))
         glsig_df.to_csv(
@@ -419,6 +821,7 @@ def run_tedana_aroma(raw_dir, fmriprep_dir, aroma_dir, tedana_out_dir, tedana_ar
             sep="\t",
             index=False,
         )
+        write_manifest(manifest_file, inputs, TEDANA_AROMA_PARAMS, outputs)
 
 
 if __name__ == "__main__":
@@ -426,10 +829,37 @@ if __name__ == "__main__":
     fmriprep_dir_ = "/cbica/projects/pafin/derivatives/fmriprep"
     aroma_dir_ = "/cbica/projects/pafin/derivatives/fmripost_aroma"
     temp_dir_ = "/cbica/comp_space/pafin/tedana_temp"
+    # Node-local scratch space for the trimmed echoes, when the scheduler provides it
+    scratch_dir_ = os.environ.get("TMPDIR")
     tedana_out_dir_ = "/cbica/projects/pafin/derivatives/tedana"
     tedana_aroma_out_dir_ = "/cbica/projects/pafin/derivatives/tedana+aroma"
+    # Shared with qc/plot_median_fd.py
+    confounds_cache_ = "/cbica/comp_space/pafin/fmriprep_confounds_cache"
+
+    # Split the allocated CPUs between parallel runs and the BLAS threads within each run
+    n_cpus_ = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+    n_threads_ = 2
+    n_procs_ = max(1, n_cpus_ // n_threads_)
 
     os.makedirs(temp_dir_, exist_ok=True)
 
-    run_tedana(raw_dir_, fmriprep_dir_, aroma_dir_, temp_dir_, tedana_out_dir_)
-    run_tedana_aroma(raw_dir_, fmriprep_dir_, aroma_dir_, tedana_out_dir_, tedana_aroma_out_dir_)
+    run_tedana(
+        raw_dir_,
+        fmriprep_dir_,
+        aroma_dir_,
+        temp_dir_,
+        tedana_out_dir_,
+        scratch_dir=scratch_dir_,
+        confounds_cache=confounds_cache_,
+        n_procs=n_procs_,
+        n_threads=n_threads_,
+    )
+    run_tedana_aroma(
+        raw_dir_,
+        fmriprep_dir_,
+        aroma_dir_,
+        tedana_out_dir_,
+        tedana_aroma_out_dir_,
+        confounds_cache=confounds_cache_,
+        optcom_cache_dir=os.path.join(temp_dir_, "optcom_cache"),
+    )
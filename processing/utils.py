@@ -0,0 +1,405 @@
+"""Shared helpers for the processing scripts.
+
+The job runner (:func:`run_jobs`, :func:`print_job_summary`, and :func:`limit_blas_threads`)
+and :func:`atomic_output` are copied in curation/utils.py,
+and :func:`get_confounds_summary` and the helpers it uses are copied in qc/utils.py.
+The curation, processing, and QC scripts run from their own folders,
+so none of them can import the others' helpers. Keep the copies identical
+(tests/test_utils.py checks that they are).
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+
+BLAS_THREAD_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+@contextmanager
+def limit_blas_threads(n_threads):
+    """Temporarily cap BLAS/OpenMP threads for any child processes started in this context.
+
+    BLAS libraries read these variables once, when they are loaded,
+    so they must be in the environment before a worker process imports numpy.
+    """
+    old_values = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: str(n_threads) for var in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for var, value in old_values.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _run_job(func, kwargs, n_threads):
+    """Run one job, turning any exception into a "failed" status."""
+    try:
+        if n_threads is None:
+            status = func(**kwargs)
+        else:
+            from threadpoolctl import threadpool_limits
+
+            with threadpool_limits(limits=n_threads):
+                status = func(**kwargs)
+
+        return status or "done", ""
+    except Exception:
+        return "failed", traceback.format_exc()
+
+
+def run_jobs(func, jobs, n_procs=1, n_threads=1):
+    """Run ``func`` once per job, optionally across a process pool.
+
+    Parameters
+    ----------
+    func : callable
+        Module-level function to run. It may return a short status string (e.g., "skipped").
+    jobs : dict
+        Mapping from a job name (e.g., a run prefix) to the keyword arguments for ``func``.
+    n_procs : int
+        Number of worker processes. With 1, jobs run serially in this process.
+    n_threads : int
+        Number of BLAS/OpenMP threads allowed in each worker process.
+        Ignored when ``n_procs`` is 1.
+
+    Returns
+    -------
+    results : dict
+        Mapping from job name to a (status, message) tuple,
+        where message holds the traceback of failed jobs.
+    """
+    results = {}
+    if n_procs == 1:
+        for name, kwargs in jobs.items():
+            results[name] = _run_job(func, kwargs, None)
+            print(f"\t{results[name][0].upper()}: {name}")
+        return results
+
+    with limit_blas_threads(n_threads):
+        # spawn, rather than fork, so the thread limits are in place before workers load BLAS
+        with ProcessPoolExecutor(max_workers=n_procs, mp_context=get_context("spawn")) as pool:
+            futures = {
+                pool.submit(_run_job, func, kwargs, n_threads): name
+                for name, kwargs in jobs.items()
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    # e.g., a worker killed by the OOM killer
+                    results[name] = ("failed", traceback.format_exc())
+
+                print(f"\t{results[name][0].upper()}: {name}")
+
+    return {name: results[name] for name in jobs}
+
+
+def print_job_summary(results):
+    """Print a per-job summary of the output of :func:`run_jobs`."""
+    statuses = sorted(set(status for status, _ in results.values()))
+    counts = ", ".join(
+        f"{sum(s == status for s, _ in results.values())} {status}" for status in statuses
+    )
+    print(f"{len(results)} jobs: {counts}")
+    for name, (status, message) in results.items():
+        if status == "failed":
+            print(f"FAILED: {name}\n{message}")
+
+
+def _run_command(cmd, log_file):
+    """Run a command, writing the command and its output to a log file."""
+    with open(log_file, "w") as fo:
+        fo.write(" ".join(cmd) + "\n\n")
+        fo.flush()
+        return subprocess.run(cmd, stdout=fo, stderr=subprocess.STDOUT).returncode
+
+
+def run_commands(commands, n_jobs=1):
+    """Run external commands concurrently, logging each one to its own file.
+
+    Parameters
+    ----------
+    commands : list of (list of str, str) tuples
+        Commands to run, each paired with the path to its log file.
+    n_jobs : int
+        Maximum number of commands to run at once.
+
+    Raises
+    ------
+    RuntimeError
+        If any command exits with a non-zero return code.
+        All commands are allowed to finish first.
+    """
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [
+            (log_file, pool.submit(_run_command, cmd, log_file)) for cmd, log_file in commands
+        ]
+
+    failed = [
+        f"{log_file} (exit code {future.result()})"
+        for log_file, future in futures
+        if future.result() != 0
+    ]
+    if failed:
+        raise RuntimeError("Commands failed. See the logs:\n\t" + "\n\t".join(failed))
+
+
+@contextmanager
+def atomic_output(out_file):
+    """Yield a temporary path to write an output to, then rename it to the output path.
+
+    The temporary file is in the same directory and has the same extension (e.g., ``.nii.gz``),
+    so writers that infer the format from the name work, and the rename is atomic.
+    If the block raises, the temporary file is removed and the output is left untouched,
+    so a killed or failed job never leaves a truncated file that looks complete.
+    """
+    out_dir, base_name = os.path.split(os.path.abspath(out_file))
+    stem, _, extension = base_name.partition(".")
+    # The writer creates the file, so it gets the usual permissions, unlike with mkstemp
+    temp_file = os.path.join(out_dir, f".{stem}.{uuid.uuid4().hex}.{extension}".rstrip("."))
+    try:
+        yield temp_file
+        os.replace(temp_file, out_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def write_json_atomic(data, out_file):
+    """Write a JSON file via a temporary file and a rename, so readers never see a partial file."""
+    with atomic_output(out_file) as temp_file:
+        with open(temp_file, "w") as fo:
+            json.dump(data, fo, indent=1, sort_keys=True)
+
+
+def is_up_to_date(out_file, in_files):
+    """Check that an output exists and is newer than all of its inputs.
+
+    Parameters
+    ----------
+    out_file : str
+        Path to the output file.
+    in_files : list of str
+        Paths to the files the output was made from.
+
+    Returns
+    -------
+    bool
+    """
+    if not os.path.isfile(out_file):
+        return False
+
+    out_mtime = os.stat(out_file).st_mtime
+    return all(os.stat(in_file).st_mtime <= out_mtime for in_file in in_files)
+
+
+def _read_confounds_summary(confounds_file):
+    """Read the number of non-steady-state volumes and median FD from a confounds file."""
+    columns = pd.read_table(confounds_file, nrows=0).columns
+    nss_cols = [c for c in columns if c.startswith("non_steady_state_outlier")]
+    fd_cols = [c for c in columns if c == "framewise_displacement"]
+    confounds_df = pd.read_table(confounds_file, usecols=nss_cols + fd_cols)
+
+    dummy_scans = 0
+    if nss_cols:
+        initial_volumes_df = confounds_df[nss_cols]
+        dummy_scans = np.any(initial_volumes_df.to_numpy(), axis=1)
+        dummy_scans = np.where(dummy_scans)[0]
+
+        # reasonably assumes all NSS volumes are contiguous
+        dummy_scans = int(dummy_scans[-1] + 1) if dummy_scans.size else 0
+
+    median_fd = None
+    if fd_cols:
+        median_fd = float(confounds_df["framewise_displacement"].iloc[dummy_scans:].median())
+
+    return dummy_scans, median_fd
+
+
+def get_confounds_summary(confounds_file, cache_dir=None):
+    """Get the number of non-steady-state volumes and the median FD of an fMRIPrep run.
+
+    Only the non-steady-state outlier and framewise displacement columns are read.
+
+    Parameters
+    ----------
+    confounds_file : str
+        Path to an fMRIPrep ``desc-confounds_timeseries.tsv`` file.
+    cache_dir : str or None
+        Directory in which to cache the results, with one small JSON file per confounds file,
+        keyed on the confounds file's path, modification time, and size.
+        Entries for modified files are recomputed.
+        Each entry is written on its own, so concurrent jobs never overwrite each other's entries.
+        If None, nothing is cached.
+
+    Returns
+    -------
+    dummy_scans : int
+        Number of initial non-steady-state volumes.
+    median_fd : float or None
+        Median framewise displacement after the non-steady-state volumes,
+        or None if the file has no framewise_displacement column.
+    """
+    confounds_file = os.path.abspath(confounds_file)
+    stat = os.stat(confounds_file)
+    key = {"path": confounds_file, "mtime": stat.st_mtime, "size": stat.st_size}
+
+    cache_file = None
+    if cache_dir is not None:
+        name = os.path.basename(confounds_file).replace(".tsv", "")
+        path_hash = hashlib.sha256(confounds_file.encode()).hexdigest()[:16]
+        cache_file = os.path.join(cache_dir, f"{name}_{path_hash}.json")
+        if os.path.isfile(cache_file):
+            with open(cache_file, "r") as fo:
+                entry = json.load(fo)
+
+            if all(entry.get(k) == v for k, v in key.items()):
+                return entry["dummy_scans"], entry["median_fd"]
+
+    dummy_scans, median_fd = _read_confounds_summary(confounds_file)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_json_atomic(
+            {**key, "dummy_scans": dummy_scans, "median_fd": median_fd},
+            cache_file,
+        )
+
+    return dummy_scans, median_fd
+
+
+def _sha256(path, chunk_size=2**24):
+    """Hash a file in chunks."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as fo:
+        for chunk in iter(lambda: fo.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def manifest_is_current(manifest_file, inputs, params):
+    """Check whether a run's outputs are up to date with its inputs and parameters.
+
+    Inputs whose size and modification time match the manifest are assumed unchanged.
+    Inputs with a new modification time (e.g., from a ``datalad get`` or a ``touch``)
+    are hashed and compared to the recorded hash.
+
+    Parameters
+    ----------
+    manifest_file : str
+        Manifest written by :func:`write_manifest`.
+    inputs : list of str
+        Paths to the run's input files.
+    params : dict
+        JSON-serializable parameters of the run.
+
+    Returns
+    -------
+    bool
+        False if the manifest is missing, the inputs or parameters have changed,
+        or any recorded output is missing.
+    """
+    if not os.path.isfile(manifest_file):
+        return False
+
+    with open(manifest_file, "r") as fo:
+        manifest = json.load(fo)
+
+    # Round-trip the parameters so that, e.g., tuples compare equal to lists
+    if manifest["params"] != json.loads(json.dumps(params)):
+        return False
+
+    if sorted(manifest["inputs"]) != sorted(os.path.abspath(f) for f in inputs):
+        return False
+
+    for in_file, signature in manifest["inputs"].items():
+        if not os.path.isfile(in_file):
+            return False
+
+        stat = os.stat(in_file)
+        if stat.st_size != signature["size"]:
+            return False
+
+        if stat.st_mtime != signature["mtime"] and _sha256(in_file) != signature["sha256"]:
+            return False
+
+    return all(os.path.isfile(out_file) for out_file in manifest["outputs"])
+
+
+def write_manifest(manifest_file, inputs, params, outputs):
+    """Record the inputs, parameters, and outputs of a run.
+
+    Parameters
+    ----------
+    manifest_file : str
+        Path to the JSON manifest to write.
+    inputs : list of str
+        Paths to the run's input files. Their sizes, modification times, and hashes are recorded.
+    params : dict
+        JSON-serializable parameters of the run.
+    outputs : list of str
+        Paths to the run's output files.
+    """
+    manifest = {"inputs": {}, "params": params, "outputs": [os.path.abspath(f) for f in outputs]}
+    for in_file in inputs:
+        stat = os.stat(in_file)
+        manifest["inputs"][os.path.abspath(in_file)] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": _sha256(in_file),
+        }
+
+    write_json_atomic(manifest, manifest_file)
+
+
+def adopt_legacy_outputs(manifest_file, inputs, params, outputs):
+    """Write a manifest for outputs made before manifests were tracked, if they are up to date.
+
+    Outputs are only adopted if every one of them exists and is newer than all of the inputs.
+    Otherwise, the run must be recomputed.
+
+    Parameters
+    ----------
+    manifest_file : str
+        Path to the JSON manifest to write.
+    inputs : list of str
+        Paths to the run's input files.
+    params : dict
+        JSON-serializable parameters of the run.
+    outputs : list of str
+        Paths to the run's output files.
+
+    Returns
+    -------
+    bool
+        True if a manifest was written, and the run can be skipped.
+    """
+    if os.path.isfile(manifest_file):
+        return False
+
+    if not all(is_up_to_date(out_file, inputs) for out_file in outputs):
+        return False
+
+    write_manifest(manifest_file, inputs, params, outputs)
+    return True
@@ -4,15 +4,17 @@ import os
 from glob import glob
 
 import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
 import seaborn as sns
+from utils import get_confounds_summary
 
 
 if __name__ == "__main__":
     in_dir = "/cbica/projects/pafin/derivatives/fmriprep"
     data_dir = "/cbica/projects/pafin/code/data"
     figure_dir = "/cbica/projects/pafin/code/figures"
+    # Shared with processing/run_tedana.py
+    confounds_cache = "/cbica/comp_space/pafin/fmriprep_confounds_cache"
 
     # Get all subject directories
     in_files = glob(
@@ -29,20 +31,8 @@ if __name__ == "__main__":
 
     out_dfs = []
     for in_file in in_files:
-        df = pd.read_table(in_file)
-        # Drop non-steady-state volumes
-        nss_cols = [col for col in df.columns if col.startswith("non_steady_state_outlier")]
-        dummy_scans = 0
-        if nss_cols:
-            initial_volumes_df = df[nss_cols]
-            dummy_scans = np.any(initial_volumes_df.to_numpy(), axis=1)
-            dummy_scans = np.where(dummy_scans)[0]
-
-            # reasonably assumes all NSS volumes are contiguous
-            dummy_scans = int(dummy_scans[-1] + 1)
-
-        df = df.iloc[dummy_scans:]
-        fd = df["framewise_displacement"].median()
+        # Median FD after dropping non-steady-state volumes
+        _, fd = get_confounds_summary(in_file, cache_dir=confounds_cache)
         entities = os.path.basename(in_file).split("_")
         task = [e for e in entities if e.startswith("task-")]
         task = task[0].replace("task-", "")
@@ -0,0 +1,119 @@
+"""Shared helpers for the QC scripts.
+
+:func:`get_confounds_summary` and the helpers it uses are copied from processing/utils.py,
+so the QC plots read the same per-run cache as processing/run_tedana.py.
+The QC scripts run from their own folder, so they cannot import the processing helpers.
+Keep the copies identical (tests/test_utils.py checks that they are).
+"""
+
+import hashlib
+import json
+import os
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+
+@contextmanager
+def atomic_output(out_file):
+    """Yield a temporary path to write an output to, then rename it to the output path.
+
+    The temporary file is in the same directory and has the same extension (e.g., ``.nii.gz``),
+    so writers that infer the format from the name work, and the rename is atomic.
+    If the block raises, the temporary file is removed and the output is left untouched,
+    so a killed or failed job never leaves a truncated file that looks complete.
+    """
+    out_dir, base_name = os.path.split(os.path.abspath(out_file))
+    stem, _, extension = base_name.partition(".")
+    # The writer creates the file, so it gets the usual permissions, unlike with mkstemp
+    temp_file = os.path.join(out_dir, f".{stem}.{uuid.uuid4().hex}.{extension}".rstrip("."))
+    try:
+        yield temp_file
+        os.replace(temp_file, out_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def write_json_atomic(data, out_file):
+    """Write a JSON file via a temporary file and a rename, so readers never see a partial file."""
+    with atomic_output(out_file) as temp_file:
+        with open(temp_file, "w") as fo:
+            json.dump(data, fo, indent=1, sort_keys=True)
+
+
+def _read_confounds_summary(confounds_file):
+    """Read the number of non-steady-state volumes and median FD from a confounds file."""
+    columns = pd.read_table(confounds_file, nrows=0).columns
+    nss_cols = [c for c in columns if c.startswith("non_steady_state_outlier")]
+    fd_cols = [c for c in columns if c == "framewise_displacement"]
+    confounds_df = pd.read_table(confounds_file, usecols=nss_cols + fd_cols)
+
+    dummy_scans = 0
+    if nss_cols:
+        initial_volumes_df = confounds_df[nss_cols]
+        dummy_scans = np.any(initial_volumes_df.to_numpy(), axis=1)
+        dummy_scans = np.where(dummy_scans)[0]
+
+        # reasonably assumes all NSS volumes are contiguous
+        dummy_scans = int(dummy_scans[-1] + 1) if dummy_scans.size else 0
+
+    median_fd = None
+    if fd_cols:
+        median_fd = float(confounds_df["framewise_displacement"].iloc[dummy_scans:].median())
+
+    return dummy_scans, median_fd
+
+
+def get_confounds_summary(confounds_file, cache_dir=None):
+    """Get the number of non-steady-state volumes and the median FD of an fMRIPrep run.
+
+    Only the non-steady-state outlier and framewise displacement columns are read.
+
+    Parameters
+    ----------
+    confounds_file : str
+        Path to an fMRIPrep ``desc-confounds_timeseries.tsv`` file.
+    cache_dir : str or None
+        Directory in which to cache the results, with one small JSON file per confounds file,
+        keyed on the confounds file's path, modification time, and size.
+        Entries for modified files are recomputed.
+        Each entry is written on its own, so concurrent jobs never overwrite each other's entries.
+        If None, nothing is cached.
+
+    Returns
+    -------
+    dummy_scans : int
+        Number of initial non-steady-state volumes.
+    median_fd : float or None
+        Median framewise displacement after the non-steady-state volumes,
+        or None if the file has no framewise_displacement column.
+    """
+    confounds_file = os.path.abspath(confounds_file)
+    stat = os.stat(confounds_file)
+    key = {"path": confounds_file, "mtime": stat.st_mtime, "size": stat.st_size}
+
+    cache_file = None
+    if cache_dir is not None:
+        name = os.path.basename(confounds_file).replace(".tsv", "")
+        path_hash = hashlib.sha256(confounds_file.encode()).hexdigest()[:16]
+        cache_file = os.path.join(cache_dir, f"{name}_{path_hash}.json")
+        if os.path.isfile(cache_file):
+            with open(cache_file, "r") as fo:
+                entry = json.load(fo)
+
+            if all(entry.get(k) == v for k, v in key.items()):
+                return entry["dummy_scans"], entry["median_fd"]
+
+    dummy_scans, median_fd = _read_confounds_summary(confounds_file)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_json_atomic(
+            {**key, "dummy_scans": dummy_scans, "median_fd": median_fd},
+            cache_file,
+        )
+
+    return dummy_scans, median_fd
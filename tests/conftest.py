@@ -0,0 +1,39 @@
+"""Shared fixtures for the tests of the curation and processing scripts."""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def load_script():
+    """Import a script by its path in the repository, e.g., "curation/12_fix_bids.py".
+
+    The curation and processing folders each have their own ``utils`` module,
+    so the cached helper modules are dropped before each import,
+    and the script picks up the ones next to it.
+    """
+
+    def _load_script(relative_path):
+        path = os.path.join(REPO_DIR, relative_path)
+        script_dir = os.path.dirname(path)
+        for name in ("utils", "physio_peaks"):
+            sys.modules.pop(name, None)
+
+        sys.path.insert(0, script_dir)
+        try:
+            name = os.path.splitext(os.path.basename(path))[0]
+            spec = importlib.util.spec_from_file_location(f"_script_{name}", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            sys.path.remove(script_dir)
+
+        return module
+
+    return _load_script
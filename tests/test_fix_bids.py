@@ -0,0 +1,35 @@
+"""Tests for curation/12_fix_bids.py."""
+
+import json
+
+import nibabel as nb
+import numpy as np
+
+
+def test_split_noise_volumes_keeps_scaling(tmp_path, load_script):
+    """Split a scaled int16 run and check the scaled values of both outputs."""
+    fix_bids = load_script("curation/12_fix_bids.py")
+
+    rng = np.random.default_rng(0)
+    raw = rng.integers(0, 4096, size=(3, 4, 5, 246), dtype=np.int16)
+    img = nb.Nifti1Image(raw, np.eye(4))
+    img.header.set_data_dtype(np.int16)
+    img.header.set_slope_inter(2, -4096)
+    bold_file = str(tmp_path / "sub-01_ses-1_task-rest_echo-1_part-phase_bold.nii.gz")
+    noise_file = bold_file.replace("_bold.nii.gz", "_noRF.nii.gz")
+    img.to_filename(bold_file)
+    with open(bold_file.replace(".nii.gz", ".json"), "w") as fo:
+        json.dump({"RepetitionTime": 1.761}, fo)
+
+    expected = nb.load(bold_file).get_fdata()
+    assert fix_bids.split_noise_volumes(bold_file, noise_file) == "done"
+
+    bold_img, noise_img = nb.load(bold_file), nb.load(noise_file)
+    assert bold_img.shape == (3, 4, 5, 243)
+    assert noise_img.shape == (3, 4, 5, 3)
+    assert np.array_equal(bold_img.get_fdata(), expected[..., :243])
+    assert np.array_equal(noise_img.get_fdata(), expected[..., 243:])
+    assert bold_img.get_data_dtype() == noise_img.get_data_dtype() == np.int16
+
+    # A split run is not split again
+    assert fix_bids.split_noise_volumes(bold_file, noise_file) == "skipped"
@@ -0,0 +1,43 @@
+"""Tests for the run manifests in processing/utils.py."""
+
+import os
+
+
+def _write(path, text="x", mtime=None):
+    path.write_text(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+    return str(path)
+
+
+def test_adopt_legacy_outputs(tmp_path, load_script):
+    """Adopt outputs made before manifests were tracked only if they are newer than the inputs."""
+    utils = load_script("processing/utils.py")
+    inputs = [_write(tmp_path / "echo-1.nii.gz", mtime=1000), _write(tmp_path / "confounds.tsv")]
+    outputs = [_write(tmp_path / "desc-optcom_bold.nii.gz", mtime=2000)]
+    manifest_file = str(tmp_path / "manifest.json")
+    params = {"tree": "minimal"}
+
+    # The confounds file is newer than the legacy output, so the run must be recomputed
+    assert not utils.adopt_legacy_outputs(manifest_file, inputs, params, outputs)
+    assert not os.path.isfile(manifest_file)
+
+    os.utime(inputs[1], (1500, 1500))
+    assert utils.adopt_legacy_outputs(manifest_file, inputs, params, outputs)
+    assert utils.manifest_is_current(manifest_file, inputs, params)
+
+    # A manifest is never overwritten by adoption
+    assert not utils.adopt_legacy_outputs(manifest_file, inputs, params, outputs)
+
+
+def test_adopt_legacy_outputs_missing_output(tmp_path, load_script):
+    """Never adopt an incomplete set of legacy outputs."""
+    utils = load_script("processing/utils.py")
+    inputs = [_write(tmp_path / "echo-1.nii.gz", mtime=1000)]
+    outputs = [
+        _write(tmp_path / "desc-optcom_bold.nii.gz", mtime=2000),
+        str(tmp_path / "desc-denoised_bold.nii.gz"),
+    ]
+    manifest_file = str(tmp_path / "manifest.json")
+    assert not utils.adopt_legacy_outputs(manifest_file, inputs, {}, outputs)
@@ -0,0 +1,57 @@
+"""Tests for processing/calculate_phase_jolt.py."""
+
+import os
+
+import nibabel as nb
+import numpy as np
+
+
+def _write_series(out_dir, shape=(12, 12, 4), n_vols=8, n_echoes=3):
+    """Write a random float32 series for each echo, like LayNII's uncompressed outputs."""
+    rng = np.random.default_rng(0)
+    echo_files = []
+    for i_echo in range(n_echoes):
+        data = rng.standard_normal(shape + (n_vols,)).astype(np.float32)
+        echo_file = os.path.join(out_dir, f"echo-{i_echo + 1}_desc-jolt.nii")
+        nb.Nifti1Image(data, np.eye(4)).to_filename(echo_file)
+        echo_files.append(echo_file)
+
+    return echo_files
+
+
+def test_average_echoes(tmp_path, load_script):
+    """Average echoes volume by volume, as in memory."""
+    phase_jolt = load_script("processing/calculate_phase_jolt.py")
+    echo_files = _write_series(str(tmp_path))
+    out_file = str(tmp_path / "desc-jolt.nii.gz")
+    phase_jolt.average_echoes(echo_files, out_file, by_volume=True, max_memory=2**10)
+
+    expected = np.mean([nb.load(f).get_fdata() for f in echo_files], axis=0)
+    np.testing.assert_allclose(nb.load(out_file).get_fdata(), expected, rtol=1e-6, atol=1e-6)
+
+
+def test_summarize_phase_derivatives(tmp_path, load_script):
+    """Summarize each echo and the across-echo mean within the brain mask."""
+    phase_jolt = load_script("processing/calculate_phase_jolt.py")
+    echo_files = _write_series(str(tmp_path))
+    mask_file = str(tmp_path / "mask.nii.gz")
+    mask = np.zeros((12, 12, 4), dtype=np.uint8)
+    mask[2:10, 2:10] = 1
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+
+    derivative_files = {name: echo_files for name in phase_jolt.PHASE_DERIVATIVES}
+    summary_df = phase_jolt.summarize_phase_derivatives(derivative_files, mask_file)
+    assert len(summary_df) == 8
+    assert len(summary_df.columns) == (
+        len(phase_jolt.PHASE_DERIVATIVES) * len(phase_jolt.SUMMARY_STATISTICS) * 4
+    )
+
+    echo_data = [nb.load(f).get_fdata(dtype=np.float32)[mask.astype(bool)] for f in echo_files]
+    mean_data = np.mean(echo_data, axis=0, dtype=np.float64).astype(np.float32)
+    np.testing.assert_allclose(summary_df["phase_jolt_mean"], mean_data.mean(axis=0), rtol=1e-5)
+    np.testing.assert_allclose(
+        summary_df["phase_jump_p95"], np.percentile(mean_data, 95, axis=0), rtol=1e-5
+    )
+    np.testing.assert_allclose(
+        summary_df["phase_laplacian_echo2_median"], np.median(echo_data[1], axis=0), rtol=1e-5
+    )
@@ -0,0 +1,79 @@
+"""Tests for processing/calculate_physio_regressors.py."""
+
+import os
+
+import pytest
+
+
+BOLD_NAME = "sub-01_ses-1_task-rest_dir-AP_run-01_echo-1_part-mag_bold.nii.gz"
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+    return path
+
+
+@pytest.mark.parametrize(
+    "physio_prefix",
+    [
+        # as written by curation/04_convert_physio.py, with the run number of the PhysioLog
+        "sub-01_ses-1_task-rest_dir-AP_run-01",
+        # with the run entity of the physio DICOM, followed by the one 04 adds
+        "sub-01_ses-1_task-rest_dir-AP_run-1_run-01",
+        # with an acq entity that the BOLD file does not have
+        "sub-01_ses-1_task-rest_acq-multiecho_dir-AP_run-01",
+    ],
+)
+def test_find_physio_files(tmp_path, load_script, physio_prefix):
+    """Find the recordings of a BOLD run with the names the physio conversion writes."""
+    regressors = load_script("processing/calculate_physio_regressors.py")
+
+    func_dir = tmp_path / "sub-01" / "ses-1" / "func"
+    bold_file = _touch(str(func_dir / BOLD_NAME))
+    physio_files = {
+        label: _touch(str(func_dir / f"{physio_prefix}_recording-{label}_physio.tsv.gz"))
+        for label in ("cardiac", "respiratory", "trigger")
+    }
+    # recordings of other runs
+    _touch(str(func_dir / "sub-01_ses-1_task-rest_dir-AP_run-02_recording-cardiac_physio.tsv.gz"))
+    _touch(str(func_dir / "sub-01_ses-1_task-rat_dir-AP_run-01_recording-cardiac_physio.tsv.gz"))
+
+    found = regressors.find_physio_files(bold_file)
+    assert found == {label: physio_files[label] for label in ("cardiac", "respiratory")}
+
+
+def test_find_physio_files_from_conversion_plan(tmp_path, load_script):
+    """Find the recordings at the prefixes planned by curation/04_convert_physio.py."""
+    pytest.importorskip("bidsphysio.dcm2bids")
+    convert_physio = load_script("curation/04_convert_physio.py")
+    regressors = load_script("processing/calculate_physio_regressors.py")
+
+    subject_dir = tmp_path / "sourcedata/imaging/scitran/bbl/PAFIN_844353/01_12345"
+    for run in ("1", "2"):
+        _touch(
+            str(
+                subject_dir
+                / "CAMRIS^Satterthwaite"
+                / f"func-bold_task-rest_dir-AP_run-{run}_PhysioLog"
+                / f"func-bold_task-rest_dir-AP_run-{run}_PhysioLog.dcm"
+            )
+        )
+
+    jobs, _ = convert_physio.plan_conversions(str(tmp_path))
+    assert len(jobs) == 2
+    for job in jobs.values():
+        # bidsphysio's save_to_bids appends the recording label to the prefix
+        for label in ("cardiac", "respiratory"):
+            _touch(f"{job['prefix']}_recording-{label}_physio.tsv.gz")
+
+    func_dir = tmp_path / "dset" / "sub-01" / "ses-1" / "func"
+    for run in ("01", "02"):
+        bold_file = str(func_dir / BOLD_NAME.replace("run-01", f"run-{run}"))
+        found = regressors.find_physio_files(bold_file)
+        # the DICOMs' run entities come first, and 04 appends run-01 to both
+        prefix = jobs[f"sub-01_ses-1_task-rest_dir-AP_run-{int(run)}_run-01"]["prefix"]
+        assert found == {
+            label: f"{prefix}_recording-{label}_physio.tsv.gz"
+            for label in ("cardiac", "respiratory")
+        }
@@ -0,0 +1,43 @@
+"""Tests for processing/calculate_t1maps.py."""
+
+import json
+import os
+
+import nibabel as nb
+import numpy as np
+
+
+def _write_tdp_pair(anat_dir, prefix, shape=(6, 6, 4), tdp2_shape=None):
+    """Write a pair of TDP volumes and the second volume's metadata into a BIDS anat folder."""
+    rng = np.random.default_rng(0)
+    os.makedirs(anat_dir, exist_ok=True)
+    tdp1 = 1000 + 100 * rng.random(shape)
+    tdp2 = 1000 * rng.uniform(0.2, 0.8, tdp2_shape or shape)
+    for acq, data in (("tr1", tdp1), ("tr2", tdp2)):
+        out_file = os.path.join(anat_dir, f"{prefix}_acq-{acq}_TDP.nii.gz")
+        nb.Nifti1Image(data.astype(np.float32), np.eye(4)).to_filename(out_file)
+
+    with open(os.path.join(anat_dir, f"{prefix}_acq-tr2_TDP.json"), "w") as f:
+        json.dump({"SaturationPulseTime": 5, "InversionTime": 1.978}, f)
+
+
+def test_run_batch_reports_each_run(tmp_path, load_script):
+    """A bad TDP pair only fails its own T1 map, and is reported by run."""
+    t1maps = load_script("processing/calculate_t1maps.py")
+    in_dir, out_dir = str(tmp_path / "dset"), str(tmp_path / "t1maps")
+    _write_tdp_pair(os.path.join(in_dir, "sub-01", "ses-1", "anat"), "sub-01_ses-1")
+    _write_tdp_pair(
+        os.path.join(in_dir, "sub-02", "ses-1", "anat"), "sub-02_ses-1", tdp2_shape=(6, 6, 3)
+    )
+
+    results = t1maps.run_batch(in_dir, out_dir)
+    good = os.path.join("sub-01", "ses-1", "anat", "sub-01_ses-1_T1map.nii.gz")
+    bad = os.path.join("sub-02", "ses-1", "anat", "sub-02_ses-1_T1map.nii.gz")
+    assert set(results) == {good, bad}
+    assert results[good][0] == "done"
+    assert results[bad][0] == "failed"
+    assert os.path.isfile(os.path.join(out_dir, good))
+    assert not os.path.isfile(os.path.join(out_dir, bad))
+
+    # The finished map is skipped, and the bad pair is retried
+    assert set(t1maps.run_batch(in_dir, out_dir)) == {bad}
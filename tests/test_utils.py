@@ -0,0 +1,96 @@
+"""Tests for the helpers shared by the curation, processing, and QC utils modules."""
+
+import inspect
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+SHARED_HELPERS = (
+    "BLAS_THREAD_VARS",
+    "limit_blas_threads",
+    "_run_job",
+    "run_jobs",
+    "print_job_summary",
+    "atomic_output",
+)
+
+
+@pytest.mark.parametrize("name", SHARED_HELPERS)
+def test_shared_helpers_are_identical(load_script, name):
+    """Check that the copies of the shared helpers have not drifted apart."""
+    curation_utils = load_script("curation/utils.py")
+    processing_utils = load_script("processing/utils.py")
+    curation_helper = getattr(curation_utils, name)
+    processing_helper = getattr(processing_utils, name)
+    if callable(curation_helper):
+        assert inspect.getsource(curation_helper) == inspect.getsource(processing_helper)
+    else:
+        assert curation_helper == processing_helper
+
+
+def test_atomic_output(tmp_path, load_script):
+    """Check that an output is only replaced when its block succeeds."""
+    curation_utils = load_script("curation/utils.py")
+    out_file = tmp_path / "sub-01_bold.nii.gz"
+    out_file.write_text("old")
+
+    with pytest.raises(RuntimeError):
+        with curation_utils.atomic_output(str(out_file)) as temp_file:
+            assert temp_file.endswith(".nii.gz")
+            with open(temp_file, "w") as fo:
+                fo.write("partial")
+            raise RuntimeError("killed")
+
+    assert out_file.read_text() == "old"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["sub-01_bold.nii.gz"]
+
+    with curation_utils.atomic_output(str(out_file)) as temp_file:
+        with open(temp_file, "w") as fo:
+            fo.write("new")
+
+    assert out_file.read_text() == "new"
+
+
+QC_HELPERS = (
+    "atomic_output",
+    "write_json_atomic",
+    "_read_confounds_summary",
+    "get_confounds_summary",
+)
+
+
+@pytest.mark.parametrize("name", QC_HELPERS)
+def test_qc_helpers_are_identical(load_script, name):
+    """Check that the QC copies of the confounds summary helpers have not drifted apart."""
+    qc_utils = load_script("qc/utils.py")
+    processing_utils = load_script("processing/utils.py")
+    assert inspect.getsource(getattr(qc_utils, name)) == inspect.getsource(
+        getattr(processing_utils, name)
+    )
+
+
+@pytest.mark.parametrize("nss", [[1, 1, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0], None])
+def test_get_confounds_summary(tmp_path, load_script, nss):
+    """Count the non-steady-state volumes, including none flagged, and cache the summary."""
+    processing_utils = load_script("processing/utils.py")
+    confounds = {"framewise_displacement": [np.nan, 0.5, 0.1, 0.2, 0.3, 0.4], "other": range(6)}
+    if nss is not None:
+        confounds["non_steady_state_outlier00"] = nss
+
+    confounds_file = str(tmp_path / "sub-01_task-rest_desc-confounds_timeseries.tsv")
+    pd.DataFrame(confounds).to_csv(confounds_file, sep="\t", index=False)
+    cache_dir = str(tmp_path / "cache")
+
+    expected_dummy_scans = 2 if nss is not None and any(nss) else 0
+    expected_fd = pd.Series(confounds["framewise_displacement"][expected_dummy_scans:]).median()
+    for _ in range(2):
+        dummy_scans, median_fd = processing_utils.get_confounds_summary(
+            confounds_file, cache_dir=cache_dir
+        )
+        assert dummy_scans == expected_dummy_scans
+        assert median_fd == pytest.approx(expected_fd)
+
+    assert len(os.listdir(cache_dir)) == 1